@@ -0,0 +1,247 @@
+"""
+Batch analysis of positions: positions in FEN or EPD are read from a file (or stdin), analysed in chunks across
+a pool of worker processes and written as JSONL in input order. For each position the legal move count,
+check/checkmate/stalemate status, best move and evaluation are reported.
+With a multipv limit above 1, the best moves are reported with their scores and principal variations.
+Searches can be cached across runs in an analysis cache (see analysiscache.py), which is checked first.
+Only a bounded number of chunks is in flight at once, so arbitrarily large inputs can be streamed.
+"""
+import game, engine, moves, pieces, pgn, tablebase, analysiscache, parallel
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import os
+import sys
+import time
+
+DEFAULT_CHUNK_SIZE = 32
+
+# EPD opcodes overriding the limits of a position (see https://www.chessprogramming.org/Extended_Position_Description)
+LIMIT_OPCODES = {"acd": "depth", "acn": "nodes", "acs": "time"}
+
+
+def parse_line(line: str) -> Tuple[str, Dict]:
+    """
+    Parses a line of FEN or EPD
+    Returns the FEN (without clocks) and the EPD operations (e.g. {"bm": "Nf3", "id": "test 1"})
+    """
+    fields = line.split()
+    if len(fields) <= 4 or (len(fields) == 6 and fields[4].isdigit() and fields[5].isdigit()):
+        # FEN (possibly with clocks)
+        return " ".join(fields[:4]), {}
+
+    operations = {}
+    for operation in " ".join(fields[4:]).split(";"):
+        opcode, _, operand = operation.strip().partition(" ")
+        if opcode != "":
+            operations[opcode] = operand.strip().strip('"')
+    return " ".join(fields[:4]), operations
+
+def score_to_json(score: int) -> Dict:
+    """
+    Converts a search score to JSON: {"cp": centipawns} or {"mate": moves} (negative if the side to move is mated)
+    """
+    mate = engine.score_to_mate(score=score)
+    if mate is not None:
+        return {"mate": mate}
+    return {"cp": score}
+
+def analyse_position(line: str, limits: Dict, tablebases: Optional[tablebase.Tablebases] = None, cache: Optional[analysiscache.AnalysisCache] = None) -> Dict:
+    """
+    Analyses a position given as a line of FEN or EPD
+    Arguments:
+    - line: FEN or EPD (the EPD opcodes acd, acn and acs override the depth, nodes and time limits)
+    - limits: search limits with the keys "depth", "nodes" and "time" (in seconds), any of which can be None,
+      and optionally "multipv" (number of best moves reported in "lines")
+    - tablebases: endgame tablebases used by the search
+    - cache: analysis cache checked before searching, in which the search results are stored
+    Returns: a Dict describing the position
+    """
+    start_time = time.perf_counter()
+    fen, operations = parse_line(line=line)
+    limits = dict(limits)
+    for opcode, limit in LIMIT_OPCODES.items():
+        if opcode in operations:
+            limits[limit] = float(operations[opcode]) if limit == "time" else int(operations[opcode])
+
+    state = game.fen_to_state(fen=fen)
+    move_list = moves.get_all_possible_moves(state=state, side=state["turn"])
+    check = pieces.in_check(state=state, side=state["turn"])
+    analysis = {
+        "fen": fen,
+        "legal_moves": len(move_list),
+        "check": check,
+        "checkmate": check and len(move_list) == 0,
+        "stalemate": not check and len(move_list) == 0,
+        "best_move": None,
+        "best_move_san": None,
+        "score": None,
+        "depth": 0,
+        "nodes": 0,
+    }
+    if len(operations) > 0:
+        analysis["epd"] = operations
+
+    if len(move_list) > 0:
+        depth = limits.get("depth")
+        if depth is None:
+            # Only the nodes or time limit stops the search
+            depth = engine.MAX_DEPTH if limits.get("nodes") is not None or limits.get("time") is not None else engine.DEFAULT_DEPTH
+        searcher = engine.Searcher(
+            depth=depth,
+            tablebases=tablebases,
+            max_nodes=limits.get("nodes"),
+            max_time=limits.get("time"),
+            multi_pv=limits.get("multipv") or 1,
+        )
+        # The settings of the search change its results, so they are part of the cache key
+        cached = cache.get_move(state=state, limits=searcher.get_settings()) if cache is not None else None
+        if cached is not None:
+            move, score = cached["best_move"], cached["score"]
+            analysis["depth"] = cached["depth"]
+            analysis["nodes"] = cached["nodes"]
+            lines = cached["lines"]
+            analysis["cached"] = True
+        else:
+            move, score = searcher.search(state=state)
+            if cache is not None:
+                cache.put_search(state=state, limits=searcher.get_settings(), searcher=searcher, move=move, score=score)
+            analysis["depth"] = searcher.completed_depth
+            analysis["nodes"] = searcher.nodes
+            lines = [
+                {
+                    "move": game.move_to_coordinates(move=line["move"]),
+                    "score": line["score"],
+                    "pv": [game.move_to_coordinates(move=pv_move) for pv_move in line["pv"]],
+                }
+                for line in searcher.lines
+            ]
+        analysis["best_move"] = game.move_to_coordinates(move=move)
+        analysis["best_move_san"] = pgn.move_to_san(state=state, move=move)
+        analysis["score"] = score_to_json(score=score) if analysis["depth"] > 0 else None
+        if searcher.multi_pv > 1:
+            analysis["lines"] = [{**line, "score": score_to_json(score=line["score"])} for line in lines]
+
+    analysis["seconds"] = time.perf_counter() - start_time
+    return analysis
+
+def analyse_chunk(lines: List[Tuple[int, str]], limits: Dict, tablebases: Optional[tablebase.Tablebases] = None, cache: Optional[analysiscache.AnalysisCache] = None) -> List[Dict]:
+    """
+    Analyses a chunk of (index, line) pairs in a worker process
+    Invalid positions are reported with an error rather than stopping the batch
+    """
+    results = []
+    for index, line in lines:
+        try:
+            analysis = analyse_position(line=line, limits=limits, tablebases=tablebases, cache=cache)
+        except Exception as error:
+            analysis = {"fen": line.strip(), "error": str(error)}
+        results.append({"index": index, **analysis})
+    return results
+
+def read_chunks(lines: Iterable[str], chunk_size: int) -> Iterator[List[Tuple[int, str]]]:
+    """
+    Groups the non-empty lines (ignoring comments starting with #) into chunks of (index, line) pairs
+    """
+    positions = (line.strip() for line in lines if line.strip() != "" and not line.strip().startswith("#"))
+    return parallel.chunks(items=enumerate(positions), chunk_size=chunk_size)
+
+
+def run_analysis(
+    lines: Iterable[str],
+    output: TextIO,
+    limits: Dict,
+    workers: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_pending: Optional[int] = None,
+    tablebases: Optional[tablebase.Tablebases] = None,
+    cache: Optional[analysiscache.AnalysisCache] = None,
+) -> Dict:
+    """
+    Analyses positions in a pool of worker processes, writing the results as JSONL in input order
+    Arguments:
+    - lines: lines of FEN or EPD (read lazily)
+    - output: file the results are written to
+    - limits: search limits of each position (see analyse_position)
+    - workers: number of worker processes (defaults to the number of CPUs)
+    - chunk_size: number of positions sent to a worker at once
+    - max_pending: maximum number of chunks in flight (defaults to twice the number of workers), which bounds memory use
+    - tablebases: endgame tablebases used by the search
+    - cache: analysis cache shared by the workers (each opens the file again)
+    Returns: statistics of the analysis
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * workers
+    positions = 0
+    errors = 0
+    nodes = 0
+    start_time = time.perf_counter()
+
+    def write_results(results: List[Dict]):
+        nonlocal positions, errors, nodes
+        for analysis in results:
+            output.write(json.dumps(analysis) + "\n")
+            positions += 1
+            if "error" in analysis:
+                errors += 1
+            else:
+                nodes += analysis["nodes"]
+        output.flush()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        tasks = (
+            (analyse_chunk, {"lines": chunk, "limits": limits, "tablebases": tablebases, "cache": cache})
+            for chunk in read_chunks(lines=lines, chunk_size=chunk_size)
+        )
+        # Results in input order, with a bounded number of chunks in flight
+        for results in parallel.map_ordered(executor=executor, tasks=tasks, max_pending=max_pending):
+            write_results(results=results)
+
+    elapsed = time.perf_counter() - start_time
+    return {
+        "positions": positions,
+        "errors": errors,
+        "nodes": nodes,
+        "seconds": elapsed,
+        "positions_per_second": positions / elapsed if elapsed > 0 else 0,
+        "nodes_per_second": nodes / elapsed if elapsed > 0 else 0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyse positions in FEN or EPD, writing the results as JSONL")
+    parser.add_argument("input", nargs="?", default="-", help="file of positions, one per line (- for stdin)")
+    parser.add_argument("--output", default="-", help="JSONL file the results are written to (- for stdout)")
+    parser.add_argument("--depth", type=int, default=None, help="search depth of each position")
+    parser.add_argument("--nodes", type=int, default=None, help="maximum number of nodes searched for each position")
+    parser.add_argument("--time", type=float, default=None, help="maximum number of seconds spent on each position")
+    parser.add_argument("--multipv", type=int, default=1, help="number of best moves reported for each position")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--tablebases", default=None, help="directory of endgame tablebases")
+    parser.add_argument("--cache", default=None, help="SQLite file of the analysis cache")
+    args = parser.parse_args()
+
+    input_file = sys.stdin if args.input == "-" else open(args.input)
+    output_file = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        stats = run_analysis(
+            lines=input_file,
+            output=output_file,
+            limits={"depth": args.depth, "nodes": args.nodes, "time": args.time, "multipv": args.multipv},
+            workers=args.workers,
+            chunk_size=args.chunk_size,
+            tablebases=tablebase.Tablebases(directory=args.tablebases) if args.tablebases is not None else None,
+            cache=analysiscache.AnalysisCache(path=args.cache) if args.cache is not None else None,
+        )
+    finally:
+        for file in [input_file, output_file]:
+            if file not in [sys.stdin, sys.stdout]:
+                file.close()
+
+    # The report goes to stderr so that it doesn't mix with the results on stdout
+    print(f"Analysed {stats['positions']} positions ({stats['errors']} errors) in {stats['seconds']:.1f}s", file=sys.stderr)
+    print(f"{stats['positions_per_second']:.2f} positions/s, {stats['nodes_per_second']:.0f} nodes/s", file=sys.stderr)
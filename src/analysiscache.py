@@ -0,0 +1,255 @@
+"""
+Persistent analysis cache: an SQLite store of search results (best move, score, depth, nodes, legal move count and
+multi-PV lines) keyed by position key (zobrist.position_key) and search settings (see engine.Searcher.get_settings),
+shared across runs and processes.
+
+The cache is bounded: the least recently used analyses are evicted once it holds more than max_entries.
+Write-ahead logging lets several processes read while one writes, and writers wait for each other (up to
+BUSY_TIMEOUT seconds) rather than failing. The last use of an analysis is only updated every TOUCH_INTERVAL seconds,
+so that reads rarely write. Each process opens the file once, however many copies of the cache it unpickles,
+and closes it when the last cache of the file is closed.
+"""
+import game, moves, zobrist, parallel
+from typing import Dict, Optional, Tuple
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_ENTRIES = 1000000
+# Number of stores between checks of the size of the cache (counted in the file, so across all processes)
+EVICTION_INTERVAL = 1000
+# Seconds a writer waits for other writers
+BUSY_TIMEOUT = 30
+# Seconds between updates of the last use of an analysis
+TOUCH_INTERVAL = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    key INTEGER NOT NULL,
+    limits TEXT NOT NULL,
+    best_move TEXT,
+    score INTEGER,
+    depth INTEGER NOT NULL,
+    nodes INTEGER NOT NULL,
+    legal_moves INTEGER NOT NULL,
+    lines TEXT,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (key, limits)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS analyses_last_used ON analyses (last_used);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters VALUES ('stores', 0);
+"""
+
+
+# Connections opened by each process, with their lock and number of caches using them,
+# by process id and path of the file (see get_connection)
+connections = {}
+connections_lock = threading.Lock()
+
+
+def get_connection(path: str) -> Tuple[sqlite3.Connection, threading.RLock]:
+    """
+    Gets the connection of this process to an SQLite file and the lock serialising its use,
+    opening it (and creating the tables) the first time
+    Child processes open their own connection rather than using the one of their parent
+    Each call must be matched by a call to release_connection
+    """
+    key = (os.getpid(), os.path.abspath(path))
+    with connections_lock:
+        if key not in connections:
+            connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                connection.executescript(SCHEMA)
+            # The connection can be shared between threads, so access is serialised by a lock (reentrant as put calls evict)
+            connections[key] = {"connection": connection, "lock": threading.RLock(), "users": 0}
+        entry = connections[key]
+        entry["users"] += 1
+        return entry["connection"], entry["lock"]
+
+def release_connection(path: str):
+    """
+    Releases the connection of this process to an SQLite file (see get_connection), closing it once it isn't used
+    """
+    key = (os.getpid(), os.path.abspath(path))
+    with connections_lock:
+        entry = connections[key]
+        entry["users"] -= 1
+        if entry["users"] == 0:
+            del connections[key]
+            with entry["lock"]:
+                entry["connection"].close()
+
+def to_signed(key: int) -> int:
+    """
+    Converts a 64 bit position key to a signed integer (SQLite integers are signed)
+    """
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+def limits_key(limits: Dict) -> str:
+    """
+    Gets the canonical form of search limits (e.g. {"depth": 3, "nodes": None}), leaving out those which are None
+    """
+    return json.dumps({name: value for name, value in limits.items() if value is not None}, sort_keys=True)
+
+
+class AnalysisCache(parallel.FileBacked):
+    pickled_arguments = ["path", "max_entries"]
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES) -> None:
+        """
+        Analysis cache stored in an SQLite file (created if it doesn't exist)
+        Arguments:
+        - path: path of the SQLite file
+        - max_entries: maximum number of analyses kept (the least recently used are evicted)
+        """
+        self.path = path
+        self.max_entries = max_entries
+        # The connection is shared by all the caches of the file in this process
+        self.connection, self.lock = get_connection(path=path)
+        self.closed = False
+        self.stores = 0
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        """
+        Closes the cache. The connection of this process to the file is shared by all the caches of the file
+        in this process, so it is only closed with the last of them
+        """
+        if not self.closed:
+            self.closed = True
+            release_connection(path=self.path)
+
+    def get(self, state: Dict, limits: Dict) -> Optional[Dict]:
+        """
+        Gets the analysis of the position with the given search limits (None if it isn't cached)
+        Returns a Dict with the best move (in coordinate notation), score, depth, nodes, number of legal moves
+        and multi-PV lines (None if they weren't stored)
+        """
+        key = (to_signed(key=zobrist.position_key(state=state)), limits_key(limits=limits))
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT best_move, score, depth, nodes, legal_moves, lines, last_used FROM analyses WHERE key = ? AND limits = ?",
+                key,
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            now = time.time()
+            if now - row[6] > TOUCH_INTERVAL:
+                with self.connection:
+                    self.connection.execute("UPDATE analyses SET last_used = ? WHERE key = ? AND limits = ?", (now,) + key)
+        return {
+            "best_move": row[0],
+            "score": row[1],
+            "depth": row[2],
+            "nodes": row[3],
+            "legal_moves": row[4],
+            "lines": json.loads(row[5]) if row[5] is not None else None,
+        }
+
+    def put(self, state: Dict, limits: Dict, analysis: Dict):
+        """
+        Stores the analysis of the position with the given search limits (a Dict with the keys returned by get)
+        """
+        row = (
+            to_signed(key=zobrist.position_key(state=state)),
+            limits_key(limits=limits),
+            analysis["best_move"],
+            analysis["score"],
+            analysis["depth"],
+            analysis["nodes"],
+            analysis["legal_moves"],
+            json.dumps(analysis["lines"]) if analysis.get("lines") is not None else None,
+            time.time(),
+        )
+        with self.lock:
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+                # The stores are counted in the file, as each process (and each unpickled copy) only makes some of them
+                total_stores = self.connection.execute("UPDATE counters SET value = value + 1 WHERE name = 'stores' RETURNING value").fetchone()[0]
+            self.stores += 1
+            if total_stores % EVICTION_INTERVAL == 0:
+                self.evict()
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used analyses beyond max_entries
+        Returns the number of analyses removed
+        """
+        with self.lock:
+            count = self.connection.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+            if count <= self.max_entries:
+                return 0
+            with self.connection:
+                self.connection.execute(
+                    "DELETE FROM analyses WHERE (key, limits) IN (SELECT key, limits FROM analyses ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            return count - self.max_entries
+
+    def get_move(self, state: Dict, limits: Dict) -> Optional[Dict]:
+        """
+        Gets the cached analysis of the position like get, with the best move as a Move of the state
+        Returns None if the analysis isn't cached or its move isn't legal (e.g. if the keys of two positions collide)
+        """
+        analysis = self.get(state=state, limits=limits)
+        if analysis is None or analysis["best_move"] is None:
+            return analysis
+        move = game.choose_move_from_coordinates(state=state, move_input=analysis["best_move"])
+        if move is None:
+            return None
+        return {**analysis, "best_move": move}
+
+    def put_search(self, state: Dict, limits: Dict, searcher, move: Optional[moves.Move], score: int):
+        """
+        Stores the result of a search (by an engine.Searcher) of the position
+        Searches which didn't complete an iteration aren't stored
+        """
+        if searcher.completed_depth == 0:
+            return
+        self.put(state=state, limits=limits, analysis={
+            "best_move": game.move_to_coordinates(move=move) if move is not None else None,
+            "score": score,
+            "depth": searcher.completed_depth,
+            "nodes": searcher.nodes,
+            "legal_moves": len(moves.get_all_possible_moves(state=state, side=state["turn"])),
+            "lines": [
+                {
+                    "move": game.move_to_coordinates(move=line["move"]),
+                    "score": line["score"],
+                    "pv": [game.move_to_coordinates(move=pv_move) for pv_move in line["pv"]],
+                }
+                for line in searcher.lines
+            ] if searcher.multi_pv > 1 else None,
+        })
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            count = self.connection.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+        return {"analyses": count, "hits": self.hits, "misses": self.misses, "stores": self.stores}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the size of an analysis cache, or trim it")
+    parser.add_argument("path", help="path of the SQLite file")
+    parser.add_argument("--max-entries", type=int, default=None, help="remove the least recently used analyses beyond this number")
+    args = parser.parse_args()
+
+    analysis_cache = AnalysisCache(path=args.path)
+    if args.max_entries is not None:
+        analysis_cache.max_entries = args.max_entries
+        removed = analysis_cache.evict()
+        print(f"Removed {removed} analyses")
+    print(f"{analysis_cache.get_stats()['analyses']} analyses")
+    analysis_cache.close()
@@ -0,0 +1,366 @@
+"""
+Batch move generation with bitboards: N positions are held as NumPy arrays of 64 bit bitboards (one per piece type
+and side, see PIECE_TYPES), and attack sets, move counts, check and mate/stalemate flags are computed for all the
+positions at once with shifts and masks (see https://www.chessprogramming.org/Bitboards).
+
+Bit row * 8 + col of a bitboard is the square at (row, col) of the board (so a8 is bit 0 and h1 is bit 63).
+Sliding attacks are computed with Kogge-Stone fills, and legal moves with check masks and pin rays rather than by
+making the moves. The rules are those of moves.get_all_possible_moves, including castling being allowed when in check
+as long as the square the king passes and its final square aren't attacked.
+
+Positions can be made from game states, FEN or the arrays written by tensors.py.
+"""
+import game, moves, pgn, pieces, tensors
+from typing import Dict, Iterable, List, Tuple
+import argparse
+import time
+import numpy as np
+
+PIECE_TYPES = tensors.PIECE_TYPES
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+
+FULL = np.uint64(0xFFFFFFFFFFFFFFFF)
+FILE_A = sum(1 << (row * 8) for row in range(8))
+FILE_H = FILE_A << 7
+NOT_FILE_A = np.uint64(~FILE_A & 0xFFFFFFFFFFFFFFFF)
+NOT_FILE_H = np.uint64(~FILE_H & 0xFFFFFFFFFFFFFFFF)
+NOT_FILE_AB = np.uint64(~(FILE_A | FILE_A << 1) & 0xFFFFFFFFFFFFFFFF)
+NOT_FILE_GH = np.uint64(~(FILE_H | FILE_H >> 1) & 0xFFFFFFFFFFFFFFFF)
+
+# Directions as (row step, col step): N, NE, E, SE, S, SW, W, NW (even directions are orthogonal)
+DIRECTION_STEPS = [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]
+KNIGHT_STEPS = [(-2, -1), (-2, 1), (-1, 2), (1, 2), (2, 1), (2, -1), (1, -2), (-1, -2)]
+
+def step_mask(col_step: int) -> np.uint64:
+    """
+    Gets the mask removing the squares a shift by col_step wraps around to
+    """
+    return {-2: NOT_FILE_GH, -1: NOT_FILE_H, 0: FULL, 1: NOT_FILE_A, 2: NOT_FILE_AB}[col_step]
+
+def shift(bitboards: np.ndarray, row_step: int, col_step: int) -> np.ndarray:
+    """
+    Moves every square of the bitboards by the given steps, dropping the squares which leave the board
+    """
+    amount = row_step * 8 + col_step
+    if amount > 0:
+        shifted = bitboards << np.uint64(amount)
+    else:
+        shifted = bitboards >> np.uint64(-amount)
+    return shifted & step_mask(col_step=col_step)
+
+def slide(generators: np.ndarray, empty: np.ndarray, direction: int) -> np.ndarray:
+    """
+    Gets the squares attacked in a direction by sliding pieces on the generator squares (up to and including
+    the first occupied square), with a Kogge-Stone fill
+    """
+    row_step, col_step = DIRECTION_STEPS[direction]
+    propagators = empty & step_mask(col_step=col_step)
+    amount = row_step * 8 + col_step
+    for distance in [1, 2, 4]:
+        if amount > 0:
+            generators = generators | (propagators & (generators << np.uint64(amount * distance)))
+            propagators = propagators & (propagators << np.uint64(amount * distance))
+        else:
+            generators = generators | (propagators & (generators >> np.uint64(-amount * distance)))
+            propagators = propagators & (propagators >> np.uint64(-amount * distance))
+    return shift(bitboards=generators, row_step=row_step, col_step=col_step)
+
+def square_rays() -> np.ndarray:
+    """
+    Gets the squares in each direction from each square of an empty board, indexed by [direction, square]
+    """
+    rays = np.zeros((8, 64), dtype=np.uint64)
+    for direction, (row_step, col_step) in enumerate(DIRECTION_STEPS):
+        for square in range(64):
+            row, col = divmod(square, 8)
+            ray = 0
+            row, col = row + row_step, col + col_step
+            while 0 <= row < 8 and 0 <= col < 8:
+                ray |= 1 << (row * 8 + col)
+                row, col = row + row_step, col + col_step
+            rays[direction, square] = ray
+    return rays
+
+RAYS = square_rays()
+
+if hasattr(np, "bitwise_count"):
+    def popcount(bitboards: np.ndarray) -> np.ndarray:
+        return np.bitwise_count(bitboards).astype(np.int32)
+else:
+    BYTE_COUNTS = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.int32)
+
+    def popcount(bitboards: np.ndarray) -> np.ndarray:
+        bitboards = np.ascontiguousarray(bitboards, dtype=np.uint64)
+        return BYTE_COUNTS[bitboards.view(np.uint8)].reshape(bitboards.shape + (8,)).sum(axis=-1)
+
+
+def from_tensors(arrays: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """
+    Converts positions encoded by tensors.py (planes, side, castling and en passant arrays) to bitboards
+    Returns the positions: "pieces" (N x 12 bitboards in the order of tensors.py), "turn", "castling" and "en_passant"
+    """
+    planes = np.ascontiguousarray(arrays["planes"]).reshape(len(arrays["planes"]), 12, 64)
+    bytes_ = np.packbits(planes, axis=2, bitorder="little")
+    return {
+        "pieces": np.ascontiguousarray(bytes_).view("<u8").reshape(len(planes), 12).astype(np.uint64),
+        "turn": np.asarray(arrays["side"], dtype=np.uint8),
+        "castling": np.asarray(arrays["castling"], dtype=np.uint8),
+        "en_passant": np.asarray(arrays["en_passant"], dtype=np.int8),
+    }
+
+def from_states(states: List[Dict]) -> Dict[str, np.ndarray]:
+    """
+    Converts game states to bitboards (see from_tensors)
+    """
+    arrays = tensors.allocate(size=len(states))
+    for index, state in enumerate(states):
+        tensors.encode_state(arrays=arrays, index=index, state=state, halfmove=0, fullmove=1)
+    return from_tensors(arrays=arrays)
+
+def from_fens(fens: List[str]) -> Dict[str, np.ndarray]:
+    """
+    Converts positions in FEN to bitboards (see from_tensors)
+    """
+    arrays = tensors.allocate(size=len(fens))
+    for index, fen in enumerate(fens):
+        tensors.encode_fen(arrays=arrays, index=index, fen=fen)
+    return from_tensors(arrays=arrays)
+
+
+def side_attacks(side_pieces: np.ndarray, side: int, empty: np.ndarray) -> np.ndarray:
+    """
+    Gets the squares attacked by the pieces of a side (N x 6 bitboards) given the empty squares
+    """
+    pawn_row_step = -1 if side == 0 else 1
+    attacks = shift(bitboards=side_pieces[:, PAWN], row_step=pawn_row_step, col_step=-1)
+    attacks |= shift(bitboards=side_pieces[:, PAWN], row_step=pawn_row_step, col_step=1)
+    for row_step, col_step in KNIGHT_STEPS:
+        attacks |= shift(bitboards=side_pieces[:, KNIGHT], row_step=row_step, col_step=col_step)
+    for row_step, col_step in DIRECTION_STEPS:
+        attacks |= shift(bitboards=side_pieces[:, KING], row_step=row_step, col_step=col_step)
+    orthogonal = side_pieces[:, ROOK] | side_pieces[:, QUEEN]
+    diagonal = side_pieces[:, BISHOP] | side_pieces[:, QUEEN]
+    for direction in range(8):
+        attacks |= slide(generators=orthogonal if direction % 2 == 0 else diagonal, empty=empty, direction=direction)
+    return attacks
+
+def attackers(square: np.ndarray, side: int, enemy_pieces: np.ndarray, empty: np.ndarray) -> np.ndarray:
+    """
+    Gets the enemy pieces (N x 6 bitboards) attacking the given squares (one per position) of a side
+    """
+    pawn_row_step = -1 if side == 0 else 1
+    found = (shift(bitboards=square, row_step=pawn_row_step, col_step=-1) | shift(bitboards=square, row_step=pawn_row_step, col_step=1)) & enemy_pieces[:, PAWN]
+    for row_step, col_step in KNIGHT_STEPS:
+        found |= shift(bitboards=square, row_step=row_step, col_step=col_step) & enemy_pieces[:, KNIGHT]
+    for row_step, col_step in DIRECTION_STEPS:
+        found |= shift(bitboards=square, row_step=row_step, col_step=col_step) & enemy_pieces[:, KING]
+    orthogonal = enemy_pieces[:, ROOK] | enemy_pieces[:, QUEEN]
+    diagonal = enemy_pieces[:, BISHOP] | enemy_pieces[:, QUEEN]
+    for direction in range(8):
+        found |= slide(generators=square, empty=empty, direction=direction) & (orthogonal if direction % 2 == 0 else diagonal)
+    return found
+
+def count_targets(targets: np.ndarray, promotion_rank: np.uint64) -> np.ndarray:
+    """
+    Counts pawn moves to the target squares: each move to the last rank is 4 moves (one per promotion piece)
+    """
+    return popcount(targets & ~promotion_rank) + 4 * popcount(targets & promotion_rank)
+
+
+def analyse_side(positions: Dict[str, np.ndarray], side: int) -> Dict[str, np.ndarray]:
+    """
+    Computes the move counts and check status of the positions for one side (as if it were to move)
+    """
+    own_pieces = positions["pieces"][:, side * 6:side * 6 + 6]
+    enemy_pieces = positions["pieces"][:, (1 - side) * 6:(1 - side) * 6 + 6]
+    own = np.bitwise_or.reduce(own_pieces, axis=1)
+    enemy = np.bitwise_or.reduce(enemy_pieces, axis=1)
+    empty = ~(own | enemy)
+    king = own_pieces[:, KING]
+    king_square = popcount(king - np.uint64(1))
+    not_own = ~own
+
+    # Enemy attacks without the king on the board, so that the king can't move along the ray of a checking slider
+    enemy_attacks = side_attacks(side_pieces=enemy_pieces, side=1 - side, empty=empty | king)
+    checkers = attackers(square=king, side=side, enemy_pieces=enemy_pieces, empty=empty)
+    checker_count = popcount(checkers)
+
+    # Squares which resolve a single check (taking the checker or blocking it), and pins
+    check_mask = np.where(checker_count == 0, FULL, np.where(checker_count == 1, checkers, np.uint64(0)))
+    pin_rays = []
+    for direction in range(8):
+        sliders = (enemy_pieces[:, ROOK] if direction % 2 == 0 else enemy_pieces[:, BISHOP]) | enemy_pieces[:, QUEEN]
+        ray = slide(generators=king, empty=empty, direction=direction)
+        check_mask |= np.where((checker_count == 1) & ((ray & checkers & sliders) != 0), ray, np.uint64(0))
+        # A piece of the side is pinned if an enemy slider is behind it (seen through it from the king)
+        blocker = ray & own
+        behind = slide(generators=king, empty=empty | blocker, direction=direction)
+        pinned = np.where((behind & sliders & ~ray) != 0, blocker, np.uint64(0))
+        line = RAYS[direction][king_square] | RAYS[(direction + 4) % 8][king_square]
+        pin_rays.append((pinned, line))
+    pinned_pieces = np.bitwise_or.reduce([pinned for pinned, _ in pin_rays], axis=0)
+
+    legal = np.zeros(len(king), dtype=np.int32)
+    pseudo_legal = np.zeros(len(king), dtype=np.int32)
+    # Groups of pieces which can move to the same mask: the unpinned pieces, and the pieces pinned on each ray
+    groups = [(~pinned_pieces, check_mask)] + [(pinned, check_mask & line) for pinned, line in pin_rays]
+
+    # Knights (pinned knights can't move)
+    for row_step, col_step in KNIGHT_STEPS:
+        targets = shift(bitboards=own_pieces[:, KNIGHT], row_step=row_step, col_step=col_step) & not_own
+        pseudo_legal += popcount(targets)
+        legal += popcount(shift(bitboards=own_pieces[:, KNIGHT] & ~pinned_pieces, row_step=row_step, col_step=col_step) & not_own & check_mask)
+
+    # Sliding pieces: the squares attacked in one direction by different pieces don't overlap
+    for direction in range(8):
+        sliders = (own_pieces[:, ROOK] if direction % 2 == 0 else own_pieces[:, BISHOP]) | own_pieces[:, QUEEN]
+        pseudo_legal += popcount(slide(generators=sliders, empty=empty, direction=direction) & not_own)
+        for group, mask in groups:
+            legal += popcount(slide(generators=sliders & group, empty=empty, direction=direction) & not_own & mask)
+
+    # Pawns
+    row_step = -1 if side == 0 else 1
+    double_push_rank = np.uint64(0xFF << (8 * (5 if side == 0 else 2)))
+    promotion_rank = np.uint64(0xFF << (8 * (0 if side == 0 else 7)))
+    for group, mask in [(FULL, FULL)] + groups:
+        pawns = own_pieces[:, PAWN] & group
+        single_pushes = shift(bitboards=pawns, row_step=row_step, col_step=0) & empty
+        double_pushes = shift(bitboards=single_pushes & double_push_rank, row_step=row_step, col_step=0) & empty
+        captures = [shift(bitboards=pawns, row_step=row_step, col_step=col_step) & enemy for col_step in [-1, 1]]
+        count = sum(count_targets(targets=targets & mask, promotion_rank=promotion_rank) for targets in [single_pushes, double_pushes] + captures)
+        if group is FULL:
+            pseudo_legal += count
+        else:
+            legal += count
+
+    # En passant: the move is made on the bitboards, as taking the pawn can uncover a check along the row
+    en_passant = positions["en_passant"].astype(np.int64)
+    has_en_passant = (en_passant >= 0) & (positions["turn"] == side)
+    pawn_row = 3 if side == 0 else 4
+    taken = np.where(has_en_passant, np.left_shift(np.uint64(1), (pawn_row * 8 + np.maximum(en_passant, 0)).astype(np.uint64)), np.uint64(0))
+    target = shift(bitboards=taken, row_step=row_step, col_step=0)
+    for col_step in [-1, 1]:
+        start = shift(bitboards=taken, row_step=0, col_step=col_step) & own_pieces[:, PAWN]
+        possible = start != 0
+        pseudo_legal += possible
+        enemy_after = enemy_pieces.copy()
+        enemy_after[:, PAWN] &= ~taken
+        empty_after = (empty | start | taken) & ~target
+        legal += possible & (attackers(square=king, side=side, enemy_pieces=enemy_after, empty=empty_after) == 0)
+
+    # King moves and castling (the king must not pass through or end on an attacked square)
+    king_targets = np.zeros(len(king), dtype=np.uint64)
+    for row_step_king, col_step in DIRECTION_STEPS:
+        king_targets |= shift(bitboards=king, row_step=row_step_king, col_step=col_step)
+    king_targets &= not_own
+    pseudo_legal += popcount(king_targets)
+    legal += popcount(king_targets & ~enemy_attacks)
+    home_row = 7 if side == 0 else 0
+    for bit, between_cols, passed_col, final_col in [(0, [5, 6], 5, 6), (1, [1, 2, 3], 3, 2)]:
+        between = np.uint64(sum(1 << (home_row * 8 + col) for col in between_cols))
+        passed = np.uint64(1 << (home_row * 8 + passed_col))
+        final = np.uint64(1 << (home_row * 8 + final_col))
+        possible = (positions["castling"][:, side * 2 + bit] != 0) & ((between & ~empty) == 0) & ((enemy_attacks & passed) == 0)
+        pseudo_legal += possible
+        legal += possible & ((enemy_attacks & final) == 0)
+
+    return {
+        "attacks": side_attacks(side_pieces=own_pieces, side=side, empty=empty),
+        "pseudo_legal_moves": pseudo_legal,
+        "legal_moves": legal,
+        "check": checker_count > 0,
+    }
+
+def analyse(positions: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """
+    Analyses a batch of positions (see from_tensors) for the side to move
+    Returns arrays of:
+    - attacks: squares attacked by white and black (N x 2 bitboards)
+    - pseudo_legal_moves: moves of the side to move which may leave its king in check
+    - legal_moves: legal moves of the side to move
+    - check, checkmate, stalemate: status of the side to move
+    """
+    turn = positions["turn"].astype(bool)
+    results = [analyse_side(positions=positions, side=side) for side in range(2)]
+    analysis = {
+        "attacks": np.stack([results[0]["attacks"], results[1]["attacks"]], axis=1),
+        "pseudo_legal_moves": np.where(turn, results[1]["pseudo_legal_moves"], results[0]["pseudo_legal_moves"]),
+        "legal_moves": np.where(turn, results[1]["legal_moves"], results[0]["legal_moves"]),
+        "check": np.where(turn, results[1]["check"], results[0]["check"]),
+    }
+    analysis["checkmate"] = analysis["check"] & (analysis["legal_moves"] == 0)
+    analysis["stalemate"] = ~analysis["check"] & (analysis["legal_moves"] == 0)
+    return analysis
+
+
+def reference_analysis(state: Dict) -> Dict:
+    """
+    Analyses a position with the move generator of pieces.py (used to cross-check analyse)
+    """
+    side = state["turn"]
+    pseudo_legal_moves = sum(
+        len(piece.get_possible_moves(state=state, ignore_checks=True))
+        for piece in state["pieces_params"].values() if piece.side == side
+    )
+    legal_moves = len(moves.get_all_possible_moves(state=state, side=side))
+    check = pieces.in_check(state=state, side=side)
+    return {
+        "pseudo_legal_moves": pseudo_legal_moves,
+        "legal_moves": legal_moves,
+        "check": check,
+        "checkmate": check and legal_moves == 0,
+        "stalemate": not check and legal_moves == 0,
+    }
+
+def cross_check(states: List[Dict]) -> Tuple[List[Dict], float, float]:
+    """
+    Compares analyse with reference_analysis on the states
+    Returns the mismatches (with the FEN and both results) and the seconds taken by both
+    """
+    start_time = time.perf_counter()
+    analysis = analyse(positions=from_states(states=states))
+    batch_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    references = [reference_analysis(state=state) for state in states]
+    reference_seconds = time.perf_counter() - start_time
+
+    mismatches = []
+    for index, (state, reference) in enumerate(zip(states, references)):
+        result = {name: analysis[name][index].item() for name in reference}
+        if result != reference:
+            mismatches.append({"fen": game.state_to_fen(state=state), "batch": result, "reference": reference})
+    return mismatches, batch_seconds, reference_seconds
+
+def read_states(fen_paths: List[str], pgn_paths: List[str]) -> Iterable[Dict]:
+    """
+    Reads positions from FEN files and replayed PGN games
+    """
+    for path in fen_paths:
+        with open(path) as file:
+            for line in file:
+                if line.strip() != "":
+                    yield game.fen_to_state(fen=line)
+    for path in pgn_paths:
+        with open(path) as file:
+            for pgn_game in pgn.read_games(lines=file):
+                try:
+                    for state, _ in pgn.replay_game(san_moves=pgn_game["moves"]):
+                        yield state
+                except Exception:
+                    continue
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cross-check the batch move generator against the move generator of pieces.py")
+    parser.add_argument("--fen", nargs="*", default=[], help="files of positions in FEN, one per line")
+    parser.add_argument("--pgn", nargs="*", default=[], help="PGN files whose positions are checked")
+    args = parser.parse_args()
+
+    states = list(read_states(fen_paths=args.fen, pgn_paths=args.pgn))
+    mismatches, batch_seconds, reference_seconds = cross_check(states=states)
+    for mismatch in mismatches:
+        print(mismatch)
+    print(f"{len(states)} positions, {len(mismatches)} mismatches")
+    print(f"Batch: {batch_seconds:.3f}s ({len(states) / batch_seconds:.0f} positions/s)")
+    print(f"Reference: {reference_seconds:.1f}s ({len(states) / reference_seconds:.0f} positions/s)")
@@ -0,0 +1,170 @@
+"""
+Opening book: a sorted binary file of (position key, move, weight) entries which is looked up
+by binary search through mmap, so opening a book costs nothing however large it is.
+
+Entries use the Polyglot layout (see http://hgm.nubati.net/book_format.html): 16 bytes, big-endian,
+key (64 bits), move (16 bits), weight (16 bits) and learn (32 bits, unused).
+NOTE: the keys are zobrist.position_key rather than the Polyglot keys, so books have to be built with build_book
+"""
+import game, pgn, zobrist, moves, parallel
+from typing import Dict, Iterable, List, Optional, Tuple
+import argparse
+import mmap
+import os
+import random
+import struct
+
+ENTRY = struct.Struct(">QHHI")
+MAX_WEIGHT = 0xFFFF
+PROMOTION_PIECES = [None, "N", "B", "R", "Q"]
+
+
+def encode_move(move: moves.Move) -> int:
+    """
+    Encodes a move in the Polyglot format: to file, to row, from file, from row (3 bits each) and promotion piece
+    Rows are counted from white's side (row 0 is rank 1). Castling is encoded as the king moving to the rook's square.
+    """
+    end_col = move.end_col
+    if move.castling_move is not None:
+        end_col = move.castling_move.start_col
+    return (
+        end_col
+        | (7 - move.end_row) << 3
+        | move.start_col << 6
+        | (7 - move.start_row) << 9
+        | PROMOTION_PIECES.index(move.promotion_piece) << 12
+    )
+
+def decode_move(state: Dict, encoded_move: int) -> Optional[moves.Move]:
+    """
+    Finds the move in the position from its Polyglot encoding (None if it isn't a valid move)
+    """
+    column_letters = "abcdefgh"
+    end_col = encoded_move & 0x7
+    end_row = 7 - (encoded_move >> 3 & 0x7)
+    start_col = encoded_move >> 6 & 0x7
+    start_row = 7 - (encoded_move >> 9 & 0x7)
+    promotion_piece = PROMOTION_PIECES[encoded_move >> 12 & 0x7]
+
+    # Castling is encoded as the king moving to the rook's square
+    piece_id = state["board"][start_row][start_col]
+    target_id = state["board"][end_row][end_col]
+    if piece_id is not None and target_id is not None and str(state["pieces_params"][piece_id]).upper() == "K":
+        target = state["pieces_params"][target_id]
+        if target.side == state["pieces_params"][piece_id].side and str(target).upper() == "R":
+            end_col = start_col + 2 if end_col > start_col else start_col - 2
+
+    move_input = column_letters[start_col] + str(8 - start_row) + column_letters[end_col] + str(8 - end_row)
+    if promotion_piece is not None:
+        move_input += promotion_piece.lower()
+    return game.choose_move_from_coordinates(state=state, move_input=move_input)
+
+
+def build_book(pgn_paths: Iterable[str], book_path: str, max_ply: int = 16, min_weight: int = 1) -> int:
+    """
+    Builds an opening book from games in PGN files
+    Each move played in the first max_ply plies of a game is weighted by its result for the side that played it
+    (2 for a win, 1 for a draw, 0 for a loss). Games with invalid moves are skipped from the first invalid move.
+    Arguments:
+    - pgn_paths: paths of the PGN files
+    - book_path: path of the book file to write
+    - max_ply: number of plies of each game to add to the book
+    - min_weight: moves with a lower total weight are left out of the book
+    Returns: the number of entries in the book
+    """
+    weights = {}
+    for pgn_path in pgn_paths:
+        with open(pgn_path) as file:
+            for pgn_game in pgn.read_games(lines=file):
+                try:
+                    for state, move in pgn.replay_game(san_moves=pgn_game["moves"][:max_ply]):
+                        if pgn_game["result"] is None:
+                            weight = 1
+                        else:
+                            # Result is 0 if white wins and 1 if black wins
+                            weight = round(2 * (1 - abs(pgn_game["result"] - state["turn"])))
+                        entry_key = (zobrist.position_key(state=state), encode_move(move=move))
+                        weights[entry_key] = weights.get(entry_key, 0) + weight
+                except Exception:
+                    continue
+
+    entries = sorted((key, encoded_move, min(weight, MAX_WEIGHT)) for (key, encoded_move), weight in weights.items() if weight >= min_weight)
+    temp_path = book_path + ".tmp"
+    with open(temp_path, "wb") as file:
+        for key, encoded_move, weight in entries:
+            file.write(ENTRY.pack(key, encoded_move, weight, 0))
+    os.replace(temp_path, book_path)
+    return len(entries)
+
+
+class OpeningBook(parallel.FileBacked):
+    def __init__(self, path: str) -> None:
+        """
+        Opening book backed by a memory-mapped book file
+        """
+        self.path = path
+        self.file = open(path, "rb")
+        self.size = os.path.getsize(path) // ENTRY.size
+        # mmap can't map empty files
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else b""
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def get_entries(self, key: int) -> List[Tuple[int, int]]:
+        """
+        Gets the (encoded move, weight) entries for a position key
+        """
+        # Binary search for the first entry with the key
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if ENTRY.unpack_from(self.data, middle * ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        entries = []
+        for index in range(low, self.size):
+            entry_key, encoded_move, weight, _ = ENTRY.unpack_from(self.data, index * ENTRY.size)
+            if entry_key != key:
+                break
+            entries.append((encoded_move, weight))
+        return entries
+
+    def get_moves(self, state: Dict) -> List[Tuple[moves.Move, int]]:
+        """
+        Gets the valid book moves in the position with their weights
+        """
+        book_moves = []
+        for encoded_move, weight in self.get_entries(key=zobrist.position_key(state=state)):
+            move = decode_move(state=state, encoded_move=encoded_move)
+            if move is not None:
+                book_moves.append((move, weight))
+        return book_moves
+
+    def choose_move(self, state: Dict, rng: Optional[random.Random] = None) -> Optional[moves.Move]:
+        """
+        Chooses a book move at random, weighted by the weights of the moves
+        Returns None if the position isn't in the book
+        """
+        book_moves = [(move, weight) for move, weight in self.get_moves(state=state) if weight > 0]
+        if len(book_moves) == 0:
+            return None
+        if rng is None:
+            rng = random
+        return rng.choices([move for move, _ in book_moves], weights=[weight for _, weight in book_moves])[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build an opening book from PGN files")
+    parser.add_argument("book", help="path of the book file to write")
+    parser.add_argument("pgn", nargs="+", help="PGN files")
+    parser.add_argument("--max-ply", type=int, default=16)
+    parser.add_argument("--min-weight", type=int, default=1)
+    args = parser.parse_args()
+
+    entry_count = build_book(pgn_paths=args.pgn, book_path=args.book, max_ply=args.max_ply, min_weight=args.min_weight)
+    print(f"Wrote {entry_count} entries to {args.book}")
@@ -0,0 +1,712 @@
+import pieces, moves, tablebase, zobrist
+from typing import Callable, Dict, List, Optional, Tuple
+import json
+import threading
+import time
+
+# Values of the pieces (in centipawns)
+PIECE_VALUES = {
+    pieces.PAWN: 100,
+    pieces.KNIGHT: 320,
+    pieces.BISHOP: 330,
+    pieces.ROOK: 500,
+    pieces.QUEEN: 900,
+    pieces.KING: 0,
+}
+# Bonuses of the pieces on each square (in centipawns), indexed by relative_square
+# By default pieces other than the king get a small bonus for being close to the centre of the board (up to 12 centipawns)
+PIECE_SQUARE_TABLES = {
+    piece_type: [
+        0 if piece_type == pieces.KING else 14 - abs(2 * (square // 8) - 7) - abs(2 * (square % 8) - 7)
+        for square in range(64)
+    ]
+    for piece_type in PIECE_VALUES
+}
+MATE_SCORE = 100000
+# Scores this close to MATE_SCORE are mates
+MATE_BOUND = MATE_SCORE - 1000
+# Maximum number of positions in a transposition table (it is cleared when full)
+TABLE_SIZE = 1000000
+# Types of transposition table scores
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+DEFAULT_DEPTH = 2
+MAX_DEPTH = 64
+# Moves assumed to be left in the game when playing on a clock without a number of moves to go
+DEFAULT_MOVES_TO_GO = 30
+# Time kept in reserve when playing on a clock (in seconds)
+TIME_MARGIN = 0.05
+# Selective search (see Searcher)
+# Depth reduction of the search after a null move, and the minimum depth it is tried at
+NULL_MOVE_REDUCTION = 2
+NULL_MOVE_MIN_DEPTH = 3
+# Margins of futility pruning by remaining depth (in centipawns)
+FUTILITY_MARGINS = {1: 200, 2: 500}
+# Quiet moves from this index in the move order are searched with reduced depth when the remaining depth is at least LATE_MOVE_MIN_DEPTH
+LATE_MOVE_INDEX = 3
+LATE_MOVE_MIN_DEPTH = 3
+# Half width of the first aspiration window around the previous iteration's score (in centipawns)
+ASPIRATION_WINDOW = 50
+# Directions of the pieces, used to find the attackers of a square (see is_attacked)
+KNIGHT_OFFSETS = [(-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)]
+KING_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+STRAIGHT_DIRECTIONS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+DIAGONAL_DIRECTIONS = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+
+def relative_square(side: int, row: int, col: int) -> int:
+    """
+    Gets the index of a square seen from a side (0 for white, 1 for black): a1 is 0 and h8 is 63 for white,
+    and the board is mirrored for black so that a8 is 0
+    """
+    return (7 - row) * 8 + col if side == 0 else row * 8 + col
+
+def load_evaluation(path: str):
+    """
+    Loads the piece values and piece-square tables used by evaluate from a JSON file (e.g. written by tuner.py)
+    with the keys "piece_values" ({"P": 100, ...}) and "piece_square_tables" ({"P": [64 values], ...})
+    """
+    with open(path) as file:
+        tables = json.load(file)
+    PIECE_VALUES.update(tables.get("piece_values", {}))
+    for piece_type, table in tables.get("piece_square_tables", {}).items():
+        if len(table) != 64:
+            raise Exception(f"Invalid piece-square table for {piece_type}")
+        PIECE_SQUARE_TABLES[piece_type] = list(table)
+
+def evaluate(state: Dict) -> int:
+    """
+    Evaluates the position from the point of view of the side to move (in centipawns)
+    Material is counted, with bonuses for the squares of the pieces (see PIECE_SQUARE_TABLES)
+    """
+    score = 0
+    for piece in state["pieces_params"].values():
+        piece_type = str(piece).upper()
+        piece_score = PIECE_VALUES[piece_type] + PIECE_SQUARE_TABLES[piece_type][relative_square(side=piece.side, row=piece.row, col=piece.col)]
+        if piece.side == state["turn"]:
+            score += piece_score
+        else:
+            score -= piece_score
+    return score
+
+def order_moves(state: Dict, move_list: List[moves.Move], history: Optional[Dict] = None) -> List[moves.Move]:
+    """
+    Orders the moves so that the most promising moves are searched first:
+    promotions and captures of valuable pieces by cheap pieces (MVV-LVA) come first,
+    then quiet moves by their history scores if given (see history_key)
+    """
+    def move_score(move: moves.Move) -> Tuple[int, int]:
+        score = 0
+        if move.piece_taken is not None:
+            victim = str(state["pieces_params"][move.piece_taken]).upper()
+            attacker = str(state["pieces_params"][move.piece_id]).upper()
+            score += 10 * PIECE_VALUES[victim] - PIECE_VALUES[attacker] + 10000
+        if move.promotion_piece is not None:
+            score += PIECE_VALUES[move.promotion_piece] + 10000
+        if history is None:
+            return score, 0
+        return score, history.get(history_key(state=state, move=move), 0)
+
+    return sorted(move_list, key=move_score, reverse=True)
+
+def history_key(state: Dict, move: moves.Move) -> Tuple[int, int, int]:
+    """
+    Gets the key of a move in a history table: side to move, start square and end square
+    """
+    return state["turn"], move.start_row * 8 + move.start_col, move.end_row * 8 + move.end_col
+
+def is_quiet(move: moves.Move) -> bool:
+    """
+    Checks if a move is neither a capture nor a promotion
+    """
+    return move.piece_taken is None and move.promotion_piece is None
+
+def has_pieces(state: Dict, side: int) -> bool:
+    """
+    Checks if a side has pieces other than pawns and the king (without them zugzwang is likely, so null moves aren't tried)
+    """
+    return any(
+        piece.side == side and str(piece).upper() not in [pieces.PAWN, pieces.KING]
+        for piece in state["pieces_params"].values()
+    )
+
+def is_attacked(state: Dict, row: int, col: int, side: int) -> bool:
+    """
+    Checks if a square is attacked by a side, looking outwards from the square for attackers
+    (much cheaper than generating the moves of the side)
+    """
+    board = state["board"]
+    size = len(board)
+    params = state["pieces_params"]
+
+    def attacker(row: int, col: int):
+        if 0 <= row < size and 0 <= col < size and board[row][col] is not None:
+            piece = params[board[row][col]]
+            if piece.side == side:
+                return piece
+        return None
+
+    # White pawns attack towards row 0 and black pawns towards the last row
+    pawn_row = row + 1 if side == 0 else row - 1
+    for pawn_col in [col - 1, col + 1]:
+        if isinstance(attacker(row=pawn_row, col=pawn_col), pieces.Pawn):
+            return True
+    for row_offset, col_offset in KNIGHT_OFFSETS:
+        if isinstance(attacker(row=row + row_offset, col=col + col_offset), pieces.Knight):
+            return True
+    for row_offset, col_offset in KING_OFFSETS:
+        if isinstance(attacker(row=row + row_offset, col=col + col_offset), pieces.King):
+            return True
+    for directions, sliders in [(STRAIGHT_DIRECTIONS, (pieces.Rook, pieces.Queen)), (DIAGONAL_DIRECTIONS, (pieces.Bishop, pieces.Queen))]:
+        for row_step, col_step in directions:
+            ray_row, ray_col = row + row_step, col + col_step
+            while 0 <= ray_row < size and 0 <= ray_col < size:
+                if board[ray_row][ray_col] is not None:
+                    if isinstance(attacker(row=ray_row, col=ray_col), sliders):
+                        return True
+                    break
+                ray_row, ray_col = ray_row + row_step, ray_col + col_step
+    return False
+
+def is_check(state: Dict, side: int) -> bool:
+    """
+    Checks if a side is in check (same as pieces.in_check, but much cheaper, for use within a search)
+    """
+    for piece in state["pieces_params"].values():
+        if piece.side == side and isinstance(piece, pieces.King):
+            return is_attacked(state=state, row=piece.row, col=piece.col, side=(side + 1) % 2)
+    return False
+
+def prepare_search_state(state: Dict) -> Dict:
+    """
+    Creates a copy of the state which is cheap to copy during a search.
+    Only the last move is needed to generate moves (for en passant), and positions and taken pieces aren't needed at all.
+    """
+    return {
+        "board": [list(row) for row in state["board"]],
+        "pieces_params": state["pieces_params"],
+        "pieces_taken_params": {},
+        "next_id": state["next_id"],
+        "result": state["result"],
+        "moves": state["moves"][-1:],
+        "positions": [],
+        "turn": state["turn"],
+    }
+
+
+def tablebase_score(value: int, ply: int) -> int:
+    """
+    Converts a tablebase value (see tablebase.py) to a score for the side to move
+    """
+    if value == tablebase.DRAW:
+        return 0
+    if tablebase.is_win(value=value):
+        return MATE_SCORE - ply - tablebase.value_to_plies(value=value)
+    return -MATE_SCORE + ply + tablebase.value_to_plies(value=value)
+
+
+def score_to_mate(score: int) -> Optional[int]:
+    """
+    Converts a mate score to the number of moves to mate (negative if the side to move is mated), None if it isn't a mate
+    """
+    if score > MATE_BOUND:
+        return (MATE_SCORE - score + 1) // 2
+    if score < -MATE_BOUND:
+        return -((MATE_SCORE + score + 1) // 2)
+    return None
+
+
+def allocate_time(time_left: float, increment: float = 0, moves_to_go: Optional[int] = None) -> float:
+    """
+    Gets the time to spend on a move (in seconds) when playing on a clock
+    Arguments:
+    - time_left: time left on the clock (in seconds)
+    - increment: time added to the clock after each move (in seconds)
+    - moves_to_go: number of moves until the next time control (DEFAULT_MOVES_TO_GO if None)
+    """
+    if moves_to_go is None:
+        moves_to_go = DEFAULT_MOVES_TO_GO
+    time_limit = time_left / moves_to_go + 0.75 * increment
+    return max(min(time_limit, time_left - TIME_MARGIN), 0.01)
+
+
+class SearchStopped(Exception):
+    """
+    Raised within a search when it has to stop (e.g. it has searched the maximum number of nodes)
+    """
+    pass
+
+
+def score_to_table(score: int, ply: int) -> int:
+    """
+    Converts a score to be stored in the transposition table: mate scores are stored relative to the position
+    rather than the root of the search
+    """
+    if score > MATE_BOUND:
+        return score + ply
+    if score < -MATE_BOUND:
+        return score - ply
+    return score
+
+def score_from_table(score: int, ply: int) -> int:
+    """
+    Converts a score stored in the transposition table back to a score relative to the root of the search
+    """
+    if score > MATE_BOUND:
+        return score - ply
+    if score < -MATE_BOUND:
+        return score + ply
+    return score
+
+
+class Searcher:
+    def __init__(
+        self,
+        depth: int = DEFAULT_DEPTH,
+        tablebases: Optional[tablebase.Tablebases] = None,
+        max_nodes: Optional[int] = None,
+        table: Optional[Dict] = None,
+        stop_event: Optional[threading.Event] = None,
+        max_time: Optional[float] = None,
+        callback: Optional[Callable[[int, int, moves.Move, int], None]] = None,
+        network = None,
+        null_move: bool = True,
+        late_move_reductions: bool = True,
+        futility_pruning: bool = True,
+        aspiration_windows: bool = True,
+        history_heuristic: bool = True,
+        multi_pv: int = 1,
+    ) -> None:
+        """
+        Searches for the best move using iterative deepening and negamax with alpha-beta pruning
+        The selective search techniques can be switched off individually (e.g. to measure their node savings),
+        and with all of them off the search is a plain alpha-beta search
+        Arguments:
+        - depth: number of plies to search
+        - tablebases: endgame tablebases used to score positions with few pieces exactly
+        - max_nodes: the search stops after this many nodes, returning the result of the last complete iteration
+        - table: transposition table, which can be shared between searches (e.g. with pondering)
+        - stop_event: the search stops when this event is set (e.g. from another thread)
+        - max_time: the search stops after this many seconds, returning the result of the last complete iteration
+        - callback: called after each complete iteration with the depth, score, best move and number of nodes
+        - network: neural network (nnue.Network) used to evaluate positions instead of evaluate
+        - null_move: the side to move passes, and if a reduced search still fails high the position is pruned
+          (not when in check or with only pawns, see has_pieces)
+        - late_move_reductions: late quiet moves in the move order are searched with reduced depth (less reduced
+          if they have a history score), and searched again at full depth if they raise alpha
+        - futility_pruning: near the leaves, quiet moves which don't give check are pruned when the evaluation plus
+          a margin (FUTILITY_MARGINS) can't raise alpha
+        - aspiration_windows: each iteration searches a window around the previous iteration's score, widened on failure
+        - history_heuristic: quiet moves causing cutoffs are scored by depth squared to order quiet moves
+        - multi_pv: number of best root moves searched (see lines). After the best move, the root is searched again
+          without the moves already found for each further line, sharing the transposition table and move ordering
+        """
+        self.depth = depth
+        self.tablebases = tablebases
+        self.max_nodes = max_nodes
+        self.table = table if table is not None else {}
+        self.stop_event = stop_event
+        self.max_time = max_time
+        self.callback = callback
+        self.network = network
+        self.null_move = null_move
+        self.late_move_reductions = late_move_reductions
+        self.futility_pruning = futility_pruning
+        self.aspiration_windows = aspiration_windows
+        self.history_heuristic = history_heuristic
+        self.history = {}
+        self.multi_pv = multi_pv
+        # Best root moves of the last complete iteration (up to multi_pv): Dicts with the move, score and principal variation
+        self.lines = []
+        self.excluded_moves = []
+        self.deadline = None
+        self.nodes = 0
+        self.completed_depth = 0
+        self.root_best_move = None
+
+    def get_settings(self) -> Dict:
+        """
+        Gets the settings which affect the result of the search (e.g. as the key of an analysis cache):
+        the limits, whether tablebases are used, the network and the options which aren't at their defaults
+        """
+        settings = {
+            "depth": self.depth,
+            "nodes": self.max_nodes,
+            "time": self.max_time,
+            "tablebases": True if self.tablebases is not None else None,
+            "network": self.network.path if self.network is not None else None,
+        }
+        for name in ["null_move", "late_move_reductions", "futility_pruning", "aspiration_windows", "history_heuristic"]:
+            if not getattr(self, name):
+                settings[name] = False
+        if self.multi_pv != 1:
+            settings["multipv"] = self.multi_pv
+        return settings
+
+    def search(self, state: Dict) -> Tuple[Optional[moves.Move], int]:
+        """
+        Searches the position for the side to move, one ply deeper at a time
+        Returns the best move (None if there are no legal moves) and its score
+        """
+        self.nodes = 0
+        self.completed_depth = 0
+        self.root_best_move = None
+        self.history = {}
+        self.lines = []
+        self.deadline = time.perf_counter() + self.max_time if self.max_time is not None else None
+        root = prepare_search_state(state=state)
+        if self.network is not None:
+            # The accumulator is updated as moves are made during the search
+            root["accumulator"] = self.network.new_accumulator(state=root)
+
+        line_count = min(self.multi_pv, len(moves.get_all_possible_moves(state=root, side=root["turn"])))
+        best_move, best_score = None, 0
+        for depth in range(1, self.depth + 1):
+            lines = []
+            try:
+                move, score = self.search_line(state=root, depth=depth, index=0, previous_score=best_score, lines=lines)
+                for index in range(1, line_count):
+                    previous_score = self.lines[index]["score"] if index < len(self.lines) else score
+                    self.search_line(state=root, depth=depth, index=index, previous_score=previous_score, lines=lines)
+            except SearchStopped:
+                break
+            finally:
+                self.excluded_moves = []
+            # Later lines can score higher than earlier ones when the search is unstable
+            lines.sort(key=lambda line: line["score"], reverse=True)
+            for line in lines:
+                line["pv"] = self.get_pv(state=root, move=line["move"], depth=depth)
+            self.lines = lines
+            if len(lines) > 0:
+                move, score = lines[0]["move"], lines[0]["score"]
+            best_move, best_score = move, score
+            self.completed_depth = depth
+            self.root_best_move = move
+            if self.callback is not None:
+                self.callback(depth, score, move, self.nodes)
+            if move is None:
+                # No legal moves
+                break
+
+        if best_move is None and self.nodes > 0:
+            # Stopped before the first iteration finished, so play the first move in order
+            move_list = moves.get_all_possible_moves(state=root, side=root["turn"])
+            if len(move_list) > 0:
+                best_move = order_moves(state=root, move_list=move_list)[0]
+        return best_move, best_score
+
+    def search_line(self, state: Dict, depth: int, index: int, previous_score: int, lines: List[Dict]) -> Tuple[Optional[moves.Move], int]:
+        """
+        Searches the root for the line with the given index in the multi-PV order, excluding the moves of the lines
+        already found in this iteration, and adds it to lines
+        The move of the line with the same index in the previous iteration is searched first
+        """
+        self.excluded_moves = [line["move"] for line in lines]
+        self.root_best_move = self.lines[index]["move"] if index < len(self.lines) else None
+        move, score = self.search_root(state=state, depth=depth, previous_score=previous_score)
+        if move is not None:
+            lines.append({"move": move, "score": score})
+        return move, score
+
+    def get_pv(self, state: Dict, move: moves.Move, depth: int) -> List[moves.Move]:
+        """
+        Gets the principal variation starting with a move, following the best moves of the transposition table
+        (up to depth moves, checking each move is legal)
+        """
+        pv = [move]
+        child = make_search_move(state=state, move=move)
+        keys = set()
+        while len(pv) < depth:
+            key = zobrist.position_key(state=child)
+            entry = self.table.get(key)
+            if entry is None or entry[3] is None or key in keys:
+                break
+            keys.add(key)
+            legal_moves = [legal_move for legal_move in moves.get_all_possible_moves(state=child, side=child["turn"]) if same_move(legal_move, entry[3])]
+            if len(legal_moves) == 0:
+                break
+            pv.append(legal_moves[0])
+            child = make_search_move(state=child, move=legal_moves[0])
+        return pv
+
+    def search_root(self, state: Dict, depth: int, previous_score: int) -> Tuple[Optional[moves.Move], int]:
+        """
+        Searches the root position to the given depth, within an aspiration window around the previous iteration's score
+        if enabled (the window is widened on the side the search fails until the score is inside it)
+        """
+        alpha, beta = -MATE_SCORE - 1, MATE_SCORE + 1
+        window = ASPIRATION_WINDOW
+        if self.aspiration_windows and depth > 1 and abs(previous_score) < MATE_BOUND:
+            alpha, beta = previous_score - window, previous_score + window
+        while True:
+            move, score = self.negamax(state=state, depth=depth, alpha=alpha, beta=beta, ply=0)
+            window *= 2
+            if score <= alpha and alpha > -MATE_SCORE - 1:
+                alpha = max(score - window, -MATE_SCORE - 1)
+            elif score >= beta and beta < MATE_SCORE + 1:
+                beta = min(score + window, MATE_SCORE + 1)
+            else:
+                return move, score
+
+    def static_evaluation(self, state: Dict) -> int:
+        """
+        Evaluates the position without searching, with the network if there is one
+        """
+        if self.network is not None:
+            return self.network.evaluate(state=state)
+        return evaluate(state=state)
+
+    def negamax(self, state: Dict, depth: int, alpha: int, beta: int, ply: int, allow_null: bool = True, in_check: Optional[bool] = None) -> Tuple[Optional[moves.Move], int]:
+        """
+        Searches the position to the given depth
+        allow_null is False after a null move, so that two aren't made in a row
+        in_check is whether the side to move is in check, if the parent already knows it (None otherwise)
+        Returns the best move and its score from the point of view of the side to move
+        """
+        self.nodes += 1
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            raise SearchStopped()
+        if self.stop_event is not None and self.stop_event.is_set():
+            raise SearchStopped()
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise SearchStopped()
+
+        # Positions in the tablebases are known exactly (the root is searched to find the best move)
+        if self.tablebases is not None and ply > 0:
+            value = self.tablebases.probe(state=state)
+            if value is not None:
+                return None, tablebase_score(value=value, ply=ply)
+
+        if depth == 0:
+            return None, self.static_evaluation(state=state)
+
+        # Look up the position in the transposition table
+        key = zobrist.position_key(state=state)
+        entry = self.table.get(key)
+        table_move = None
+        if entry is not None:
+            entry_depth, entry_score, entry_type, table_move = entry
+            entry_score = score_from_table(score=entry_score, ply=ply)
+            if entry_depth >= depth and ply > 0:
+                if entry_type == EXACT:
+                    return table_move, entry_score
+                if entry_type == LOWER_BOUND and entry_score >= beta:
+                    return table_move, entry_score
+                if entry_type == UPPER_BOUND and entry_score <= alpha:
+                    return table_move, entry_score
+
+        # Whether the side to move is in check is computed once per node (and passed on by the parent when it knows it)
+        if in_check is None:
+            in_check = is_check(state=state, side=state["turn"])
+
+        if self.null_move and allow_null and ply > 0 and depth >= NULL_MOVE_MIN_DEPTH and not in_check and abs(beta) < MATE_BOUND and has_pieces(state=state, side=state["turn"]):
+            # If the opponent can't reach beta even if the side to move passes, the position is very likely to fail high
+            child = make_null_move(state=state)
+            _, score = self.negamax(state=child, depth=depth - 1 - NULL_MOVE_REDUCTION, alpha=-beta, beta=-beta + 1, ply=ply + 1, allow_null=False, in_check=False)
+            if -score >= beta:
+                return None, beta
+
+        move_list = moves.get_all_possible_moves(state=state, side=state["turn"])
+        if len(move_list) == 0:
+            if in_check:
+                # Checkmate (prefer the quickest mate)
+                return None, -MATE_SCORE + ply
+            # Stalemate
+            return None, 0
+        if ply == 0 and len(self.excluded_moves) > 0:
+            # Moves of the lines already found (multi-PV)
+            move_list = [move for move in move_list if not any(same_move(move, excluded_move) for excluded_move in self.excluded_moves)]
+
+        # Quiet moves are pruned if even the evaluation plus a margin can't raise alpha
+        futility_score = None
+        if self.futility_pruning and depth in FUTILITY_MARGINS and ply > 0 and not in_check and abs(alpha) < MATE_BOUND:
+            score = self.static_evaluation(state=state) + FUTILITY_MARGINS[depth]
+            if score <= alpha:
+                futility_score = score
+
+        move_list = order_moves(state=state, move_list=move_list, history=self.history if self.history_heuristic else None)
+        if ply == 0 and self.root_best_move is not None:
+            # Search the best move of the previous iteration first
+            table_move = self.root_best_move
+        if table_move is not None:
+            # Search the best move found before first
+            move_list.sort(key=lambda move: not same_move(move, table_move))
+
+        original_alpha = alpha
+        best_move = None
+        best_score = -MATE_SCORE - 1
+        for index, move in enumerate(move_list):
+            child = make_search_move(state=state, move=move)
+            quiet = is_quiet(move=move)
+            gives_check = None
+            if futility_score is not None and best_move is not None and quiet:
+                gives_check = is_check(state=child, side=child["turn"])
+                if not gives_check:
+                    best_score = max(best_score, futility_score)
+                    continue
+
+            reduction = 0
+            if self.late_move_reductions and index >= LATE_MOVE_INDEX and depth >= LATE_MOVE_MIN_DEPTH and not in_check and quiet:
+                reduction = 1 if index < 2 * LATE_MOVE_INDEX else 2
+                if self.history.get(history_key(state=state, move=move), 0) > 0:
+                    # Moves which caused cutoffs elsewhere are reduced less
+                    reduction -= 1
+                reduction = min(reduction, depth - 2)
+            if reduction > 0:
+                # A reduced search with a null window checks if the move can raise alpha
+                _, score = self.negamax(state=child, depth=depth - 1 - reduction, alpha=-alpha - 1, beta=-alpha, ply=ply + 1, in_check=gives_check)
+                score = -score
+                if score > alpha:
+                    _, score = self.negamax(state=child, depth=depth - 1, alpha=-beta, beta=-alpha, ply=ply + 1, in_check=gives_check)
+                    score = -score
+            else:
+                _, score = self.negamax(state=child, depth=depth - 1, alpha=-beta, beta=-alpha, ply=ply + 1, in_check=gives_check)
+                score = -score
+
+            if score > best_score:
+                best_score = score
+                best_move = move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                # Opponent won't allow this position
+                if self.history_heuristic and quiet:
+                    key = history_key(state=state, move=move)
+                    self.history[key] = self.history.get(key, 0) + depth * depth
+                break
+
+        # Store the result in the transposition table
+        if best_score <= original_alpha:
+            entry_type = UPPER_BOUND
+        elif best_score >= beta:
+            entry_type = LOWER_BOUND
+        else:
+            entry_type = EXACT
+        if ply == 0 and len(self.excluded_moves) > 0:
+            # The score of a search without some moves isn't the score of the position
+            return best_move, best_score
+        if len(self.table) >= TABLE_SIZE:
+            self.table.clear()
+        self.table[key] = (depth, score_to_table(score=best_score, ply=ply), entry_type, best_move)
+
+        return best_move, best_score
+
+
+def same_move(move: moves.Move, other_move: moves.Move) -> bool:
+    """
+    Checks if two Move objects represent the same move
+    """
+    return (
+        move.start_row == other_move.start_row
+        and move.start_col == other_move.start_col
+        and move.end_row == other_move.end_row
+        and move.end_col == other_move.end_col
+        and move.promotion_piece == other_move.promotion_piece
+    )
+
+def make_search_move(state: Dict, move: moves.Move) -> Dict:
+    """
+    Makes a move within a search and changes turn
+    """
+    child = pieces.make_move(state=state, move=move)
+    if state.get("accumulator") is not None:
+        # Only the moves of the search update the accumulator, not the copies made to check if moves are legal
+        child["accumulator"] = state["accumulator"].after_move(state=state, move=move)
+    child["moves"] = child["moves"][-1:]
+    child["turn"] = (child["turn"] + 1) % 2
+    return child
+
+def make_null_move(state: Dict) -> Dict:
+    """
+    Passes the turn within a search (for null-move pruning): the pieces don't move and en passant is no longer possible
+    The child shares the board with the state, which is safe as making a move copies the state
+    """
+    child = dict(state)
+    child["moves"] = []
+    child["turn"] = (state["turn"] + 1) % 2
+    return child
+
+def choose_engine_move(state: Dict, depth: int = DEFAULT_DEPTH, book = None, tablebases: Optional[tablebase.Tablebases] = None, table: Optional[Dict] = None, network = None, cache = None) -> Optional[moves.Move]:
+    """
+    Chooses the engine's move for the side to move
+    If an opening book (book.OpeningBook) is given, it is consulted before searching
+    If endgame tablebases are given, they are used to score positions with few pieces during the search
+    If a transposition table is given (e.g. one filled by a Ponderer), the search uses it
+    If a neural network (nnue.Network) is given, it evaluates the positions of the search
+    If an analysis cache (analysiscache.AnalysisCache) is given, it is checked before searching and the result is stored in it
+    """
+    if book is not None:
+        move = book.choose_move(state=state)
+        if move is not None:
+            return move
+
+    searcher = Searcher(depth=depth, tablebases=tablebases, table=table, network=network)
+    # The settings of the search change its results, so they are part of the cache key
+    if cache is not None:
+        analysis = cache.get_move(state=state, limits=searcher.get_settings())
+        if analysis is not None:
+            return analysis["best_move"]
+
+    move, score = searcher.search(state=state)
+    if cache is not None:
+        cache.put_search(state=state, limits=searcher.get_settings(), searcher=searcher, move=move, score=score)
+    return move
+
+
+class Ponderer:
+    def __init__(self, state: Dict, depth: int = DEFAULT_DEPTH, table: Optional[Dict] = None, tablebases: Optional[tablebase.Tablebases] = None) -> None:
+        """
+        Searches in a background thread while the opponent is thinking about their move.
+        The opponent's most likely move is predicted and the engine's reply to it is searched (used on a ponder hit),
+        then the opponent's position is searched deeper and deeper to fill the shared transposition table
+        (used for the engine's search if the opponent plays a different move).
+        Arguments:
+        - state: game state with the opponent to move
+        - depth: search depth of the engine
+        - table: transposition table shared with the engine's searches
+        - tablebases: endgame tablebases used by the search
+        """
+        self.state = state
+        self.depth = depth
+        self.table = table if table is not None else {}
+        self.tablebases = tablebases
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.predicted_move = None
+        self.reply = None
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        """
+        Ponders until stopped (runs in the background thread)
+        """
+        # Predict the opponent's move
+        searcher = Searcher(depth=self.depth, tablebases=self.tablebases, table=self.table, stop_event=self.stop_event)
+        predicted_move, _ = searcher.search(state=self.state)
+        if predicted_move is None or self.stop_event.is_set():
+            return
+        self.predicted_move = predicted_move
+
+        # Search the reply to the predicted move
+        predicted_state = make_search_move(state=prepare_search_state(state=self.state), move=predicted_move)
+        searcher = Searcher(depth=self.depth, tablebases=self.tablebases, table=self.table, stop_event=self.stop_event)
+        reply, _ = searcher.search(state=predicted_state)
+        if searcher.completed_depth == self.depth:
+            self.reply = reply
+
+        # Keep searching all the opponent's moves to fill the transposition table
+        Searcher(depth=MAX_DEPTH, tablebases=self.tablebases, table=self.table, stop_event=self.stop_event).search(state=self.state)
+
+    def stop(self, move: moves.Move) -> Optional[moves.Move]:
+        """
+        Stops pondering once the opponent has played the given move
+        Returns the engine's reply if the move was predicted and the reply was fully searched (a ponder hit), otherwise None
+        """
+        self.stop_event.set()
+        self.thread.join()
+        if self.reply is not None and same_move(move, self.predicted_move):
+            return self.reply
+        return None
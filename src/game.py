@@ -1,6 +1,9 @@
-import pieces, moves
-from typing import Dict, Tuple
+import pieces, moves, engine, tablebase, zobrist
+from typing import Dict, Optional, Tuple
 from copy import deepcopy
+import re
+
+COORDINATE_MOVE_PATTERN = r"[a-h][1-8][a-h][1-8][qrbnQRBN]?"
 
 def create_game_state(rows: int = 8, cols: int = 8):
     """
@@ -119,11 +122,15 @@ def display_pieces(state: Dict):
 def choose_move(state: Dict, move_input: str) -> moves.Move:
     """
     Based on the move input, selects the move from the possible moves
-    move_input should be in the form of standard notation (e.g. Ra4)
+    move_input should be in the form of standard notation (e.g. Ra4) or coordinate notation (e.g. e2e4, e7e8q)
     NOTE: pawn moves are represented with a "P" at the start (e.g. Pd4)
     NOTE: taking moves do not have an "x" in them
     """
 
+    # Check for coordinate notation (e.g. g1f3)
+    if re.fullmatch(COORDINATE_MOVE_PATTERN, move_input):
+        return choose_move_from_coordinates(state=state, move_input=move_input)
+
     # Check for kingside castling
     if move_input == "0-0" or move_input.upper() == "O-O":
         if state["turn"] == 0:
@@ -196,6 +203,42 @@ def choose_move(state: Dict, move_input: str) -> moves.Move:
         return None
 
 
+def choose_move_from_coordinates(state: Dict, move_input: str) -> Optional[moves.Move]:
+    """
+    Selects the move from the possible moves based on a move in coordinate notation (e.g. e2e4, e7e8q)
+    Returns None if the move is not valid
+    """
+    column_letters = "abcdefgh" # Assumes that there are 8 columns
+    row_numbers = "87654321" # Assumes that there are 8 rows
+
+    start_col = column_letters.index(move_input[0])
+    start_row = row_numbers.index(move_input[1])
+    end_col = column_letters.index(move_input[2])
+    end_row = row_numbers.index(move_input[3])
+    promotion_piece = move_input[4].upper() if len(move_input) == 5 else None
+
+    piece_id = state["board"][start_row][start_col]
+    if piece_id is None or state["pieces_params"][piece_id].side != state["turn"]:
+        return None
+
+    for move in state["pieces_params"][piece_id].get_possible_moves(state=state):
+        if move.end_row == end_row and move.end_col == end_col and move.promotion_piece == promotion_piece:
+            return move
+    return None
+
+def move_to_coordinates(move: moves.Move) -> str:
+    """
+    Converts a move to coordinate notation (e.g. e2e4, e7e8q)
+    """
+    column_letters = "abcdefgh" # Assumes that there are 8 columns
+    row_numbers = "87654321" # Assumes that there are 8 rows
+
+    move_str = column_letters[move.start_col] + row_numbers[move.start_row] + column_letters[move.end_col] + row_numbers[move.end_row]
+    if move.promotion_piece is not None:
+        move_str += move.promotion_piece.lower()
+    return move_str
+
+
 def board_to_fen(state: Dict) -> str:
     """
     Converts board layout to FEN notation (see https://en.wikipedia.org/wiki/Forsyth%E2%80%93Edwards_Notation)
@@ -217,6 +260,87 @@ def board_to_fen(state: Dict) -> str:
     fen = fen[:-1]
     return fen
 
+def state_to_fen(state: Dict) -> str:
+    """
+    Converts a game state to FEN with the side to move, castling rights and en passant square (without clocks)
+    """
+    rights = zobrist.castling_rights(state=state)
+    castling = "".join(right for bit, right in enumerate("KQkq") if rights >> bit & 1)
+    en_passant = "-"
+    en_passant_col = zobrist.en_passant_file(state=state)
+    if en_passant_col >= 0:
+        en_passant = "abcdefgh"[en_passant_col] + ("6" if state["turn"] == 0 else "3")
+    return f"{board_to_fen(state=state)} {'w' if state['turn'] == 0 else 'b'} {castling or '-'} {en_passant}"
+
+def fen_to_state(fen: str) -> Dict:
+    """
+    Creates a game state from a position in FEN notation (see board_to_fen).
+    The side to move, castling rights and en passant square are optional; clocks are ignored.
+    NOTE: a king can castle on either side as long as the rook is on its home square, so a king keeps
+    its castling rights if the FEN gives it any
+    Raises an Exception if the FEN is invalid (including positions without exactly one king for each side,
+    and en passant squares on the wrong rank for the side to move)
+    """
+    fields = fen.split()
+    if len(fields) == 0:
+        raise Exception("Empty FEN")
+    ranks = fields[0].split("/")
+    if len(ranks) != 8:
+        raise Exception(f"Invalid FEN: {fen}")
+
+    state = create_game_state()
+    for row, rank in enumerate(ranks):
+        col = 0
+        for char in rank:
+            if char.isdigit():
+                col += int(char)
+            elif char.upper() in [pieces.PAWN, pieces.KNIGHT, pieces.BISHOP, pieces.ROOK, pieces.QUEEN, pieces.KING] and col < 8:
+                state = add_piece(state=state, piece=char.upper(), row=row, col=col, side=0 if char.isupper() else 1)
+                col += 1
+            else:
+                raise Exception(f"Invalid FEN: {fen}")
+        if col != 8:
+            raise Exception(f"Invalid FEN: {fen}")
+    kings = [piece.side for piece in state["pieces_params"].values() if str(piece).upper() == pieces.KING]
+    if sorted(kings) != [0, 1]:
+        raise Exception(f"Invalid FEN (each side needs exactly one king): {fen}")
+
+    # Side to move
+    turn = fields[1] if len(fields) > 1 else "w"
+    if turn not in ["w", "b"]:
+        raise Exception(f"Invalid FEN: {fen}")
+    state["turn"] = 0 if turn == "w" else 1
+
+    # Castling rights
+    castling = fields[2] if len(fields) > 2 else "-"
+    for piece in state["pieces_params"].values():
+        if str(piece).upper() == pieces.KING:
+            rights = "KQ" if piece.side == 0 else "kq"
+            start_row = 7 if piece.side == 0 else 0
+            if piece.row != start_row or piece.col != 4 or not any(right in castling for right in rights):
+                piece.has_moved = True
+
+    # En passant square (behind a pawn of the side which just moved): recreate the pawn's move forward 2 squares
+    en_passant = fields[3] if len(fields) > 3 else "-"
+    if en_passant != "-" and not re.fullmatch(r"[a-h]6" if state["turn"] == 0 else r"[a-h]3", en_passant):
+        raise Exception(f"Invalid FEN (en passant square): {fen}")
+    if en_passant != "-":
+        col = "abcdefgh".index(en_passant[0])
+        passed_row = "87654321".index(en_passant[1])
+        direction = 1 if state["turn"] == 0 else -1
+        pawn_id = state["board"][passed_row + direction][col]
+        if pawn_id is not None and str(state["pieces_params"][pawn_id]).upper() == pieces.PAWN:
+            state["moves"].append(moves.Move(
+                piece_id=pawn_id,
+                start_row=passed_row - direction,
+                start_col=col,
+                end_row=passed_row + direction,
+                end_col=col,
+            ))
+
+    state["positions"].append(board_to_fen(state=state))
+    return state
+
 def draw_by_insufficient_material(state: Dict) -> bool:
     """
     Checks if a draw by insufficient material has occurred
@@ -226,12 +350,10 @@ def draw_by_insufficient_material(state: Dict) -> bool:
     
     if len(pieces) == 2:
         # Just 2 kings
-        log_message("Draw by insufficient material")
         return True
     elif len(pieces) == 3:
         if "B" in pieces or "N" in pieces:
             # 2 kings and one bishop/knight
-            log_message("Draw by insufficient material")
             return True
     return False
 
@@ -246,7 +368,6 @@ def draw_by_repetition(state: Dict) -> bool:
         else:
             position_dict[position] += 1
             if position_dict[position] >= 3:
-                log_message("Draw by repetition")
                 return True
                 
     return False
@@ -267,12 +388,92 @@ def fifty_move_draw(state: Dict) -> bool:
                     if str(parameters[move.piece_id]).upper() == "P":
                         # Pawn was moved, so no draw
                         return False
-        log_message("Draw by 50 move rule")
         return True
     else:
         return False
 
 
+def get_termination(state: Dict, tablebases = None) -> Tuple[Optional[float], Optional[str]]:
+    """
+    Checks whether the game has finished, from the point of view of the side to move
+    If endgame tablebases (tablebase.Tablebases) are given, positions in them are adjudicated with their exact result
+    Returns the game result (None if the game is still going, 0 if white wins, 1 if black wins, 0.5 if draw)
+    and the reason the game finished, e.g. "Checkmate" or "Draw by repetition" (None if the game is still going)
+    """
+    result = None
+    termination = None
+
+    # Check for draws
+    if draw_by_insufficient_material(state=state):
+        result, termination = 0.5, "Draw by insufficient material"
+    elif draw_by_repetition(state=state):
+        result, termination = 0.5, "Draw by repetition"
+    elif fifty_move_draw(state=state):
+        result, termination = 0.5, "Draw by 50 move rule"
+
+    # Check for checkmate or stalemate
+    if len(moves.get_all_possible_moves(state=state, side=state["turn"])) == 0:
+        if pieces.in_check(state=state, side=state["turn"]):
+            # Checkmate
+            if state["turn"] == 0:
+                result = 1
+            else:
+                result = 0
+            termination = "Checkmate"
+        else:
+            # Stalemate
+            result, termination = 0.5, "Draw by stalemate"
+
+    # Adjudicate with the tablebases
+    if result is None and tablebases is not None:
+        value = tablebases.probe(state=state)
+        if value is not None:
+            termination = "Adjudicated by tablebase"
+            if value == tablebase.DRAW:
+                result = 0.5
+            elif tablebase.is_win(value=value):
+                # The side to move wins
+                result = state["turn"]
+            else:
+                result = (state["turn"] + 1) % 2
+
+    return result, termination
+
+def get_result(state: Dict, tablebases = None, log: bool = True) -> Optional[float]:
+    """
+    Checks whether the game has finished like get_termination, logging the reason it finished if log is True
+    Returns the game result: None if the game is still going, 0 if white wins, 1 if black wins, 0.5 if draw
+    """
+    result, termination = get_termination(state=state, tablebases=tablebases)
+    if termination is not None and log:
+        log_message(termination)
+    return result
+
+def make_turn(state: Dict, move: moves.Move, tablebases = None, log: bool = True) -> Dict:
+    """
+    Plays a move in the game: makes the move, records the position, changes turn and checks for the result
+    Arguments:
+    - state: game state
+    - move: Move object
+    - tablebases: endgame tablebases (tablebase.Tablebases) used to adjudicate the result
+    - log: whether to log the reason the game finished (e.g. "Draw by repetition")
+    Returns: updated game state
+    """
+    # Make move
+    state_copy = pieces.make_move(state=state, move=move)
+
+    # Record position (used for draw by repetition)
+    state_copy["positions"].append(board_to_fen(state=state_copy))
+
+    # Change turn
+    state_copy["turn"] = (state_copy["turn"] + 1) % 2
+
+    # Check for draws, checkmate or stalemate
+    state_copy["result"] = get_result(state=state_copy, tablebases=tablebases, log=log)
+
+    return state_copy
+
+
 def get_user_input(query: str):
     """
     Get the user input. This function is created to make I/O easier to control.
@@ -285,12 +486,22 @@ def log_message(message: str = ""):
     """
     print(message)
 
-def play(state: Dict) -> Tuple[Dict, float]:
+def play(state: Dict, engine_side: Optional[int] = None, depth: int = engine.DEFAULT_DEPTH, book = None, tablebases = None, ponder: bool = False) -> Tuple[Dict, float]:
     """
     Play the game in the terminal
+    Arguments:
+    - state: game state
+    - engine_side: side played by the engine (0 for white, 1 for black, None for two players)
+    - depth: search depth of the engine
+    - book: opening book (book.OpeningBook) consulted by the engine before searching
+    - tablebases: endgame tablebases (tablebase.Tablebases) used by the engine and to adjudicate the result
+    - ponder: whether the engine keeps searching in the background while waiting for the player's move
     Returns the state as well as the game result: 0 if white wins, 1 if black wins, 0.5 if draw
     """
     state_copy = deepcopy(state)
+    # Transposition table shared by the engine's searches and pondering
+    table = {}
+    ponder_move = None
 
     while state_copy["result"] is None:
         # Display current state
@@ -299,7 +510,18 @@ def play(state: Dict) -> Tuple[Dict, float]:
         # Get move
         move_input = ""
         move = None
-        while move_input == "" or move is None:
+        ponderer = None
+        if state_copy["turn"] == engine_side:
+            if ponder_move is not None:
+                # The engine's reply was found while pondering
+                move = ponder_move
+            else:
+                move = engine.choose_engine_move(state=state_copy, depth=depth, book=book, tablebases=tablebases, table=table)
+            log_message(f"Engine plays {move_to_coordinates(move=move)}")
+        elif engine_side is not None and ponder:
+            ponderer = engine.Ponderer(state=state_copy, depth=depth, table=table, tablebases=tablebases)
+            ponderer.start()
+        while move is None:
             # Ask user for move
             if state_copy["turn"] == 0:
                 move_input = get_user_input("White to move: ")
@@ -313,31 +535,11 @@ def play(state: Dict) -> Tuple[Dict, float]:
                 except:
                     log_message("Invalid move")
 
-        # Make move
-        state_copy = pieces.make_move(state=state_copy, move=move)
-
-        # Record position (used for draw by repetition)
-        state_copy["positions"].append(board_to_fen(state=state_copy))
+        # Stop pondering, keeping the engine's reply on a ponder hit
+        ponder_move = ponderer.stop(move=move) if ponderer is not None else None
 
-        # Change turn
-        state_copy["turn"] = (state_copy["turn"] + 1) % 2
-
-        # Check for draws
-        if draw_by_insufficient_material(state=state_copy) or draw_by_repetition(state=state_copy) or fifty_move_draw(state=state_copy):
-            state_copy["result"] = 0.5
-        
-        # Check for checkmate or stalemate
-        if len(moves.get_all_possible_moves(state=state_copy, side=state_copy["turn"])) == 0:
-            if pieces.in_check(state=state_copy, side=state_copy["turn"]):
-                # Checkmate
-                if state_copy["turn"] == 0:
-                    state_copy["result"] = 1
-                else:
-                    state_copy["result"] = 0
-            else:
-                # Stalemate
-                log_message("Draw by stalemate")
-                state_copy["result"] = 0.5
+        # Make move and check for the result
+        state_copy = make_turn(state=state_copy, move=move, tablebases=tablebases)
 
     return state_copy
 
@@ -0,0 +1,223 @@
+"""
+Mate solver: proves or disproves forced mate in N moves with depth-first proof-number search (df-pn)
+(see https://www.chessprogramming.org/Proof-Number_Search and https://www.chessprogramming.org/DFPN)
+
+Proof and disproof numbers are stored from the point of view of the side to move (phi, delta):
+phi is the number of leaves to prove that the side to move wins (for the attacker: mates, for the defender: escapes)
+and delta the number of leaves to prove that it loses. Checking moves of the attacker start with a lower proof number
+than quiet moves, so they are searched first, and once in check the defender's moves (see moves.get_all_possible_moves)
+are only the evasions. The table of proof numbers has a maximum size: when it is full the least recently stored
+entry is replaced, so the entries of the positions being searched are kept. Replaced entries can make the search go
+over the same positions again, so the number of nodes is always limited.
+The mating line is then found with the shortest mate for the attacker and the longest resistance for the defender.
+"""
+import engine, game, moves, zobrist
+from typing import Dict, List, Optional, Tuple
+import argparse
+import time
+
+INFINITY = 10 ** 9
+TABLE_SIZE = 1000000
+DEFAULT_MAX_NODES = 1000000
+# Initial proof number of the position after a quiet move of the attacker (it is 1 after a check)
+QUIET_MOVE_PROOF = 4
+
+
+class MateSolver:
+    def __init__(self, max_nodes: int = DEFAULT_MAX_NODES, table_size: int = TABLE_SIZE, checks_only: bool = False) -> None:
+        """
+        Solves mate in N problems
+        Arguments:
+        - max_nodes: the solver gives up after this many nodes (including those needed to find the mating line)
+        - table_size: maximum number of positions in the table of proof numbers
+        - checks_only: only consider checking moves of the attacker (much faster, but misses mates with quiet moves)
+        """
+        self.max_nodes = max_nodes
+        self.table_size = table_size
+        self.checks_only = checks_only
+        self.table = {}
+        self.nodes = 0
+
+    def prove(self, state: Dict, mate_moves: int) -> Optional[bool]:
+        """
+        Checks if the side to move can force mate in at most mate_moves moves
+        Returns True if it can, False if it can't, and None if the solver ran out of nodes
+        """
+        root = engine.prepare_search_state(state=state)
+        try:
+            phi, delta = self.mid(state=root, key=zobrist.position_key(state=root), plies=2 * mate_moves - 1, phi_threshold=INFINITY, delta_threshold=INFINITY)
+        except engine.SearchStopped:
+            return None
+        if phi == 0:
+            return True
+        if delta == 0:
+            return False
+        return None
+
+    def solve(self, state: Dict, mate_moves: int) -> Optional[List[moves.Move]]:
+        """
+        Finds a forced mate in at most mate_moves moves for the side to move
+        Returns a mating line (None if there is no mate or the solver ran out of nodes before proving it)
+        """
+        self.nodes = 0
+        if not self.prove(state=state, mate_moves=mate_moves):
+            return None
+        return self.get_line(state=state, mate_moves=mate_moves)
+
+    def get_line(self, state: Dict, mate_moves: int) -> List[moves.Move]:
+        """
+        Gets a mating line after mate in mate_moves has been proven: the attacker plays one of its fastest mates and
+        the defender the move which delays mate the longest (the line is cut short if the solver runs out of nodes)
+        """
+        line = []
+        node = engine.prepare_search_state(state=state)
+        plies = 2 * mate_moves - 1
+        try:
+            while plies > 0:
+                move_list = moves.get_all_possible_moves(state=node, side=node["turn"])
+                if len(move_list) == 0:
+                    break
+                if plies % 2 == 1:
+                    # Attacker: play a move after which the defender is mated in the fewest plies
+                    plies = self.mate_plies(state=node, plies=plies)
+                    move = self.get_proven_move(state=node, move_list=move_list, plies=plies)
+                else:
+                    # Defender: play the move after which mate takes the most plies
+                    move, plies = max(
+                        ((move, self.mate_plies(state=engine.make_search_move(state=node, move=move), plies=plies - 1)) for move in move_list),
+                        key=lambda item: item[1],
+                    )
+                    plies += 1
+                line.append(move)
+                node = engine.make_search_move(state=node, move=move)
+                plies -= 1
+        except engine.SearchStopped:
+            pass
+        return line
+
+    def mate_plies(self, state: Dict, plies: int) -> int:
+        """
+        Gets the fewest plies (odd, at most plies) in which the attacker, to move, is proven to mate
+        NOTE: the attacker must be proven to mate within plies
+        """
+        for mate_plies in range(1, plies, 2):
+            phi, _ = self.mid(state=state, key=zobrist.position_key(state=state), plies=mate_plies, phi_threshold=INFINITY, delta_threshold=INFINITY)
+            if phi == 0:
+                return mate_plies
+        return plies
+
+    def get_proven_move(self, state: Dict, move_list: List[moves.Move], plies: int) -> moves.Move:
+        """
+        Gets a move of the attacker after which the defender is proven to lose within plies - 1 plies
+        (searching again if the entries have been replaced)
+        NOTE: the attacker must be proven to mate within plies
+        """
+        for move in move_list:
+            child = engine.make_search_move(state=state, move=move)
+            _, delta = self.mid(state=child, key=zobrist.position_key(state=child), plies=plies - 1, phi_threshold=INFINITY, delta_threshold=INFINITY)
+            if delta == 0:
+                return move
+        raise Exception("No proven move for a proven mate")
+
+    def store(self, key: int, plies: int, phi: int, delta: int):
+        # The table is kept in the order the entries were stored, so the first entry is the least recently stored
+        if self.table.pop((key, plies), None) is None and len(self.table) >= self.table_size:
+            del self.table[next(iter(self.table))]
+        self.table[(key, plies)] = (phi, delta)
+
+    def mid(self, state: Dict, key: int, plies: int, phi_threshold: int, delta_threshold: int) -> Tuple[int, int]:
+        """
+        Searches the position until its proof or disproof number reaches its threshold
+        Arguments:
+        - state: position (prepared with engine.prepare_search_state)
+        - key: Zobrist key of the position
+        - plies: number of plies left (odd if the attacker is to move)
+        - phi_threshold, delta_threshold: thresholds of the proof numbers of the side to move
+        Returns the proof numbers (phi, delta) of the side to move
+        """
+        self.nodes += 1
+        if self.nodes > self.max_nodes:
+            raise engine.SearchStopped()
+
+        attacker = plies % 2 == 1
+        move_list = moves.get_all_possible_moves(state=state, side=state["turn"])
+        if len(move_list) == 0:
+            if attacker or engine.is_check(state=state, side=state["turn"]):
+                # Checkmate, or the attacker is stalemated
+                phi, delta = INFINITY, 0
+            else:
+                # Stalemate
+                phi, delta = 0, INFINITY
+            self.store(key=key, plies=plies, phi=phi, delta=delta)
+            return phi, delta
+        if plies == 0:
+            # The defender isn't mated
+            self.store(key=key, plies=plies, phi=0, delta=INFINITY)
+            return 0, INFINITY
+
+        # Generate the children with their initial proof numbers
+        children = []
+        for move in move_list:
+            child = engine.make_search_move(state=state, move=move)
+            initial = (1, 1)
+            if attacker:
+                if not engine.is_check(state=child, side=child["turn"]):
+                    if self.checks_only or plies == 1:
+                        # Only a check can mate
+                        continue
+                    initial = (1, QUIET_MOVE_PROOF)
+            children.append((child, zobrist.position_key(state=child), initial))
+        if len(children) == 0:
+            self.store(key=key, plies=plies, phi=INFINITY, delta=0)
+            return INFINITY, 0
+
+        while True:
+            # The side to move wins if one of the children is lost for the opponent,
+            # and loses if all the children are won for the opponent
+            phi = INFINITY
+            delta = 0
+            best_index, best_child_phi, best_child_delta = 0, 0, INFINITY
+            second_delta = INFINITY
+            for index, (child, child_key, initial) in enumerate(children):
+                child_phi, child_delta = self.table.get((child_key, plies - 1), initial)
+                delta = min(delta + child_phi, INFINITY)
+                if child_delta < best_child_delta:
+                    second_delta = best_child_delta
+                    best_index, best_child_phi, best_child_delta = index, child_phi, child_delta
+                elif child_delta < second_delta:
+                    second_delta = child_delta
+            phi = best_child_delta
+
+            if phi >= phi_threshold or delta >= delta_threshold:
+                break
+
+            # Search the most promising child until it is no longer the most promising
+            if delta_threshold >= INFINITY:
+                child_phi_threshold = INFINITY
+            else:
+                child_phi_threshold = delta_threshold + best_child_phi - delta
+            child_delta_threshold = min(phi_threshold, second_delta + 1)
+            child, child_key, _ = children[best_index]
+            self.mid(state=child, key=child_key, plies=plies - 1, phi_threshold=child_phi_threshold, delta_threshold=child_delta_threshold)
+
+        self.store(key=key, plies=plies, phi=phi, delta=delta)
+        return phi, delta
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find forced mates with proof-number search")
+    parser.add_argument("fen", help="position in FEN")
+    parser.add_argument("--moves", type=int, default=5, help="number of moves to mate")
+    parser.add_argument("--nodes", type=int, default=DEFAULT_MAX_NODES)
+    parser.add_argument("--checks-only", action="store_true", help="only consider checking moves of the attacker")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    solver = MateSolver(max_nodes=args.nodes, checks_only=args.checks_only)
+    line = solver.solve(state=game.fen_to_state(fen=args.fen), mate_moves=args.moves)
+    elapsed = time.perf_counter() - start_time
+    if line is None:
+        print(f"No mate in {args.moves} found")
+    else:
+        print(f"Mate in {(len(line) + 1) // 2}: {' '.join(game.move_to_coordinates(move=move) for move in line)}")
+    print(f"{solver.nodes} nodes in {elapsed:.2f}s")
@@ -0,0 +1,211 @@
+"""
+Efficiently updatable neural network evaluation (NNUE, see https://www.chessprogramming.org/NNUE), run on the CPU with NumPy.
+
+The input features are the 768 (colour relative to the perspective, piece type, square) triples, seen from both sides.
+The first layer's output (the accumulator) is kept in the game state and updated when the search makes a move
+(engine.make_search_move calls Accumulator.after_move), by subtracting and adding the weight rows of the pieces that moved
+or were taken, so only the small remaining layers are computed for each evaluation.
+
+Layers are quantised: the accumulator and weights are int16, the sums of the hidden layer are int32.
+Activations are clipped to [0, QA], i.e. [0, 1], and weights are scaled by QB.
+
+Network files start with a header (magic, version, number of features, accumulator size, hidden layer size)
+followed by the arrays in little-endian order: feature weights (int16, features x accumulator size),
+feature biases (int16), hidden weights (int16, 2 * accumulator size x hidden size), hidden biases (int32),
+output weights (int16, hidden size) and output bias (int32). The arrays are memory-mapped when loaded.
+"""
+import pieces, moves, parallel
+from typing import Dict, List, Tuple
+import argparse
+import struct
+import numpy as np
+
+HEADER = struct.Struct("<4sIIII")
+MAGIC = b"NNUE"
+VERSION = 1
+FEATURES = 768
+PIECE_TYPES = [pieces.PAWN, pieces.KNIGHT, pieces.BISHOP, pieces.ROOK, pieces.QUEEN, pieces.KING]
+# Quantisation: activations are scaled by QA and weights by QB
+QA = 127
+QB = 64
+# Network output corresponding to 1 centipawn (before scaling by QA * QB)
+OUTPUT_SCALE = 400
+
+
+def feature_index(perspective: int, piece_str: str, row: int, col: int) -> int:
+    """
+    Gets the input feature of a piece seen from a side (0 for white, 1 for black)
+    Squares are mirrored for black so that both sides see their pieces the same way
+    """
+    side = 0 if piece_str.isupper() else 1
+    square = (7 - row) * 8 + col if perspective == 0 else row * 8 + col
+    return ((side != perspective) * 6 + PIECE_TYPES.index(piece_str.upper())) * 64 + square
+
+
+class Network(parallel.FileBacked):
+    def __init__(self, path: str) -> None:
+        """
+        Network loaded from a memory-mapped network file
+        """
+        self.path = path
+        with open(path, "rb") as file:
+            magic, version, features, self.accumulator_size, self.hidden_size = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or features != FEATURES:
+            raise Exception(f"Invalid network file: {path}")
+
+        offset = HEADER.size
+        arrays = []
+        for dtype, shape in get_layout(accumulator_size=self.accumulator_size, hidden_size=self.hidden_size):
+            arrays.append(np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape))
+            offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.feature_weights, self.feature_biases, self.hidden_weights, self.hidden_biases, self.output_weights, self.output_bias = arrays
+
+    def new_accumulator(self, state: Dict) -> "Accumulator":
+        """
+        Creates the accumulator of a position (to be stored in state["accumulator"])
+        """
+        accumulator = Accumulator(network=self, values=np.zeros((2, self.accumulator_size), dtype=np.int16))
+        accumulator.refresh(state=state)
+        return accumulator
+
+    def evaluate(self, state: Dict) -> int:
+        """
+        Evaluates the position from the point of view of the side to move (in centipawns)
+        The accumulator of the state is used if it has one
+        """
+        accumulator = state.get("accumulator")
+        if accumulator is None:
+            accumulator = self.new_accumulator(state=state)
+        turn = state["turn"]
+        # The side to move's half of the accumulator comes first
+        inputs = np.clip(np.concatenate((accumulator.values[turn], accumulator.values[1 - turn])), 0, QA).astype(np.int32)
+        hidden = (inputs @ self.hidden_weights + self.hidden_biases) // QB
+        hidden = np.clip(hidden, 0, QA)
+        output = int(hidden @ self.output_weights) + int(self.output_bias[0])
+        return output * OUTPUT_SCALE // (QA * QB)
+
+
+class Accumulator:
+    def __init__(self, network: Network, values: np.ndarray) -> None:
+        """
+        Output of the first layer of the network for a position, seen from white (values[0]) and black (values[1])
+        """
+        self.network = network
+        self.values = values
+
+    def __deepcopy__(self, memo: Dict):
+        # States are deep copied for each move (including those made to check if moves are legal): accumulators
+        # aren't changed once they are in a state (after_move makes a new one), so the copies share them
+        return self
+
+    def refresh(self, state: Dict):
+        """
+        Computes the accumulator from all the pieces of the position
+        """
+        for perspective in range(2):
+            features = [
+                feature_index(perspective=perspective, piece_str=str(piece), row=piece.row, col=piece.col)
+                for piece in state["pieces_params"].values()
+            ]
+            total = self.network.feature_biases.astype(np.int32) + self.network.feature_weights[features].sum(axis=0, dtype=np.int32)
+            self.values[perspective] = total.astype(np.int16)
+
+    def update(self, removed: List[Tuple[str, int, int]], added: List[Tuple[str, int, int]]):
+        """
+        Updates the accumulator for pieces (piece string, row, col) removed from and added to the board
+        """
+        weights = self.network.feature_weights
+        for perspective in range(2):
+            for piece_str, row, col in removed:
+                self.values[perspective] -= weights[feature_index(perspective=perspective, piece_str=piece_str, row=row, col=col)]
+            for piece_str, row, col in added:
+                self.values[perspective] += weights[feature_index(perspective=perspective, piece_str=piece_str, row=row, col=col)]
+
+    def after_move(self, state: Dict, move: moves.Move) -> "Accumulator":
+        """
+        Gets a new accumulator for the position after a move made in the state (including the castling rook's move)
+        """
+        piece_str = str(state["pieces_params"][move.piece_id])
+        end_piece_str = piece_str
+        if move.promotion_piece is not None:
+            end_piece_str = move.promotion_piece if piece_str.isupper() else move.promotion_piece.lower()
+        removed = [(piece_str, move.start_row, move.start_col)]
+        added = [(end_piece_str, move.end_row, move.end_col)]
+        if move.piece_taken is not None:
+            # The taken piece's own square is used (it differs from the end square for en passant)
+            taken = state["pieces_params"][move.piece_taken]
+            removed.append((str(taken), taken.row, taken.col))
+        if move.castling_move is not None:
+            rook_str = str(state["pieces_params"][move.castling_move.piece_id])
+            removed.append((rook_str, move.castling_move.start_row, move.castling_move.start_col))
+            added.append((rook_str, move.castling_move.end_row, move.castling_move.end_col))
+        accumulator = Accumulator(network=self.network, values=self.values.copy())
+        accumulator.update(removed=removed, added=added)
+        return accumulator
+
+
+def get_layout(accumulator_size: int, hidden_size: int) -> List[Tuple[type, Tuple[int, ...]]]:
+    """
+    Gets the types and shapes of the arrays of a network file, in order
+    """
+    return [
+        (np.int16, (FEATURES, accumulator_size)),
+        (np.int16, (accumulator_size,)),
+        (np.int16, (2 * accumulator_size, hidden_size)),
+        (np.int32, (hidden_size,)),
+        (np.int16, (hidden_size,)),
+        (np.int32, (1,)),
+    ]
+
+def save_network(path: str, arrays: List[np.ndarray]):
+    """
+    Writes a network file from its arrays (in the order of get_layout)
+    """
+    accumulator_size = arrays[0].shape[1]
+    hidden_size = arrays[2].shape[1]
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, FEATURES, accumulator_size, hidden_size))
+        for array, (dtype, shape) in zip(arrays, get_layout(accumulator_size=accumulator_size, hidden_size=hidden_size)):
+            file.write(np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder("<")).reshape(shape).tobytes())
+
+def material_network(piece_values: Dict[str, int], accumulator_size: int = 128, hidden_size: int = 32) -> List[np.ndarray]:
+    """
+    Creates the arrays of a network which evaluates the material balance, as a starting point for training
+    The first 12 accumulator values count the pieces of each type and side (12 per piece), the hidden layer passes them on
+    and the output layer weights them by the piece values
+    """
+    if accumulator_size < 12 or hidden_size < 12:
+        raise Exception("The network needs at least 12 accumulator and hidden values")
+    feature_weights = np.zeros((FEATURES, accumulator_size), dtype=np.int16)
+    for feature in range(FEATURES):
+        feature_weights[feature, feature // 64] = 12
+    hidden_weights = np.zeros((2 * accumulator_size, hidden_size), dtype=np.int16)
+    for index in range(12):
+        hidden_weights[index, index] = QB
+    output_weights = np.zeros(hidden_size, dtype=np.int16)
+    for index, piece_type in enumerate(PIECE_TYPES):
+        # Pieces of the side to move count positively and the opponent's negatively
+        weight = round(piece_values[piece_type] * QA * QB / (12 * OUTPUT_SCALE))
+        output_weights[index] = weight
+        output_weights[6 + index] = -weight
+    return [
+        feature_weights,
+        np.zeros(accumulator_size, dtype=np.int16),
+        hidden_weights,
+        np.zeros(hidden_size, dtype=np.int32),
+        output_weights,
+        np.zeros(1, dtype=np.int32),
+    ]
+
+
+if __name__ == "__main__":
+    import engine
+
+    parser = argparse.ArgumentParser(description="Create a network file which evaluates the material balance")
+    parser.add_argument("path", help="path of the network file to write")
+    parser.add_argument("--accumulator-size", type=int, default=128)
+    parser.add_argument("--hidden-size", type=int, default=32)
+    args = parser.parse_args()
+
+    save_network(path=args.path, arrays=material_network(piece_values=engine.PIECE_VALUES, accumulator_size=args.accumulator_size, hidden_size=args.hidden_size))
+    print(f"Wrote {args.path}")
@@ -0,0 +1,81 @@
+"""
+Helpers for sending work to pools of worker processes
+"""
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from concurrent.futures import Executor, wait, FIRST_COMPLETED
+from collections import deque
+
+
+class FileBacked:
+    """
+    Mixin for objects backed by files (e.g. an opening book or an SQLite database) which are sent to worker processes:
+    only the constructor arguments named in pickled_arguments are pickled, and the object is created again from them
+    when it is unpickled, so that the files are opened again rather than copied
+    """
+    pickled_arguments = ["path"]
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.pickled_arguments}
+
+    def __setstate__(self, state: Dict):
+        self.__init__(**state)
+
+
+def chunks(items: Iterable, chunk_size: int) -> Iterator[List]:
+    """
+    Groups items (read lazily) into lists of chunk_size items, the last one possibly shorter
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def map_ordered(executor: Executor, tasks: Iterable[Tuple[Callable, Dict]], max_pending: int) -> Iterator:
+    """
+    Runs tasks (functions with their keyword arguments, read lazily) in the executor, yielding their results in the
+    order of the tasks. At most max_pending tasks are in flight: the oldest result is yielded before more are submitted,
+    which bounds memory use
+    """
+    pending = deque()
+    try:
+        for function, arguments in tasks:
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+            pending.append(executor.submit(function, **arguments))
+        while len(pending) > 0:
+            yield pending.popleft().result()
+    finally:
+        # Tasks which haven't started when the results are no longer wanted are cancelled
+        for future in pending:
+            future.cancel()
+
+def map_as_completed(executor: Executor, next_task: Callable[[], Optional[Tuple[Callable, Dict, Any]]], max_pending: int) -> Iterator[Tuple[Any, Any]]:
+    """
+    Runs tasks in the executor as they become available, yielding the label and result of each task as it finishes
+    Whenever fewer than max_pending tasks are in flight, next_task is called for another task: a function, its keyword
+    arguments and a label (e.g. its stage), or None if there is none for now. The tasks can depend on the results
+    handled so far, and the iteration stops once no task is in flight and next_task returns None
+    """
+    pending = {}
+    try:
+        while True:
+            while len(pending) < max_pending:
+                task = next_task()
+                if task is None:
+                    break
+                function, arguments, label = task
+                pending[executor.submit(function, **arguments)] = label
+            if len(pending) == 0:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        # Tasks which haven't started when the results are no longer wanted (e.g. after stopping early) are cancelled
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,191 @@
+"""
+Reading games in PGN (see https://en.wikipedia.org/wiki/Portable_Game_Notation)
+"""
+import game, pieces, moves
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import re
+
+# Game results in PGN and in the game state (0 if white wins, 1 if black wins, 0.5 if draw)
+PGN_RESULTS = {"1-0": 0, "0-1": 1, "1/2-1/2": 0.5, "*": None}
+
+HEADER_PATTERN = re.compile(r'\[(\w+)\s+"(.*)"\]')
+# Comments, variations and numeric annotation glyphs are skipped
+IGNORED_PATTERN = re.compile(r"\{[^}]*\}|;[^\n]*|\$\d+")
+MOVE_NUMBER_PATTERN = re.compile(r"^\d+\.+")
+
+
+def remove_variations(movetext: str) -> str:
+    """
+    Removes (possibly nested) variations in brackets from the movetext
+    """
+    depth = 0
+    kept = []
+    for char in movetext:
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth = max(depth - 1, 0)
+        elif depth == 0:
+            kept.append(char)
+    return "".join(kept)
+
+def parse_movetext(movetext: str) -> Tuple[List[str], Optional[str]]:
+    """
+    Gets the moves (in standard notation) and the result from the movetext of a game
+    """
+    movetext = remove_variations(IGNORED_PATTERN.sub(" ", movetext))
+    san_moves = []
+    result = None
+    for token in movetext.split():
+        if token in PGN_RESULTS:
+            result = token
+            continue
+        token = MOVE_NUMBER_PATTERN.sub("", token)
+        if token != "":
+            san_moves.append(token)
+    return san_moves, result
+
+def read_games(lines: Iterable[str]) -> Iterator[Dict]:
+    """
+    Reads games from the lines of a PGN file
+    Yields a Dict for each game with:
+    - headers: Dict of the tag pairs (e.g. {"White": "...", "Result": "1-0"})
+    - moves: list of moves in standard notation (e.g. ["e4", "e5", "Nf3"])
+    - result: 0 if white wins, 1 if black wins, 0.5 if draw, None if unknown
+    """
+    headers = {}
+    movetext = []
+    for line in lines:
+        line = line.strip()
+        header_match = HEADER_PATTERN.match(line)
+        if header_match:
+            if len(movetext) > 0:
+                yield make_game(headers=headers, movetext=" ".join(movetext))
+                headers = {}
+                movetext = []
+            headers[header_match.group(1)] = header_match.group(2)
+        elif line != "":
+            movetext.append(line)
+    if len(movetext) > 0 or len(headers) > 0:
+        yield make_game(headers=headers, movetext=" ".join(movetext))
+
+def make_game(headers: Dict, movetext: str) -> Dict:
+    """
+    Creates the Dict of a game read from PGN
+    """
+    san_moves, result = parse_movetext(movetext=movetext)
+    if result is None:
+        result = headers.get("Result", "*")
+    return {
+        "headers": headers,
+        "moves": san_moves,
+        "result": PGN_RESULTS.get(result),
+    }
+
+def move_to_san(state: Dict, move: moves.Move) -> str:
+    """
+    Converts a move to standard notation (e.g. Nbd7, exd5, e8=Q+, O-O)
+    """
+    column_letters = "abcdefgh" # Assumes that there are 8 columns
+    row_numbers = "87654321" # Assumes that there are 8 rows
+
+    piece = str(state["pieces_params"][move.piece_id]).upper()
+    if move.castling_move is not None:
+        san = "O-O" if move.end_col > move.start_col else "O-O-O"
+    else:
+        san = ""
+        if piece == pieces.PAWN:
+            if move.piece_taken is not None:
+                san += column_letters[move.start_col]
+        else:
+            san += piece
+            # Disambiguate if another piece of the same type can move to the same square
+            others = [
+                other_move for other in state["pieces_params"].values()
+                if other.side == state["turn"] and other.id != move.piece_id and str(other).upper() == piece
+                for other_move in other.get_possible_moves(state=state)
+                if other_move.end_row == move.end_row and other_move.end_col == move.end_col
+            ]
+            if len(others) > 0:
+                if all(other_move.start_col != move.start_col for other_move in others):
+                    san += column_letters[move.start_col]
+                elif all(other_move.start_row != move.start_row for other_move in others):
+                    san += row_numbers[move.start_row]
+                else:
+                    san += column_letters[move.start_col] + row_numbers[move.start_row]
+        if move.piece_taken is not None:
+            san += "x"
+        san += column_letters[move.end_col] + row_numbers[move.end_row]
+        if move.promotion_piece is not None:
+            san += "=" + move.promotion_piece
+
+    # Add check or checkmate
+    state_after_move = pieces.make_move(state=state, move=move)
+    opponent = (state["turn"] + 1) % 2
+    if pieces.in_check(state=state_after_move, side=opponent):
+        if len(moves.get_all_possible_moves(state=state_after_move, side=opponent)) == 0:
+            san += "#"
+        else:
+            san += "+"
+    return san
+
+def result_to_pgn(result: Optional[float]) -> str:
+    """
+    Converts a game result (0 if white wins, 1 if black wins, 0.5 if draw, None if unknown) to PGN (e.g. "1-0")
+    """
+    return [pgn_result for pgn_result, value in PGN_RESULTS.items() if value == result][0]
+
+def write_game(headers: Dict, san_moves: List[str], result: Optional[float]) -> str:
+    """
+    Writes a game in PGN
+    Arguments:
+    - headers: tag pairs (the Result tag is set from the result)
+    - san_moves: moves in standard notation
+    - result: 0 if white wins, 1 if black wins, 0.5 if draw, None if unknown
+    """
+    result_str = result_to_pgn(result=result)
+    lines = [f'[{name} "{value}"]' for name, value in {**headers, "Result": result_str}.items()]
+    lines.append("")
+
+    movetext = []
+    for index, san in enumerate(san_moves):
+        if index % 2 == 0:
+            movetext.append(f"{index // 2 + 1}.")
+        movetext.append(san)
+    movetext.append(result_str)
+
+    # Wrap the movetext at 80 characters
+    line = ""
+    for token in movetext:
+        if len(line) + len(token) + 1 > 80:
+            lines.append(line)
+            line = token
+        else:
+            line = token if line == "" else line + " " + token
+    lines.append(line)
+    return "\n".join(lines) + "\n\n"
+
+def san_to_move_input(san: str) -> str:
+    """
+    Converts a move in standard notation to the form used by game.choose_move (removes check and annotation symbols)
+    """
+    return san.rstrip("+#!?")
+
+def replay_game(san_moves: List[str], state: Optional[Dict] = None) -> Iterator[Tuple[Dict, moves.Move]]:
+    """
+    Replays the moves of a game from the given state (the starting position by default).
+    The game result isn't checked after each move, so this is much faster than game.make_turn.
+    Yields the state before each move and the move played
+    Raises an Exception if a move is invalid
+    """
+    if state is None:
+        state = game.setup_board(state=game.create_game_state())
+
+    for san in san_moves:
+        move = game.choose_move(state=state, move_input=san_to_move_input(san=san))
+        if move is None:
+            raise Exception(f"Invalid move in game: {san}")
+        yield state, move
+
+        state = pieces.make_move(state=state, move=move)
+        state["turn"] = (state["turn"] + 1) % 2
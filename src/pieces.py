@@ -330,7 +330,7 @@ class Pawn(Piece):
         else:
             direction = 1
             start_row = 1
-            final_row = len(state["board"])
+            final_row = len(state["board"]) - 1
         
         # Pieces to promote to
         promotion_pieces = [KNIGHT, BISHOP, ROOK, QUEEN]
@@ -0,0 +1,252 @@
+"""
+Position database: an SQLite index mapping position keys (zobrist.position_key) to the games and plies in which
+the positions occurred, with the results of those games, for opening exploration and finding duplicate games.
+
+Positions are stored in a clustered table (WITHOUT ROWID) ordered by key, so a lookup reads a few pages whatever
+the size of the database. Games are inserted in batches, each batch in a single transaction.
+"""
+import game, pgn, pieces, zobrist, parallel
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor
+from itertools import islice, repeat
+import argparse
+import hashlib
+import sqlite3
+import time
+
+DEFAULT_BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    white TEXT,
+    black TEXT,
+    event TEXT,
+    date TEXT,
+    result REAL,
+    plies INTEGER,
+    moves_hash BLOB UNIQUE
+);
+CREATE TABLE IF NOT EXISTS positions (
+    key INTEGER NOT NULL,
+    game_id INTEGER NOT NULL,
+    ply INTEGER NOT NULL,
+    PRIMARY KEY (key, game_id, ply)
+) WITHOUT ROWID;
+"""
+
+
+def to_signed(key: int) -> int:
+    """
+    Converts a 64 bit position key to a signed integer (SQLite integers are signed)
+    """
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+def game_positions(san_moves: List[str], max_ply: Optional[int] = None) -> Iterator[Tuple[int, int]]:
+    """
+    Replays a game, yielding the ply number and key of each position (including the final position)
+    Raises an Exception if a move is invalid
+    """
+    state, move = None, None
+    ply = 0
+    for ply, (state, move) in enumerate(pgn.replay_game(san_moves=san_moves[:max_ply] if max_ply is not None else san_moves)):
+        yield ply, zobrist.position_key(state=state)
+    if move is not None:
+        state = pieces.make_move(state=state, move=move)
+        state["turn"] = (state["turn"] + 1) % 2
+        yield ply + 1, zobrist.position_key(state=state)
+
+def moves_hash(san_moves: List[str]) -> bytes:
+    """
+    Hashes the moves of a game (used to find duplicate games)
+    """
+    return hashlib.sha1(" ".join(san_moves).encode()).digest()
+
+def index_game(pgn_game: Dict, max_ply: Optional[int] = None) -> Optional[List[Tuple[int, int]]]:
+    """
+    Gets the (ply, key) pairs of the positions of a game (None if the game has invalid moves)
+    """
+    try:
+        return list(game_positions(san_moves=pgn_game["moves"], max_ply=max_ply))
+    except Exception:
+        return None
+
+
+class PositionDatabase(parallel.FileBacked):
+    def __init__(self, path: str) -> None:
+        """
+        Position database stored in an SQLite file (created if it doesn't exist)
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        # Write-ahead logging lets lookups run while games are being inserted
+        self.connection.execute("PRAGMA journal_mode=WAL")
+
+    def close(self):
+        self.connection.close()
+
+    def add_games(
+        self,
+        games: Iterable[Dict],
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_ply: Optional[int] = None,
+        executor: Optional[Executor] = None,
+    ) -> Dict:
+        """
+        Adds games (as read by pgn.read_games) to the database in batches
+        Games with invalid moves and duplicates of games already in the database are skipped
+        Arguments:
+        - games: games to add (read lazily, one batch at a time)
+        - batch_size: number of games inserted in each transaction
+        - max_ply: only the positions of the first max_ply plies of each game are indexed (all of them by default)
+        - executor: executor (e.g. a ProcessPoolExecutor) used to replay the games of a batch in parallel
+        Returns: the numbers of games added and skipped and of positions added
+        """
+        stats = {"games": 0, "skipped": 0, "positions": 0}
+        games = iter(games)
+        while True:
+            batch = list(islice(games, batch_size))
+            if len(batch) == 0:
+                break
+
+            # Leave out duplicate games before replaying them
+            batch_hashes = [moves_hash(san_moves=pgn_game["moves"]) for pgn_game in batch]
+            hashes = self.get_existing_hashes(hashes=batch_hashes)
+            new_games = []
+            for game_hash, pgn_game in zip(batch_hashes, batch):
+                if game_hash in hashes:
+                    stats["skipped"] += 1
+                else:
+                    hashes.add(game_hash)
+                    new_games.append((game_hash, pgn_game))
+
+            batch_games = [pgn_game for _, pgn_game in new_games]
+            if executor is not None:
+                indexed_games = executor.map(index_game, batch_games, repeat(max_ply), chunksize=max(1, batch_size // 64))
+            else:
+                indexed_games = map(index_game, batch_games, repeat(max_ply))
+
+            next_id = self.connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM games").fetchone()[0]
+            game_rows = []
+            position_rows = []
+            for (game_hash, pgn_game), positions in zip(new_games, indexed_games):
+                if positions is None:
+                    # Invalid game
+                    stats["skipped"] += 1
+                    continue
+
+                headers = pgn_game["headers"]
+                game_rows.append((
+                    next_id,
+                    headers.get("White"),
+                    headers.get("Black"),
+                    headers.get("Event"),
+                    headers.get("Date"),
+                    pgn_game["result"],
+                    len(pgn_game["moves"]),
+                    game_hash,
+                ))
+                position_rows.extend((to_signed(key=key), next_id, ply) for ply, key in positions)
+                next_id += 1
+
+            self.insert_batch(game_rows=game_rows, position_rows=position_rows, stats=stats)
+        return stats
+
+    def get_existing_hashes(self, hashes: List[bytes]) -> Set[bytes]:
+        """
+        Gets the hashes of games (see moves_hash) which are already in the database
+        """
+        existing = set()
+        # SQLite limits the number of parameters in a query
+        for start in range(0, len(hashes), 500):
+            part = hashes[start:start + 500]
+            query = f"SELECT moves_hash FROM games WHERE moves_hash IN ({','.join('?' * len(part))})"
+            existing.update(row[0] for row in self.connection.execute(query, part))
+        return existing
+
+    def insert_batch(self, game_rows: List[Tuple], position_rows: List[Tuple], stats: Dict):
+        """
+        Inserts a batch of games and their positions in a single transaction
+        """
+        with self.connection:
+            self.connection.executemany("INSERT INTO games VALUES (?, ?, ?, ?, ?, ?, ?, ?)", game_rows)
+            self.connection.executemany("INSERT OR IGNORE INTO positions VALUES (?, ?, ?)", position_rows)
+        stats["games"] += len(game_rows)
+        stats["positions"] += len(position_rows)
+
+    def get_games(self, key: int, limit: Optional[int] = None) -> List[Tuple[int, int]]:
+        """
+        Gets the (game id, ply) pairs in which the position with the given key occurred
+        """
+        query = "SELECT game_id, ply FROM positions WHERE key = ? ORDER BY game_id, ply"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        return self.connection.execute(query, (to_signed(key=key),)).fetchall()
+
+    def get_stats(self, key: int) -> Dict:
+        """
+        Gets the number of games in which the position with the given key occurred, by result
+        """
+        rows = self.connection.execute(
+            "SELECT games.result, COUNT(DISTINCT games.id) FROM positions JOIN games ON games.id = positions.game_id "
+            "WHERE positions.key = ? GROUP BY games.result",
+            (to_signed(key=key),),
+        ).fetchall()
+        counts = {result: count for result, count in rows}
+        return {
+            "games": sum(counts.values()),
+            "white_wins": counts.get(0, 0),
+            "black_wins": counts.get(1, 0),
+            "draws": counts.get(0.5, 0),
+            "unknown": counts.get(None, 0),
+        }
+
+    def get_game(self, game_id: int) -> Optional[Dict]:
+        """
+        Gets the details of a game (None if there is no game with the id)
+        """
+        row = self.connection.execute("SELECT id, white, black, event, date, result, plies FROM games WHERE id = ?", (game_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(["id", "white", "black", "event", "date", "result", "plies"], row))
+
+    def count_positions(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM positions").fetchone()[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query a database of the positions in PGN files")
+    parser.add_argument("database", help="path of the SQLite database")
+    parser.add_argument("pgn", nargs="*", help="PGN files to add to the database")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--max-ply", type=int, default=None, help="number of plies of each game to index")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes replaying games")
+    parser.add_argument("--fen", default=None, help="position to look up")
+    parser.add_argument("--limit", type=int, default=10, help="number of games listed for the position")
+    args = parser.parse_args()
+
+    database = PositionDatabase(path=args.database)
+    executor = ProcessPoolExecutor(max_workers=args.workers) if len(args.pgn) > 0 else None
+    try:
+        for pgn_path in args.pgn:
+            start_time = time.perf_counter()
+            with open(pgn_path) as file:
+                stats = database.add_games(games=pgn.read_games(lines=file), batch_size=args.batch_size, max_ply=args.max_ply, executor=executor)
+            elapsed = time.perf_counter() - start_time
+            print(f"{pgn_path}: added {stats['games']} games ({stats['skipped']} skipped) and {stats['positions']} positions in {elapsed:.1f}s")
+
+        if args.fen is not None:
+            start_time = time.perf_counter()
+            key = zobrist.position_key(state=game.fen_to_state(fen=args.fen))
+            stats = database.get_stats(key=key)
+            games = database.get_games(key=key, limit=args.limit)
+            elapsed = time.perf_counter() - start_time
+            print(f"{stats['games']} games: {stats['white_wins']} white wins, {stats['draws']} draws, {stats['black_wins']} black wins ({elapsed * 1000:.1f}ms)")
+            for game_id, ply in games:
+                details = database.get_game(game_id=game_id)
+                print(f"Game {game_id} (ply {ply}): {details['white']} - {details['black']}, {details['event']}, {details['date']}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        database.close()
@@ -0,0 +1,310 @@
+"""
+Mining of tactical puzzles (forced mates, winning captures and other single winning moves) from PGN games.
+
+The games are processed in stages:
+- read: games are read from the PGN files (in the main process)
+- prefilter: the games are replayed in worker processes and positions are kept as candidates if the move played
+  gives check or wins material over the next few plies (from the pieces taken, see Move.piece_taken)
+- deduplicate: candidates already seen (with the same Zobrist key, among the last MAX_SEEN candidates) are dropped
+  (in the main process)
+- search: candidates are searched in worker processes, first for a short forced mate with checks (mate.MateSolver),
+  then with a bounded two-line search which finds puzzles with a single clearly winning move
+- write: puzzles are written as JSONL (in completion order)
+The time spent in each stage is reported so that the bottleneck can be found.
+"""
+import game, engine, mate, pgn, pieces, zobrist, analysis, parallel
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import argparse
+import json
+import os
+import sys
+import time
+
+# Plies after a position over which the material won by the side to move is counted
+SWING_PLIES = 3
+# Material a position's side to move has to win over SWING_PLIES plies to be a candidate (in centipawns)
+MIN_SWING = 200
+# Score the best move must reach, and its minimum lead over the second best move (in centipawns)
+WINNING_SCORE = 300
+UNIQUE_MARGIN = 250
+DEFAULT_LIMITS = {"depth": 3, "nodes": 2000, "time": None, "mate_moves": 2, "mate_nodes": 2000}
+DEFAULT_GAME_CHUNK_SIZE = 4
+DEFAULT_SEARCH_CHUNK_SIZE = 8
+# Number of candidates remembered to drop duplicates (older candidates are forgotten, which bounds memory use)
+MAX_SEEN = 1000000
+# Headers of the game copied to its puzzles
+GAME_HEADERS = ["Event", "Site", "Date", "White", "Black"]
+
+
+def prefilter_game(pgn_game: Dict, skip_plies: int = 0) -> List[Dict]:
+    """
+    Replays a game, keeping the positions (after skip_plies) in which the move played gives check or the side to move
+    wins at least MIN_SWING of material over the next SWING_PLIES plies
+    Returns the candidates: Dicts with the FEN, the Zobrist key, the ply and the reason ("check" or "material")
+    """
+    positions = []
+    for state, move in pgn.replay_game(san_moves=pgn_game["moves"]):
+        taken = 0
+        if move.piece_taken is not None:
+            taken = engine.PIECE_VALUES[str(state["pieces_params"][move.piece_taken]).upper()]
+        positions.append((state, taken))
+    if len(positions) > 0:
+        # Position after the last move, to know if it gives check
+        positions.append((engine.make_search_move(state=state, move=move), 0))
+
+    def gives_check(ply: int) -> bool:
+        after = positions[ply + 1][0]
+        return pieces.in_check(state=after, side=after["turn"])
+
+    candidates = []
+    for ply in range(skip_plies, len(positions) - 1):
+        # Material taken by the side to move minus material taken by the opponent
+        swing = sum(taken if (other_ply - ply) % 2 == 0 else -taken for other_ply, (_, taken) in enumerate(positions[ply:ply + SWING_PLIES], start=ply))
+        if swing >= MIN_SWING:
+            reason = "material"
+        elif gives_check(ply=ply):
+            reason = "check"
+        else:
+            continue
+        candidates.append({
+            "fen": game.state_to_fen(state=positions[ply][0]),
+            "key": zobrist.position_key(state=positions[ply][0]),
+            "ply": ply,
+            "reason": reason,
+            "game": {header: pgn_game["headers"][header] for header in GAME_HEADERS if header in pgn_game["headers"]},
+        })
+    return candidates
+
+def prefilter_games(pgn_games: List[Dict], skip_plies: int = 0) -> Dict:
+    """
+    Prefilters a chunk of games (in a worker process)
+    Returns the candidates and statistics of the stage
+    """
+    start_time = time.perf_counter()
+    candidates = []
+    positions = 0
+    skipped = 0
+    for pgn_game in pgn_games:
+        try:
+            candidates += prefilter_game(pgn_game=pgn_game, skip_plies=skip_plies)
+            positions += len(pgn_game["moves"])
+        except Exception:
+            # Invalid moves
+            skipped += 1
+    return {"candidates": candidates, "positions": positions, "skipped": skipped, "seconds": time.perf_counter() - start_time}
+
+
+def line_to_san(state: Dict, line: List) -> List[str]:
+    """
+    Converts a line of moves from the state to standard notation
+    """
+    sans = []
+    for move in line:
+        sans.append(pgn.move_to_san(state=state, move=move))
+        state = engine.make_search_move(state=state, move=move)
+    return sans
+
+def search_candidate(candidate: Dict, limits: Dict) -> Optional[Dict]:
+    """
+    Searches a candidate position
+    Returns the puzzle (the candidate with its type, score and solution line) or None if it isn't one
+    """
+    state = engine.prepare_search_state(state=game.fen_to_state(fen=candidate["fen"]))
+    # Only checking moves are tried, which is much faster: mates with quiet moves are left to the search
+    line = mate.MateSolver(max_nodes=limits["mate_nodes"], checks_only=True).solve(state=state, mate_moves=limits["mate_moves"])
+    if line is not None:
+        puzzle_type = "mate"
+        score = engine.MATE_SCORE - len(line)
+    else:
+        searcher = engine.Searcher(depth=limits["depth"], max_nodes=limits["nodes"], max_time=limits["time"], multi_pv=2)
+        searcher.search(state=state)
+        if len(searcher.lines) == 0:
+            return None
+        score = searcher.lines[0]["score"]
+        second_score = searcher.lines[1]["score"] if len(searcher.lines) > 1 else -engine.MATE_SCORE
+        if score < WINNING_SCORE or score - second_score < UNIQUE_MARGIN:
+            return None
+        line = searcher.lines[0]["pv"]
+        if score > engine.MATE_BOUND:
+            puzzle_type = "mate"
+        elif line[0].piece_taken is not None:
+            puzzle_type = "capture"
+        else:
+            puzzle_type = "tactic"
+    return {
+        **candidate,
+        "type": puzzle_type,
+        "score": analysis.score_to_json(score=score),
+        "solution": [game.move_to_coordinates(move=move) for move in line],
+        "solution_san": line_to_san(state=state, line=line),
+    }
+
+def search_candidates(candidates: List[Dict], limits: Dict) -> Dict:
+    """
+    Searches a chunk of candidates (in a worker process)
+    Returns the puzzles found and statistics of the stage
+    """
+    start_time = time.perf_counter()
+    puzzles = []
+    for candidate in candidates:
+        puzzle = search_candidate(candidate=candidate, limits=limits)
+        if puzzle is not None:
+            puzzles.append(puzzle)
+    return {"puzzles": puzzles, "seconds": time.perf_counter() - start_time}
+
+
+def mine_puzzles(
+    lines: Iterable[str],
+    output: TextIO,
+    limits: Dict = DEFAULT_LIMITS,
+    workers: Optional[int] = None,
+    game_chunk_size: int = DEFAULT_GAME_CHUNK_SIZE,
+    search_chunk_size: int = DEFAULT_SEARCH_CHUNK_SIZE,
+    skip_plies: int = 0,
+    report=None,
+) -> Dict:
+    """
+    Mines puzzles from PGN games in a pool of worker processes, writing them as JSONL
+    Arguments:
+    - lines: lines of PGN (read lazily)
+    - output: file the puzzles are written to
+    - limits: limits of the search of each candidate (see DEFAULT_LIMITS): depth, nodes and time (in seconds) of the
+      search, and moves and nodes of the mate solver
+    - workers: number of worker processes (defaults to the number of CPUs)
+    - game_chunk_size: number of games prefiltered by a worker at once
+    - search_chunk_size: number of candidates searched by a worker at once
+    - skip_plies: number of plies of each game which aren't considered (e.g. the opening)
+    - report: function called with the statistics after each chunk
+    Returns: statistics of each stage
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    limits = {**DEFAULT_LIMITS, **limits}
+    stats = {
+        "games": 0,
+        "skipped": 0,
+        "positions": 0,
+        "candidates": 0,
+        "duplicates": 0,
+        "searched": 0,
+        "puzzles": 0,
+        # Seconds spent in each stage (summed over the workers for prefilter and search)
+        "seconds": {"read": 0.0, "prefilter": 0.0, "search": 0.0, "write": 0.0},
+        "total_seconds": 0.0,
+    }
+    # Zobrist keys of the last MAX_SEEN candidates, and their order to forget the oldest
+    seen = set()
+    seen_order = deque()
+    queue = []
+    start_time = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        game_chunks = parallel.chunks(items=pgn.read_games(lines=lines), chunk_size=game_chunk_size)
+        games_left = True
+
+        def next_task() -> Optional[Tuple]:
+            nonlocal queue, games_left
+            # Candidates are searched before more games are read
+            while True:
+                if len(queue) >= search_chunk_size or (not games_left and len(queue) > 0):
+                    candidates, queue = queue[:search_chunk_size], queue[search_chunk_size:]
+                    stats["searched"] += len(candidates)
+                    return search_candidates, {"candidates": candidates, "limits": limits}, "search"
+                if not games_left:
+                    return None
+                read_start = time.perf_counter()
+                chunk = next(game_chunks, None)
+                stats["seconds"]["read"] += time.perf_counter() - read_start
+                if chunk is None:
+                    games_left = False
+                    continue
+                stats["games"] += len(chunk)
+                return prefilter_games, {"pgn_games": chunk, "skip_plies": skip_plies}, "prefilter"
+
+        # A bounded number of chunks is in flight, each handled as soon as it finishes
+        for stage, result in parallel.map_as_completed(executor=executor, next_task=next_task, max_pending=2 * workers):
+            stats["seconds"][stage] += result["seconds"]
+            if stage == "prefilter":
+                stats["positions"] += result["positions"]
+                stats["skipped"] += result["skipped"]
+                for candidate in result["candidates"]:
+                    stats["candidates"] += 1
+                    if candidate["key"] in seen:
+                        stats["duplicates"] += 1
+                    else:
+                        seen.add(candidate["key"])
+                        seen_order.append(candidate["key"])
+                        if len(seen_order) > MAX_SEEN:
+                            seen.discard(seen_order.popleft())
+                        queue.append(candidate)
+            else:
+                write_start = time.perf_counter()
+                for puzzle in result["puzzles"]:
+                    output.write(json.dumps(puzzle) + "\n")
+                output.flush()
+                stats["puzzles"] += len(result["puzzles"])
+                stats["seconds"]["write"] += time.perf_counter() - write_start
+            stats["total_seconds"] = time.perf_counter() - start_time
+            if report is not None:
+                report(stats)
+
+    stats["total_seconds"] = time.perf_counter() - start_time
+    return stats
+
+def format_stats(stats: Dict) -> List[str]:
+    """
+    Formats the throughput of each stage (per second spent in the stage, summed over workers)
+    """
+    def rate(count: int, stage: str) -> str:
+        seconds = stats["seconds"][stage]
+        return f"{count / seconds:.2f}/s" if seconds > 0 else "-"
+
+    return [
+        f"read:        {stats['games']} games in {stats['seconds']['read']:.1f}s ({rate(stats['games'], 'read')})",
+        f"prefilter:   {stats['positions']} positions in {stats['seconds']['prefilter']:.1f}s ({rate(stats['positions'], 'prefilter')}), "
+        f"{stats['candidates']} candidates, {stats['skipped']} invalid games",
+        f"deduplicate: {stats['duplicates']} duplicates dropped",
+        f"search:      {stats['searched']} candidates in {stats['seconds']['search']:.1f}s ({rate(stats['searched'], 'search')}), {stats['puzzles']} puzzles",
+        f"write:       {stats['puzzles']} puzzles in {stats['seconds']['write']:.1f}s",
+        f"total:       {stats['total_seconds']:.1f}s",
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mine tactical puzzles from PGN games, writing them as JSONL")
+    parser.add_argument("pgn", nargs="*", help="PGN files (stdin if none are given)")
+    parser.add_argument("--output", default="-", help="JSONL file the puzzles are written to (- for stdout)")
+    parser.add_argument("--depth", type=int, default=DEFAULT_LIMITS["depth"], help="search depth of each candidate")
+    parser.add_argument("--nodes", type=int, default=DEFAULT_LIMITS["nodes"], help="maximum number of nodes searched for each candidate")
+    parser.add_argument("--time", type=float, default=DEFAULT_LIMITS["time"], help="maximum number of seconds spent searching each candidate")
+    parser.add_argument("--mate-moves", type=int, default=DEFAULT_LIMITS["mate_moves"], help="longest forced mate looked for")
+    parser.add_argument("--mate-nodes", type=int, default=DEFAULT_LIMITS["mate_nodes"], help="maximum number of nodes of the mate solver")
+    parser.add_argument("--skip-plies", type=int, default=0, help="number of plies at the start of each game which aren't considered")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    def read_lines() -> Iterator[str]:
+        if len(args.pgn) == 0:
+            yield from sys.stdin
+        for path in args.pgn:
+            with open(path) as file:
+                yield from file
+
+    output_file = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        stats = mine_puzzles(
+            lines=read_lines(),
+            output=output_file,
+            limits={"depth": args.depth, "nodes": args.nodes, "time": args.time, "mate_moves": args.mate_moves, "mate_nodes": args.mate_nodes},
+            workers=args.workers,
+            skip_plies=args.skip_plies,
+        )
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
+
+    # The report goes to stderr so that it doesn't mix with the puzzles on stdout
+    for line in format_stats(stats=stats):
+        print(line, file=sys.stderr)
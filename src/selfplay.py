@@ -0,0 +1,243 @@
+"""
+Self-play: plays games automatically between move choosers (e.g. random moves or the engine at a fixed depth or number of nodes)
+across a pool of worker processes. Finished games are streamed to PGN and/or JSONL files, and the number of games
+and plies per second and the distribution of results are reported.
+"""
+import game, engine, pgn, moves, book, tablebase, parallel
+from typing import Dict, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+import argparse
+import json
+import os
+import random
+import time
+
+DEFAULT_MAX_PLIES = 300
+
+
+def choose_random_move(state: Dict, rng: random.Random, options: Dict, book = None, tablebases = None) -> moves.Move:
+    """
+    Chooses a random legal move
+    """
+    move_list = moves.get_all_possible_moves(state=state, side=state["turn"])
+    return rng.choice(move_list)
+
+def choose_searched_move(state: Dict, rng: random.Random, options: Dict, book = None, tablebases = None) -> moves.Move:
+    """
+    Chooses the engine's move, searching to options["depth"] plies or options["nodes"] nodes
+    """
+    if book is not None:
+        move = book.choose_move(state=state, rng=rng)
+        if move is not None:
+            return move
+    searcher = engine.Searcher(
+        depth=options.get("depth", engine.DEFAULT_DEPTH if "nodes" not in options else engine.MAX_DEPTH),
+        max_nodes=options.get("nodes"),
+        tablebases=tablebases,
+    )
+    move, _ = searcher.search(state=state)
+    return move
+
+# Move choosers by name. A chooser is called with the state, a random number generator, the player's options,
+# and the opening book and tablebases (or None), and returns the move to play.
+MOVE_CHOOSERS = {
+    "random": choose_random_move,
+    "engine": choose_searched_move,
+}
+
+
+def parse_player(spec: str) -> Dict:
+    """
+    Parses a player specification such as "random", "engine:depth=2" or "engine:nodes=500"
+    Returns a Dict with the chooser name and its options
+    """
+    name, _, options_str = spec.partition(":")
+    if name not in MOVE_CHOOSERS:
+        raise Exception(f"Unknown move chooser: {name}")
+    player = {"name": name, "spec": spec}
+    for option in options_str.split(","):
+        if option != "":
+            key, _, value = option.partition("=")
+            player[key] = int(value)
+    return player
+
+def play_game(white: Dict, black: Dict, seed: int, max_plies: int = DEFAULT_MAX_PLIES, opening_plies: int = 0, with_san: bool = True, book = None, tablebases = None) -> Dict:
+    """
+    Plays a game between two players (see parse_player) using game.make_turn to detect the result
+    Arguments:
+    - white, black: players
+    - seed: seed of the random number generator used by the players
+    - max_plies: the game is stopped unfinished after this many plies
+    - opening_plies: number of random moves played at the start (so that games between deterministic players differ)
+    - with_san: whether to record the moves in standard notation (needed for PGN)
+    - book: opening book (book.OpeningBook) used by engine players
+    - tablebases: endgame tablebases (tablebase.Tablebases) used by engine players and to adjudicate the result
+    Returns: a Dict describing the game
+    """
+    start_time = time.perf_counter()
+    rng = random.Random(seed)
+    state = game.setup_board(state=game.create_game_state())
+    coordinate_moves = []
+    san_moves = []
+
+    while state["result"] is None and len(coordinate_moves) < max_plies:
+        player = white if state["turn"] == 0 else black
+        if len(coordinate_moves) < opening_plies:
+            move = choose_random_move(state=state, rng=rng, options={})
+        else:
+            move = MOVE_CHOOSERS[player["name"]](state=state, rng=rng, options=player, book=book, tablebases=tablebases)
+
+        coordinate_moves.append(game.move_to_coordinates(move=move))
+        if with_san:
+            san_moves.append(pgn.move_to_san(state=state, move=move))
+        # The reason the game finished is returned rather than printed
+        state = game.make_turn(state=state, move=move, tablebases=tablebases, log=False)
+
+    if state["result"] is None:
+        termination = "Ply limit"
+    else:
+        _, termination = game.get_termination(state=state, tablebases=tablebases)
+
+    return {
+        "white": white["spec"],
+        "black": black["spec"],
+        "seed": seed,
+        "result": state["result"],
+        "termination": termination,
+        "plies": len(coordinate_moves),
+        "moves": coordinate_moves,
+        "san": san_moves,
+        "seconds": time.perf_counter() - start_time,
+    }
+
+
+def run_selfplay(
+    white: Dict,
+    black: Dict,
+    games: int,
+    workers: Optional[int] = None,
+    seed: int = 0,
+    alternate: bool = False,
+    pgn_path: Optional[str] = None,
+    jsonl_path: Optional[str] = None,
+    max_plies: int = DEFAULT_MAX_PLIES,
+    opening_plies: int = 0,
+    book = None,
+    tablebases = None,
+) -> Dict:
+    """
+    Plays games in a pool of worker processes (a bounded number at a time), writing each game as soon as it finishes
+    Arguments:
+    - white, black: players (see parse_player)
+    - games: number of games to play
+    - workers: number of worker processes (defaults to the number of CPUs)
+    - seed: seed of the first game (game i uses seed + i)
+    - alternate: swap the players' colours every other game
+    - pgn_path, jsonl_path: files the games are written to
+    - max_plies, opening_plies, book, tablebases: see play_game
+    Returns: statistics of the games played
+    """
+    pgn_file = open(pgn_path, "w") if pgn_path is not None else None
+    jsonl_file = open(jsonl_path, "w") if jsonl_path is not None else None
+    results = Counter()
+    terminations = Counter()
+    total_plies = 0
+    if workers is None:
+        workers = os.cpu_count() or 1
+    game_indexes = iter(range(games))
+
+    def next_task() -> Optional[Tuple]:
+        index = next(game_indexes, None)
+        if index is None:
+            return None
+        players = (black, white) if alternate and index % 2 == 1 else (white, black)
+        arguments = {
+            "white": players[0],
+            "black": players[1],
+            "seed": seed + index,
+            "max_plies": max_plies,
+            "opening_plies": opening_plies,
+            "with_san": pgn_file is not None,
+            "book": book,
+            "tablebases": tablebases,
+        }
+        return play_game, arguments, index
+
+    start_time = time.perf_counter()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for index, finished_game in parallel.map_as_completed(executor=executor, next_task=next_task, max_pending=2 * workers):
+                finished_game["id"] = index
+                results[pgn.result_to_pgn(result=finished_game["result"])] += 1
+                terminations[finished_game["termination"]] += 1
+                total_plies += finished_game["plies"]
+
+                if pgn_file is not None:
+                    pgn_file.write(pgn.write_game(
+                        headers={
+                            "Event": "Self-play",
+                            "Round": str(finished_game["id"] + 1),
+                            "White": finished_game["white"],
+                            "Black": finished_game["black"],
+                            "Termination": finished_game["termination"],
+                        },
+                        san_moves=finished_game["san"],
+                        result=finished_game["result"],
+                    ))
+                    pgn_file.flush()
+                if jsonl_file is not None:
+                    jsonl_file.write(json.dumps({key: value for key, value in finished_game.items() if key != "san"}) + "\n")
+                    jsonl_file.flush()
+    finally:
+        for file in [pgn_file, jsonl_file]:
+            if file is not None:
+                file.close()
+
+    elapsed = time.perf_counter() - start_time
+    return {
+        "games": games,
+        "plies": total_plies,
+        "seconds": elapsed,
+        "games_per_second": games / elapsed if elapsed > 0 else 0,
+        "plies_per_second": total_plies / elapsed if elapsed > 0 else 0,
+        "results": dict(results),
+        "terminations": dict(terminations),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play games automatically between move choosers")
+    parser.add_argument("--white", default="engine:depth=1", help='player, e.g. "random", "engine:depth=2" or "engine:nodes=500"')
+    parser.add_argument("--black", default="random")
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--alternate", action="store_true", help="swap colours every other game")
+    parser.add_argument("--pgn", default=None, help="PGN file the games are written to")
+    parser.add_argument("--jsonl", default=None, help="JSONL file the games are written to")
+    parser.add_argument("--max-plies", type=int, default=DEFAULT_MAX_PLIES)
+    parser.add_argument("--opening-plies", type=int, default=0, help="number of random moves at the start of each game")
+    parser.add_argument("--book", default=None, help="opening book used by engine players")
+    parser.add_argument("--tablebases", default=None, help="directory of endgame tablebases")
+    args = parser.parse_args()
+
+    stats = run_selfplay(
+        white=parse_player(spec=args.white),
+        black=parse_player(spec=args.black),
+        games=args.games,
+        workers=args.workers,
+        seed=args.seed,
+        alternate=args.alternate,
+        pgn_path=args.pgn,
+        jsonl_path=args.jsonl,
+        max_plies=args.max_plies,
+        opening_plies=args.opening_plies,
+        book=book.OpeningBook(path=args.book) if args.book is not None else None,
+        tablebases=tablebase.Tablebases(directory=args.tablebases) if args.tablebases is not None else None,
+    )
+    print(f"Played {stats['games']} games ({stats['plies']} plies) in {stats['seconds']:.1f}s")
+    print(f"{stats['games_per_second']:.3f} games/s, {stats['plies_per_second']:.1f} plies/s")
+    print(f"Results: {stats['results']}")
+    print(f"Terminations: {stats['terminations']}")
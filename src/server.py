@@ -0,0 +1,565 @@
+import game, engine, pieces, moves, snapshot, book, tablebase, analysiscache
+from typing import Dict, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import argparse
+import base64
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import struct
+import time
+import uuid
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+MAX_BODY_SIZE = 64 * 1024
+# Maximum search depth of the engine in a game (deeper requested depths are reduced to it)
+MAX_DEPTH = 6
+# WebSocket close status codes (see https://www.rfc-editor.org/rfc/rfc6455#section-7.4.1)
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_INVALID_DATA = 1007
+CLOSE_TOO_BIG = 1009
+STATUS_MESSAGES = {
+    101: "Switching Protocols",
+    200: "OK",
+    201: "Created",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    413: "Payload Too Large",
+}
+
+
+class SessionStore:
+    def __init__(self, max_idle_seconds: float = 3600) -> None:
+        """
+        Holds the games being played in memory
+        Arguments:
+        - max_idle_seconds: games which haven't been played for this long are removed by evict_idle
+        """
+        self.sessions = {}
+        self.max_idle_seconds = max_idle_seconds
+
+    def create(self, engine_side: Optional[int] = None, depth: int = engine.DEFAULT_DEPTH) -> Dict:
+        """
+        Creates a new game in the starting position
+        Arguments:
+        - engine_side: side played by the engine (0 for white, 1 for black, None for no engine)
+        - depth: search depth of the engine
+        Returns: the session
+        """
+        state = game.create_game_state()
+        state = game.setup_board(state=state)
+
+        session = {
+            "id": uuid.uuid4().hex,
+            "state": state,
+            "engine_side": engine_side,
+            "depth": depth,
+            "lock": asyncio.Lock(),
+            "last_active": time.monotonic(),
+        }
+        self.sessions[session["id"]] = session
+        return session
+
+    def get(self, game_id: str) -> Optional[Dict]:
+        """
+        Gets the session of a game (None if it doesn't exist)
+        """
+        session = self.sessions.get(game_id)
+        if session is not None:
+            session["last_active"] = time.monotonic()
+        return session
+
+    def delete(self, game_id: str) -> bool:
+        """
+        Deletes a game. Returns True if the game existed
+        """
+        return self.sessions.pop(game_id, None) is not None
+
+    def save_snapshot(self, path: str):
+        """
+        Saves all the games to a snapshot file
+        """
+        snapshot.save_games(path=path, games=(
+            (game_id, session["state"], {"engine_side": session["engine_side"], "depth": session["depth"]})
+            for game_id, session in self.sessions.items()
+        ))
+
+    def load_snapshot(self, path: str) -> int:
+        """
+        Loads the games from a snapshot file. Returns the number of games loaded
+        """
+        games = snapshot.load_games(path=path)
+        for game_id, state, metadata in games:
+            self.sessions[game_id] = {
+                "id": game_id,
+                "state": state,
+                "engine_side": metadata.get("engine_side"),
+                "depth": metadata.get("depth", engine.DEFAULT_DEPTH),
+                "lock": asyncio.Lock(),
+                "last_active": time.monotonic(),
+            }
+        return len(games)
+
+    def evict_idle(self) -> int:
+        """
+        Removes the games which have been idle for too long. Returns the number of games removed
+        """
+        now = time.monotonic()
+        idle_ids = [game_id for game_id, session in self.sessions.items() if now - session["last_active"] > self.max_idle_seconds and not session["lock"].locked()]
+        for game_id in idle_ids:
+            self.sessions.pop(game_id)
+        return len(idle_ids)
+
+
+def session_summary(session: Dict) -> Dict:
+    """
+    Describes a game for the client
+    """
+    state = session["state"]
+    return {
+        "id": session["id"],
+        "fen": game.board_to_fen(state=state),
+        "turn": state["turn"],
+        "result": state["result"],
+        "moves": [game.move_to_coordinates(move=move) for move in state["moves"]],
+        "engine_side": session["engine_side"],
+    }
+
+
+# Opening book, tablebases and analysis cache of a worker process, opened once by init_worker
+worker_resources = {}
+
+def init_worker(book_path: Optional[str] = None, tablebase_directory: Optional[str] = None, cache_path: Optional[str] = None):
+    """
+    Opens the resources used to play moves in a worker process (the initializer of the pool), so that they aren't
+    sent with every move
+    """
+    worker_resources["book"] = book.OpeningBook(path=book_path) if book_path is not None else None
+    worker_resources["tablebases"] = tablebase.Tablebases(directory=tablebase_directory) if tablebase_directory is not None else None
+    worker_resources["cache"] = analysiscache.AnalysisCache(path=cache_path) if cache_path is not None else None
+
+def find_player_turn(record: bytes, move_input: str) -> Optional[Tuple[moves.Move, Optional[float]]]:
+    """
+    Checks a move given by a player (in standard or coordinate notation) in a game (as a snapshot record),
+    in a worker process
+    Returns the move and the result of the game after it, or None if the move is invalid
+    """
+    state, _ = snapshot.unpack_state(record=record)
+    try:
+        move = game.choose_move(state=state, move_input=move_input)
+    except Exception:
+        move = None
+    if move is None:
+        return None
+    # The server doesn't print the reason the game finished (it is sent to the client as the result)
+    new_state = game.make_turn(state=state, move=move, tablebases=worker_resources["tablebases"], log=False)
+    return move, new_state["result"]
+
+def find_engine_turn(record: bytes, depth: int) -> Optional[Tuple[moves.Move, Optional[float]]]:
+    """
+    Searches for the engine's move in a game (as a snapshot record), in a worker process
+    Returns the move and the result of the game after it, or None if there is no move
+    """
+    state, _ = snapshot.unpack_state(record=record)
+    tablebases = worker_resources["tablebases"]
+    move = engine.choose_engine_move(
+        state=engine.prepare_search_state(state=state),
+        depth=depth,
+        book=worker_resources["book"],
+        tablebases=tablebases,
+        cache=worker_resources["cache"],
+    )
+    if move is None:
+        return None
+    new_state = game.make_turn(state=state, move=move, tablebases=tablebases, log=False)
+    return move, new_state["result"]
+
+def apply_turn(state: Dict, move: moves.Move, result: Optional[float]) -> Dict:
+    """
+    Plays a move found in a worker process, with the result found there, so no moves are generated by the caller
+    Returns the updated game state
+    """
+    new_state = pieces.make_move(state=state, move=move)
+    new_state["positions"].append(game.board_to_fen(state=new_state))
+    new_state["turn"] = (new_state["turn"] + 1) % 2
+    new_state["result"] = result
+    return new_state
+
+
+class GameServer:
+    def __init__(self, store: SessionStore, workers: Optional[int] = None, book_path: Optional[str] = None, tablebase_directory: Optional[str] = None, cache_path: Optional[str] = None) -> None:
+        """
+        Serves games over HTTP (JSON) and WebSockets. Moves are checked and engine moves are searched in a pool
+        of worker processes, so the event loop is never blocked by move generation or the engine thinking.
+        The workers open the book, tablebases and cache once, and each move only sends them the game as a snapshot record.
+        Arguments:
+        - store: session store holding the games
+        - workers: number of engine worker processes (defaults to the number of CPUs)
+        - book_path: path of an opening book consulted by the engine before searching
+        - tablebase_directory: directory of endgame tablebases used by the engine and to adjudicate games
+        - cache_path: SQLite file of an analysis cache checked by the engine before searching (shared with other runs)
+        """
+        self.store = store
+        # Workers are started when they are first needed, so they are spawned rather than forked: a forked worker
+        # would keep the connections open at that time, and the clients would never see them closed
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=functools.partial(
+                init_worker,
+                book_path=book_path,
+                tablebase_directory=tablebase_directory,
+                cache_path=cache_path,
+            ),
+        )
+
+    async def play_move(self, session: Dict, move_input: str) -> Tuple[int, Dict]:
+        """
+        Plays the given move (in standard or coordinate notation) and then the engine's reply if it is the engine's turn
+        Returns the HTTP status code and the response body
+        """
+        async with session["lock"]:
+            # Catch up on the engine's move (e.g. if the server was restarted while the engine was thinking)
+            await self.play_engine_move(session=session)
+
+            state = session["state"]
+            if state["result"] is not None:
+                return 409, {"error": "Game is over"}
+            if state["turn"] == session["engine_side"]:
+                return 409, {"error": "It is the engine's turn"}
+
+            # Checking the move and the result of the game is too slow for the event loop
+            loop = asyncio.get_running_loop()
+            turn = await loop.run_in_executor(self.executor, functools.partial(
+                find_player_turn,
+                record=snapshot.pack_state(state=state),
+                move_input=move_input,
+            ))
+            if turn is None:
+                return 400, {"error": f"Invalid move: {move_input}"}
+            move, result = turn
+            session["state"] = apply_turn(state=state, move=move, result=result)
+
+            await self.play_engine_move(session=session)
+
+        return 200, session_summary(session=session)
+
+    async def play_engine_move(self, session: Dict):
+        """
+        Plays the engine's move if it is the engine's turn. The search (and the move) is made in a worker process.
+        NOTE: the session lock must be held by the caller
+        """
+        state = session["state"]
+        if state["result"] is not None or state["turn"] != session["engine_side"]:
+            return
+
+        loop = asyncio.get_running_loop()
+        turn = await loop.run_in_executor(self.executor, functools.partial(
+            find_engine_turn,
+            record=snapshot.pack_state(state=state),
+            depth=session["depth"],
+        ))
+        if turn is not None:
+            move, result = turn
+            session["state"] = apply_turn(state=state, move=move, result=result)
+
+    async def route(self, method: str, path: str, body: Dict) -> Tuple[int, Dict]:
+        """
+        Handles a HTTP request
+        Returns the HTTP status code and the response body
+        """
+        parts = [part for part in path.split("/") if part != ""]
+
+        if parts == ["games"]:
+            if method != "POST":
+                return 405, {"error": "Method not allowed"}
+            engine_side = body.get("engine_side")
+            if engine_side not in (None, 0, 1):
+                return 400, {"error": "engine_side must be 0, 1 or null"}
+            try:
+                depth = int(body.get("depth", engine.DEFAULT_DEPTH))
+            except (TypeError, ValueError):
+                depth = None
+            if depth is None or depth < 1:
+                return 400, {"error": "depth must be a positive integer"}
+            session = self.store.create(engine_side=engine_side, depth=min(depth, MAX_DEPTH))
+            async with session["lock"]:
+                await self.play_engine_move(session=session)
+            return 201, session_summary(session=session)
+
+        if len(parts) in (2, 3) and parts[0] == "games":
+            session = self.store.get(parts[1])
+            if session is None:
+                return 404, {"error": "Game not found"}
+
+            if len(parts) == 2:
+                if method == "GET":
+                    return 200, session_summary(session=session)
+                if method == "DELETE":
+                    self.store.delete(parts[1])
+                    return 200, {"id": parts[1]}
+                return 405, {"error": "Method not allowed"}
+
+            if parts[2] == "moves":
+                if method != "POST":
+                    return 405, {"error": "Method not allowed"}
+                if not isinstance(body.get("move"), str) or body["move"] == "":
+                    return 400, {"error": "No move given"}
+                return await self.play_move(session=session, move_input=body["move"])
+
+        return 404, {"error": "Not found"}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Handles HTTP requests on a connection (kept alive between requests), upgrading to a WebSocket if asked
+        """
+        try:
+            while True:
+                try:
+                    request = await read_http_request(reader=reader)
+                except ValueError:
+                    # The rest of the connection can't be parsed either, so it is closed
+                    write_http_response(writer=writer, status=400, body={"error": "Malformed request"}, keep_alive=False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, raw_body = request
+
+                if headers.get("upgrade", "").lower() == "websocket":
+                    await self.handle_websocket(reader=reader, writer=writer, path=path, headers=headers)
+                    break
+
+                if raw_body is None:
+                    status, response = 413, {"error": "Request body too large"}
+                else:
+                    try:
+                        body = json.loads(raw_body) if raw_body else {}
+                    except ValueError:
+                        body = None
+                    if not isinstance(body, dict):
+                        status, response = 400, {"error": "Request body must be a JSON object"}
+                    else:
+                        status, response = await self.route(method=method, path=path, body=body)
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                write_http_response(writer=writer, status=status, body=response, keep_alive=keep_alive)
+                await writer.drain()
+                if not keep_alive or raw_body is None:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_websocket(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, path: str, headers: Dict):
+        """
+        Plays a game over a WebSocket at /games/<id>/ws
+        Each text message from the client is a move (fragmented messages are reassembled), and the game is sent back
+        after every move
+        """
+        parts = [part for part in path.split("/") if part != ""]
+        session = self.store.get(parts[1]) if len(parts) == 3 and parts[0] == "games" and parts[2] == "ws" else None
+        if session is None or "sec-websocket-key" not in headers:
+            write_http_response(writer=writer, status=404, body={"error": "Game not found"}, keep_alive=False)
+            await writer.drain()
+            return
+
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WEBSOCKET_GUID).encode()).digest()).decode()
+        writer.write(
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode()
+        )
+        write_websocket_message(writer=writer, message=json.dumps(session_summary(session=session)))
+        await writer.drain()
+
+        # Opcode and payloads of the frames of a fragmented message, until its final frame
+        fragments = None
+        while True:
+            final, opcode, payload = await read_websocket_frame(reader=reader)
+            if opcode in (0x0, 0x1, 0x2) and (opcode == 0x0) != (fragments is not None):
+                # A continuation without a message to continue, or a new message before the last one is finished
+                await close_websocket(writer=writer, status=CLOSE_PROTOCOL_ERROR)
+                return
+            if opcode == 0x0 or (opcode in (0x1, 0x2) and not final):
+                # Frame of a fragmented message
+                if fragments is None:
+                    fragments = (opcode, [])
+                fragments[1].append(payload)
+                if sum(len(fragment) for fragment in fragments[1]) > MAX_BODY_SIZE:
+                    await close_websocket(writer=writer, status=CLOSE_TOO_BIG)
+                    return
+                if not final:
+                    continue
+                opcode, payload = fragments[0], b"".join(fragments[1])
+                fragments = None
+
+            if opcode == 0x8:
+                # Close
+                write_websocket_frame(writer=writer, opcode=0x8, payload=payload[:2])
+                await writer.drain()
+                return
+            elif opcode == 0x9:
+                # Ping
+                write_websocket_frame(writer=writer, opcode=0xA, payload=payload)
+            elif opcode == 0x1:
+                # Text message containing a move
+                try:
+                    move_input = payload.decode().strip()
+                except UnicodeDecodeError:
+                    await close_websocket(writer=writer, status=CLOSE_INVALID_DATA)
+                    return
+                if self.store.get(session["id"]) is None:
+                    response = {"error": "Game not found"}
+                else:
+                    _, response = await self.play_move(session=session, move_input=move_input)
+                write_websocket_message(writer=writer, message=json.dumps(response))
+            await writer.drain()
+
+    async def evict_idle_periodically(self, interval: float = 60):
+        """
+        Removes idle games from the session store every interval seconds
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self.store.evict_idle()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000, snapshot_path: Optional[str] = None):
+        """
+        Runs the server until it is cancelled (or receives SIGTERM)
+        If a snapshot path is given, games are loaded from it on start and all games are saved to it on shutdown
+        """
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            self.store.load_snapshot(path=snapshot_path)
+
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+        eviction_task = asyncio.create_task(self.evict_idle_periodically())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            eviction_task.cancel()
+            self.executor.shutdown(cancel_futures=True)
+            if snapshot_path is not None:
+                self.store.save_snapshot(path=snapshot_path)
+
+
+async def read_http_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict, Optional[bytes]]]:
+    """
+    Reads a HTTP request from the connection
+    Returns the method, path, headers (with lowercase names) and body (None if it is too large),
+    or None if the connection was closed
+    Raises ValueError if the request is malformed
+    """
+    request_line = await reader.readline()
+    if request_line == b"":
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, value = line.decode("latin-1").split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get("content-length", 0))
+    if length < 0:
+        raise ValueError(f"Invalid content length: {length}")
+    if length > MAX_BODY_SIZE:
+        return method, path, headers, None
+    body = await reader.readexactly(length) if length > 0 else b""
+    return method, path, headers, body
+
+def write_http_response(writer: asyncio.StreamWriter, status: int, body: Dict, keep_alive: bool = True):
+    """
+    Writes a JSON HTTP response to the connection
+    """
+    encoded_body = json.dumps(body).encode()
+    writer.write(
+        f"HTTP/1.1 {status} {STATUS_MESSAGES[status]}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(encoded_body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + encoded_body
+    )
+
+async def read_websocket_frame(reader: asyncio.StreamReader) -> Tuple[bool, int, bytes]:
+    """
+    Reads a WebSocket frame (see https://www.rfc-editor.org/rfc/rfc6455#section-5.2)
+    Returns whether it is the final frame of its message, the opcode and the unmasked payload
+    """
+    first_byte, second_byte = await reader.readexactly(2)
+    final = bool(first_byte & 0x80)
+    opcode = first_byte & 0x0F
+    length = second_byte & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    if length > MAX_BODY_SIZE:
+        # Treat oversized messages as the client closing the connection
+        return True, 0x8, b""
+
+    mask = await reader.readexactly(4) if second_byte & 0x80 else b"\x00\x00\x00\x00"
+    payload = await reader.readexactly(length)
+    return final, opcode, bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+def write_websocket_frame(writer: asyncio.StreamWriter, opcode: int, payload: bytes):
+    """
+    Writes an unmasked WebSocket frame
+    """
+    if len(payload) < 126:
+        header = struct.pack("!BB", 0x80 | opcode, len(payload))
+    elif len(payload) < 2 ** 16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, len(payload))
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, len(payload))
+    writer.write(header + payload)
+
+async def close_websocket(writer: asyncio.StreamWriter, status: int):
+    """
+    Closes a WebSocket with a status code, e.g. CLOSE_INVALID_DATA
+    """
+    write_websocket_frame(writer=writer, opcode=0x8, payload=struct.pack("!H", status))
+    await writer.drain()
+
+def write_websocket_message(writer: asyncio.StreamWriter, message: str):
+    """
+    Writes a WebSocket text message
+    """
+    write_websocket_frame(writer=writer, opcode=0x1, payload=message.encode())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve Chess games over HTTP and WebSockets")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=None, help="number of engine worker processes")
+    parser.add_argument("--max-idle", type=float, default=3600, help="seconds before an idle game is removed")
+    parser.add_argument("--snapshot", default=None, help="snapshot file the games are loaded from and saved to")
+    parser.add_argument("--book", default=None, help="opening book used by the engine")
+    parser.add_argument("--tablebases", default=None, help="directory of endgame tablebases")
+    parser.add_argument("--cache", default=None, help="SQLite file of the analysis cache")
+    args = parser.parse_args()
+
+    game_server = GameServer(
+        store=SessionStore(max_idle_seconds=args.max_idle),
+        workers=args.workers,
+        book_path=args.book,
+        tablebase_directory=args.tablebases,
+        cache_path=args.cache,
+    )
+    try:
+        asyncio.run(game_server.serve(host=args.host, port=args.port, snapshot_path=args.snapshot))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
@@ -0,0 +1,301 @@
+"""
+Compact binary snapshots of game states.
+
+A game record holds the current position and the move history as packed moves:
+- header: version, turn, result, next id, number of pieces on the board, number of taken pieces,
+  number of moves and number of positions recorded
+- each piece (on the board, then taken): id, square (row * 8 + col) and a code for its type, side and whether it has moved
+- each move: a 32 bit integer (see pack_move)
+- metadata: length-prefixed JSON (used to store extra information such as the engine settings of a game)
+
+The earlier positions (used for draw by repetition) aren't stored: they are rebuilt by undoing the moves from the current position.
+
+A snapshot file holds many game records followed by an index of (key, offset, length) sorted by key,
+so a single game can be loaded by memory-mapping the file and binary searching the index.
+"""
+import pieces, moves
+from typing import Dict, Iterable, List, Optional, Tuple
+import json
+import mmap
+import os
+import struct
+
+
+RECORD_VERSION = 1
+FILE_VERSION = 1
+FILE_MAGIC = b"CHSN"
+
+RECORD_HEADER = struct.Struct("<BBBHBBHH")
+PIECE_RECORD = struct.Struct("<BBB")
+MOVE_RECORD = struct.Struct("<I")
+METADATA_LENGTH = struct.Struct("<H")
+FILE_HEADER = struct.Struct("<4sHIQ")
+INDEX_ENTRY = struct.Struct("<32sQI")
+
+PIECE_TYPES = [pieces.PAWN, pieces.KNIGHT, pieces.BISHOP, pieces.ROOK, pieces.QUEEN, pieces.KING]
+PIECE_CLASSES = {
+    pieces.PAWN: pieces.Pawn,
+    pieces.KNIGHT: pieces.Knight,
+    pieces.BISHOP: pieces.Bishop,
+    pieces.ROOK: pieces.Rook,
+    pieces.QUEEN: pieces.Queen,
+    pieces.KING: pieces.King,
+}
+PROMOTION_PIECES = [None, pieces.KNIGHT, pieces.BISHOP, pieces.ROOK, pieces.QUEEN]
+RESULTS = [0, 1, 0.5, None]
+
+
+def pack_piece(piece: pieces.Piece) -> bytes:
+    """
+    Packs a piece into 3 bytes: id, square and code (type in bits 0-2, side in bit 3, has moved in bit 4)
+    """
+    code = PIECE_TYPES.index(str(piece).upper()) | piece.side << 3 | int(getattr(piece, "has_moved", False)) << 4
+    return PIECE_RECORD.pack(piece.id, piece.row * 8 + piece.col, code)
+
+def unpack_piece(id: int, square: int, code: int) -> pieces.Piece:
+    """
+    Creates the piece instance from its packed fields
+    """
+    piece_obj = PIECE_CLASSES[PIECE_TYPES[code & 0x7]](id=id, row=square // 8, col=square % 8, side=(code >> 3) & 1)
+    if code >> 4 & 1:
+        piece_obj.has_moved = True
+    return piece_obj
+
+def pack_move(move: moves.Move) -> int:
+    """
+    Packs a move into a 32 bit integer:
+    - bits 0-5: start square, bits 6-11: end square
+    - bits 12-14: promotion piece (0 for none)
+    - bit 15: castling move, bit 16: piece taken
+    - bits 17-24: id of the piece taken, or of the rook for castling moves
+    The id of the piece moved isn't stored as it is found on the board when the moves are rebuilt.
+    NOTE: the rook move of castling is recorded in the moves as a move of its own, so only its id is kept with the king move
+    """
+    other_id = 0
+    if move.piece_taken is not None:
+        other_id = move.piece_taken
+    elif move.castling_move is not None:
+        other_id = move.castling_move.piece_id
+
+    return (
+        move.start_row * 8 + move.start_col
+        | (move.end_row * 8 + move.end_col) << 6
+        | PROMOTION_PIECES.index(move.promotion_piece) << 12
+        | int(move.castling_move is not None) << 15
+        | int(move.piece_taken is not None) << 16
+        | other_id << 17
+    )
+
+def pack_state(state: Dict, metadata: Optional[Dict] = None) -> bytes:
+    """
+    Packs a game state (8x8 board) into a game record
+    Arguments:
+    - state: game state
+    - metadata: JSON-serialisable Dict stored alongside the game
+    Returns: the game record
+    """
+    if state["next_id"] > 256:
+        raise Exception("Snapshots only support up to 256 pieces")
+
+    encoded_metadata = json.dumps(metadata if metadata is not None else {}).encode()
+    record = [RECORD_HEADER.pack(
+        RECORD_VERSION,
+        state["turn"],
+        RESULTS.index(state["result"]),
+        state["next_id"],
+        len(state["pieces_params"]),
+        len(state["pieces_taken_params"]),
+        len(state["moves"]),
+        len(state["positions"]),
+    )]
+    record += [pack_piece(piece=piece) for piece in state["pieces_params"].values()]
+    record += [pack_piece(piece=piece) for piece in state["pieces_taken_params"].values()]
+    record += [MOVE_RECORD.pack(pack_move(move=move)) for move in state["moves"]]
+    record += [METADATA_LENGTH.pack(len(encoded_metadata)), encoded_metadata]
+    return b"".join(record)
+
+def squares_to_fen(board: List[Optional[int]], types: Dict[int, str]) -> str:
+    """
+    Converts a flat board of piece ids to FEN notation (same as game.board_to_fen)
+    """
+    fen = ""
+    for row in range(8):
+        spaces = 0
+        for square in board[row * 8:row * 8 + 8]:
+            if square is not None:
+                if spaces > 0:
+                    fen += str(spaces)
+                    spaces = 0
+                fen += types[square]
+            else:
+                spaces += 1
+        if spaces > 0:
+            fen += str(spaces)
+        fen += "/"
+    return fen[:-1]
+
+def unpack_state(record: bytes) -> Tuple[Dict, Dict]:
+    """
+    Rebuilds a game state from a game record. The moves are undone on a flat board to rebuild
+    the Move objects and the positions, so no moves are replayed.
+    Returns: the game state and its metadata
+    """
+    version, turn, result, next_id, live_count, taken_count, move_count, position_count = RECORD_HEADER.unpack_from(record, 0)
+    if version != RECORD_VERSION:
+        raise Exception(f"Unsupported snapshot record version: {version}")
+    offset = RECORD_HEADER.size
+
+    state = {
+        "board": [[None for _ in range(8)] for _ in range(8)],
+        "pieces_params": {},
+        "pieces_taken_params": {},
+        "next_id": next_id,
+        "result": RESULTS[result],
+        "moves": [],
+        "positions": [],
+        "turn": turn,
+    }
+
+    # Flat board of ids and the piece strings (e.g. "P", "n") used for the FEN of each position
+    board = [None] * 64
+    types = {}
+    taken_squares = {}
+    for index in range(live_count + taken_count):
+        id, square, code = PIECE_RECORD.unpack_from(record, offset)
+        offset += PIECE_RECORD.size
+        piece_obj = unpack_piece(id=id, square=square, code=code)
+        types[id] = str(piece_obj)
+        if index < live_count:
+            board[square] = id
+            state["board"][piece_obj.row][piece_obj.col] = id
+            state["pieces_params"][id] = piece_obj
+        else:
+            taken_squares[id] = square
+            state["pieces_taken_params"][id] = piece_obj
+
+    packed_moves = [packed for (packed,) in MOVE_RECORD.iter_unpack(record[offset:offset + move_count * MOVE_RECORD.size])]
+    offset += move_count * MOVE_RECORD.size
+    (metadata_length,) = METADATA_LENGTH.unpack_from(record, offset)
+    offset += METADATA_LENGTH.size
+    metadata = json.loads(record[offset:offset + metadata_length])
+
+    # Undo the moves from the last to the first.
+    # NOTE: castling is recorded as the king move followed by the rook move, so the rook move is undone on its own
+    # and the position is only recorded once both have been undone.
+    fens = [squares_to_fen(board=board, types=types)]
+    for index in range(move_count - 1, -1, -1):
+        packed = packed_moves[index]
+        start = packed & 0x3F
+        end = packed >> 6 & 0x3F
+        promotion_piece = PROMOTION_PIECES[packed >> 12 & 0x7]
+        other_id = packed >> 17 & 0xFF
+        piece_id = board[end]
+
+        castling_move = None
+        if packed >> 15 & 1 and index + 1 < move_count:
+            castling_move = state["moves"][-1]
+
+        board[start] = piece_id
+        board[end] = None
+        if promotion_piece is not None:
+            types[piece_id] = pieces.PAWN if types[piece_id].isupper() else pieces.PAWN.lower()
+        piece_taken = None
+        if packed >> 16 & 1:
+            piece_taken = other_id
+            board[taken_squares[other_id]] = other_id
+
+        state["moves"].append(moves.Move(
+            piece_id=piece_id,
+            start_row=start // 8,
+            start_col=start % 8,
+            end_row=end // 8,
+            end_col=end % 8,
+            piece_taken=piece_taken,
+            promotion_piece=promotion_piece,
+            castling_move=castling_move,
+        ))
+        if index == 0 or not packed_moves[index - 1] >> 15 & 1:
+            fens.append(squares_to_fen(board=board, types=types))
+
+    state["moves"].reverse()
+    fens.reverse()
+    state["positions"] = fens[len(fens) - position_count:] if position_count > 0 else []
+
+    return state, metadata
+
+
+def save_games(path: str, games: Iterable[Tuple[str, Dict, Optional[Dict]]]):
+    """
+    Saves many games to one snapshot file. The file is replaced atomically.
+    Arguments:
+    - path: path of the snapshot file
+    - games: (key, state, metadata) for each game, where the key is a string of up to 32 bytes
+    """
+    index = []
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, 0, 0))
+        offset = FILE_HEADER.size
+        for key, state, metadata in games:
+            encoded_key = key.encode()
+            if len(encoded_key) > 32:
+                raise Exception(f"Snapshot key is too long: {key}")
+            record = pack_state(state=state, metadata=metadata)
+            file.write(record)
+            index.append((encoded_key, offset, len(record)))
+            offset += len(record)
+
+        # Write the index sorted by key (for binary search) and then the real header
+        index.sort()
+        file.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in index))
+        file.seek(0)
+        file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, len(index), offset))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+def read_header(data) -> Tuple[int, int]:
+    """
+    Reads the header of a snapshot file
+    Returns: the number of games and the offset of the index
+    """
+    magic, version, count, index_offset = FILE_HEADER.unpack_from(data, 0)
+    if magic != FILE_MAGIC:
+        raise Exception("Not a snapshot file")
+    if version != FILE_VERSION:
+        raise Exception(f"Unsupported snapshot file version: {version}")
+    return count, index_offset
+
+def load_games(path: str) -> List[Tuple[str, Dict, Dict]]:
+    """
+    Loads all the games from a snapshot file
+    Returns: (key, state, metadata) for each game
+    """
+    games = []
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        count, index_offset = read_header(data=data)
+        for i in range(count):
+            key, offset, length = INDEX_ENTRY.unpack_from(data, index_offset + i * INDEX_ENTRY.size)
+            state, metadata = unpack_state(record=data[offset:offset + length])
+            games.append((key.rstrip(b"\x00").decode(), state, metadata))
+    return games
+
+def load_game(path: str, key: str) -> Optional[Tuple[Dict, Dict]]:
+    """
+    Loads a single game from a snapshot file by binary searching the index
+    Returns: the game state and its metadata, or None if the game isn't in the file
+    """
+    encoded_key = key.encode().ljust(32, b"\x00")
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        count, index_offset = read_header(data=data)
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            middle_key, offset, length = INDEX_ENTRY.unpack_from(data, index_offset + middle * INDEX_ENTRY.size)
+            if middle_key < encoded_key:
+                low = middle + 1
+            elif middle_key > encoded_key:
+                high = middle
+            else:
+                return unpack_state(record=data[offset:offset + length])
+    return None
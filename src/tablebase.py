@@ -0,0 +1,514 @@
+"""
+Endgame tablebases for small numbers of pieces (e.g. KQvK, KRvK, KPvK, KBNvK), generated by retrograde analysis
+using the rules in pieces and moves.
+
+A table has one byte for every position of its material, giving the result with best play from the
+point of view of the side to move:
+- 0: draw
+- 1 to 254: the side to move wins or loses, with (byte - 1) plies until mate. An odd number of plies is a win
+  and an even number of plies is a loss (1 is being checkmated).
+- 255: the position is not valid (e.g. two pieces on the same square or the side not to move in check)
+
+Positions are indexed by the side to move, the square of the white king (reduced by symmetry) and the squares of the
+other pieces. Tables are written to "<signature>.tb" files which are probed through mmap.
+NOTE: castling and en passant are never possible in the tables, so positions with those rights aren't probed
+"""
+import pieces, moves, snapshot, zobrist, parallel
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from itertools import chain
+import argparse
+import mmap
+import os
+import struct
+
+FILE_MAGIC = b"CHTB"
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct("<4sB16s")
+
+MAX_PIECES = 4
+DRAW = 0
+INVALID = 255
+MAX_PLIES = 253
+# Order of the pieces of each side in a signature
+PIECE_ORDER = "KQRBNP"
+PROMOTION_PIECES = [pieces.QUEEN, pieces.ROOK, pieces.BISHOP, pieces.KNIGHT]
+STRAIGHT_DIRECTIONS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+DIAGONAL_DIRECTIONS = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+KNIGHT_OFFSETS = [(-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)]
+# Moves of each piece other than pawns: (row offset, col offset) of each step and whether it can take several steps
+PIECE_STEPS = {
+    pieces.KING: (STRAIGHT_DIRECTIONS + DIAGONAL_DIRECTIONS, False),
+    pieces.QUEEN: (STRAIGHT_DIRECTIONS + DIAGONAL_DIRECTIONS, True),
+    pieces.ROOK: (STRAIGHT_DIRECTIONS, True),
+    pieces.BISHOP: (DIAGONAL_DIRECTIONS, True),
+    pieces.KNIGHT: (KNIGHT_OFFSETS, False),
+}
+
+
+def make_transforms() -> Tuple[List[List[int]], List[List[int]]]:
+    """
+    Creates the symmetries of the board as tables mapping each square (row * 8 + col) to its image
+    Returns the 8 symmetries (used without pawns) and the 2 left-right symmetries (used with pawns)
+    """
+    all_transforms = []
+    for swap in [False, True]:
+        for flip_rows in [False, True]:
+            for flip_cols in [False, True]:
+                transform = []
+                for square in range(64):
+                    row, col = square // 8, square % 8
+                    if swap:
+                        row, col = col, row
+                    if flip_rows:
+                        row = 7 - row
+                    if flip_cols:
+                        col = 7 - col
+                    transform.append(row * 8 + col)
+                all_transforms.append(transform)
+    pawn_transforms = [all_transforms[0], all_transforms[1]]
+    return all_transforms, pawn_transforms
+
+TRANSFORMS, PAWN_TRANSFORMS = make_transforms()
+# Squares the white king is moved to by symmetry: the a1-d1-d4 triangle without pawns and the a-d files with pawns
+KING_SQUARES = [row * 8 + col for row in range(4, 8) for col in range(4) if col >= 7 - row]
+PAWN_KING_SQUARES = [row * 8 + col for row in range(8) for col in range(4)]
+
+
+def parse_signature(signature: str) -> Tuple[str, str]:
+    """
+    Splits a signature (e.g. "KQvK") into the pieces of each side, sorted (e.g. ("KQ", "K"))
+    """
+    white, black = signature.upper().split("V")
+    white = "".join(sorted(white, key=PIECE_ORDER.index))
+    black = "".join(sorted(black, key=PIECE_ORDER.index))
+    if white[:1] != pieces.KING or black[:1] != pieces.KING or white.count(pieces.KING) != 1 or black.count(pieces.KING) != 1:
+        raise Exception(f"Invalid tablebase signature: {signature}")
+    if len(white) + len(black) > MAX_PIECES:
+        raise Exception(f"Tablebases only support up to {MAX_PIECES} pieces: {signature}")
+    return white, black
+
+def make_signature(white: str, black: str) -> str:
+    """
+    Creates the signature of the pieces of each side (e.g. "KQvK")
+    """
+    return "".join(sorted(white, key=PIECE_ORDER.index)) + "v" + "".join(sorted(black, key=PIECE_ORDER.index))
+
+def is_insufficient(white: str, black: str) -> bool:
+    """
+    Checks if the material is a draw by insufficient material (as in game.draw_by_insufficient_material)
+    """
+    others = (white + black).replace(pieces.KING, "")
+    return others in ["", pieces.BISHOP, pieces.KNIGHT]
+
+def get_dependencies(signature: str) -> List[str]:
+    """
+    Gets the signatures reached by captures and promotions, which must be generated first
+    """
+    white, black = parse_signature(signature=signature)
+    dependencies = []
+    for side_pieces, other_pieces, is_white in [(white, black, True), (black, white, False)]:
+        for index, piece in enumerate(side_pieces):
+            if piece == pieces.KING:
+                continue
+            remaining = side_pieces[:index] + side_pieces[index + 1:]
+            reduced = [remaining]
+            if piece == pieces.PAWN:
+                reduced += [remaining + promotion_piece for promotion_piece in PROMOTION_PIECES]
+            for new_pieces in reduced:
+                new_white, new_black = (new_pieces, other_pieces) if is_white else (other_pieces, new_pieces)
+                if not is_insufficient(white=new_white, black=new_black):
+                    dependency = make_signature(white=new_white, black=new_black)
+                    if dependency not in dependencies and dependency != signature:
+                        dependencies.append(dependency)
+    return dependencies
+
+def get_layout(signature: str) -> List[Tuple[str, int]]:
+    """
+    Gets the (piece, side) of each piece in index order: white king, other white pieces, black king, other black pieces
+    """
+    white, black = parse_signature(signature=signature)
+    return [(piece, 0) for piece in white] + [(piece, 1) for piece in black]
+
+def table_size(signature: str) -> int:
+    """
+    Gets the number of positions in the table of a signature
+    """
+    layout = get_layout(signature=signature)
+    king_squares = PAWN_KING_SQUARES if pieces.PAWN in signature.upper() else KING_SQUARES
+    return 2 * len(king_squares) * 64 ** (len(layout) - 1)
+
+def position_index(squares: List[int], turn: int, has_pawns: bool) -> int:
+    """
+    Gets the index of a position from the squares of the pieces (in layout order) and the side to move
+    The position is first moved by symmetry so the white king is on one of the indexed squares
+    """
+    transforms, king_squares = (PAWN_TRANSFORMS, PAWN_KING_SQUARES) if has_pawns else (TRANSFORMS, KING_SQUARES)
+    for transform in transforms:
+        if transform[squares[0]] in king_squares:
+            index = turn * len(king_squares) + king_squares.index(transform[squares[0]])
+            for square in squares[1:]:
+                index = index * 64 + transform[square]
+            return index
+    raise Exception("No symmetry found for the white king")
+
+def index_to_position(index: int, length: int, has_pawns: bool) -> Tuple[List[int], int]:
+    """
+    Gets the squares of the pieces (in layout order) and the side to move from an index
+    """
+    squares = []
+    for _ in range(length - 1):
+        squares.append(index % 64)
+        index //= 64
+    king_squares = PAWN_KING_SQUARES if has_pawns else KING_SQUARES
+    squares.append(king_squares[index % len(king_squares)])
+    turn = index // len(king_squares)
+    squares.reverse()
+    return squares, turn
+
+def make_state(layout: List[Tuple[str, int]], squares: List[int], turn: int) -> Dict:
+    """
+    Creates a game state with the pieces of the layout on the given squares (kings can't castle)
+    """
+    state = {
+        "board": [[None for _ in range(8)] for _ in range(8)],
+        "pieces_params": {},
+        "pieces_taken_params": {},
+        "next_id": len(layout),
+        "result": None,
+        "moves": [],
+        "positions": [],
+        "turn": turn,
+    }
+    for id, ((piece, side), square) in enumerate(zip(layout, squares)):
+        piece_obj = snapshot.PIECE_CLASSES[piece](id=id, row=square // 8, col=square % 8, side=side)
+        if piece == pieces.KING:
+            piece_obj.has_moved = True
+        state["board"][piece_obj.row][piece_obj.col] = id
+        state["pieces_params"][id] = piece_obj
+    return state
+
+
+class Tablebases(parallel.FileBacked):
+    # Only the directory is pickled, and the tables are mapped again when probed
+    pickled_arguments = ["directory"]
+
+    def __init__(self, directory: str) -> None:
+        """
+        Collection of the tablebases in a directory, which are memory-mapped when first probed
+        """
+        self.directory = directory
+        self.tables = {}
+
+    def get_table(self, signature: str) -> Optional[mmap.mmap]:
+        """
+        Gets the memory-mapped table of a signature (None if it hasn't been generated)
+        """
+        if signature not in self.tables:
+            path = os.path.join(self.directory, signature + ".tb")
+            if not os.path.exists(path):
+                self.tables[signature] = None
+            else:
+                with open(path, "rb") as file:
+                    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, version, _ = FILE_HEADER.unpack_from(data, 0)
+                if magic != FILE_MAGIC or version != FILE_VERSION:
+                    raise Exception(f"Invalid tablebase file: {path}")
+                self.tables[signature] = data
+        return self.tables[signature]
+
+    def probe_squares(self, white: List[Tuple[str, int]], black: List[Tuple[str, int]], turn: int) -> Optional[int]:
+        """
+        Probes a position given by the (piece, square) of each side's pieces
+        Returns the value from the point of view of the side to move (see the top of this file), or None if there is no table
+        """
+        white_pieces = "".join(piece for piece, _ in white)
+        black_pieces = "".join(piece for piece, _ in black)
+        if is_insufficient(white=white_pieces, black=black_pieces):
+            return DRAW
+
+        for flipped in [False, True]:
+            if flipped:
+                # Swap the colours: black becomes white with the board mirrored top to bottom
+                white, black = [(piece, 56 ^ square) for piece, square in black], [(piece, 56 ^ square) for piece, square in white]
+                turn = 1 - turn
+            signature = make_signature(white="".join(piece for piece, _ in white), black="".join(piece for piece, _ in black))
+            table = self.get_table(signature=signature)
+            if table is not None:
+                squares = [square for _, square in sorted(white, key=lambda item: PIECE_ORDER.index(item[0]))]
+                squares += [square for _, square in sorted(black, key=lambda item: PIECE_ORDER.index(item[0]))]
+                index = position_index(squares=squares, turn=turn, has_pawns=pieces.PAWN in signature)
+                return table[FILE_HEADER.size + index]
+        return None
+
+    def probe(self, state: Dict) -> Optional[int]:
+        """
+        Probes the position of a game state
+        Returns the value from the point of view of the side to move (see the top of this file),
+        or None if the position isn't covered by the tablebases
+        """
+        if len(state["pieces_params"]) > MAX_PIECES:
+            return None
+        # Castling and en passant aren't in the tables
+        if zobrist.castling_rights(state=state) != 0 or zobrist.en_passant_file(state=state) >= 0:
+            return None
+
+        white = []
+        black = []
+        for piece in state["pieces_params"].values():
+            (white if piece.side == 0 else black).append((str(piece).upper(), piece.row * 8 + piece.col))
+
+        value = self.probe_squares(white=white, black=black, turn=state["turn"])
+        return value if value != INVALID else None
+
+
+def value_to_plies(value: int) -> int:
+    """
+    Gets the number of plies until mate of a win or loss value
+    """
+    return value - 1
+
+def is_win(value: int) -> bool:
+    """
+    Checks if a value is a win for the side to move
+    """
+    return value != DRAW and value != INVALID and value_to_plies(value=value) % 2 == 1
+
+
+def analyse_positions(signature: str, start: int, end: int, directory: str) -> List[Tuple]:
+    """
+    Generates the moves of the positions from index start to end (run in worker processes)
+    Returns for each position either (value,) for positions which are invalid or have no moves,
+    or (successor_count, external_values) where successor_count is the number of moves to positions in the same table
+    and external_values are the values (for the opponent) of positions reached by captures and promotions
+    """
+    layout = get_layout(signature=signature)
+    has_pawns = pieces.PAWN in signature
+    tablebases = Tablebases(directory=directory)
+    results = []
+
+    for index in range(start, end):
+        squares, turn = index_to_position(index=index, length=len(layout), has_pawns=has_pawns)
+
+        # Check that the position is valid
+        if len(set(squares)) < len(squares) or any(piece == pieces.PAWN and square // 8 in (0, 7) for (piece, _), square in zip(layout, squares)):
+            results.append((INVALID,))
+            continue
+        state = make_state(layout=layout, squares=squares, turn=turn)
+        if pieces.in_check(state=state, side=1 - turn):
+            results.append((INVALID,))
+            continue
+
+        move_list = moves.get_all_possible_moves(state=state, side=turn)
+        if len(move_list) == 0:
+            if pieces.in_check(state=state, side=turn):
+                # Checkmated
+                results.append((1,))
+            else:
+                # Stalemate
+                results.append((DRAW,))
+            continue
+
+        successor_count = 0
+        external_values = []
+        for move in move_list:
+            if move.piece_taken is None and move.promotion_piece is None:
+                successor_count += 1
+                continue
+
+            # The move changes the material, so probe the position in another table
+            new_squares = list(squares)
+            new_squares[move.piece_id] = move.end_row * 8 + move.end_col
+            white = []
+            black = []
+            for id, ((piece, side), square) in enumerate(zip(layout, new_squares)):
+                if id == move.piece_taken:
+                    continue
+                if id == move.piece_id and move.promotion_piece is not None:
+                    piece = move.promotion_piece
+                (white if side == 0 else black).append((piece, square))
+            value = tablebases.probe_squares(white=white, black=black, turn=1 - turn)
+            if value is None:
+                raise Exception(f"Missing tablebase for a position reached from {signature}")
+            external_values.append(value)
+        results.append((successor_count, external_values))
+
+    return results
+
+def unmove_squares(layout: List[Tuple[str, int]], squares: List[int], side: int) -> Iterator[List[int]]:
+    """
+    Generates the squares of the pieces before each quiet move (neither a capture nor a promotion) of side
+    which leads to the given squares. Whether the moves were legal isn't checked.
+    """
+    occupied = set(squares)
+    for id, ((piece, piece_side), square) in enumerate(zip(layout, squares)):
+        if piece_side != side:
+            continue
+        row, col = square // 8, square % 8
+        origins = []
+        if piece == pieces.PAWN:
+            # White pawns move up the board (towards row 0) and black pawns down, so take the move back the other way
+            direction, start_row = (-1, 6) if side == 0 else (1, 1)
+            if 1 <= row - direction <= 6 and (row - direction) * 8 + col not in occupied:
+                origins.append((row - direction) * 8 + col)
+                if row == start_row + 2 * direction and start_row * 8 + col not in occupied:
+                    origins.append(start_row * 8 + col)
+        else:
+            steps, slides = PIECE_STEPS[piece]
+            for row_offset, col_offset in steps:
+                origin_row, origin_col = row + row_offset, col + col_offset
+                while 0 <= origin_row < 8 and 0 <= origin_col < 8 and origin_row * 8 + origin_col not in occupied:
+                    origins.append(origin_row * 8 + origin_col)
+                    if not slides:
+                        break
+                    origin_row, origin_col = origin_row + row_offset, origin_col + col_offset
+        for origin in origins:
+            new_squares = list(squares)
+            new_squares[id] = origin
+            yield new_squares
+
+def find_predecessors(signature: str, indexes: List[int]) -> List[List[int]]:
+    """
+    Finds the positions of the table which have a quiet move to each of the given positions (run in worker processes)
+    Returns for each position the indexes of its predecessors, once for every such move, as counted by analyse_positions
+    (only the positions the white king is indexed from are counted: the others aren't in the table).
+    Whether the predecessors are valid isn't checked, but they always are for valid positions.
+    """
+    layout = get_layout(signature=signature)
+    has_pawns = pieces.PAWN in signature
+    transforms, king_squares = (PAWN_TRANSFORMS, PAWN_KING_SQUARES) if has_pawns else (TRANSFORMS, KING_SQUARES)
+    results = []
+
+    for index in indexes:
+        squares, turn = index_to_position(index=index, length=len(layout), has_pawns=has_pawns)
+        # Moves can lead to any symmetry of the position which has the same index
+        images = []
+        for transform in transforms:
+            image = [transform[square] for square in squares]
+            if image not in images and position_index(squares=image, turn=turn, has_pawns=has_pawns) == index:
+                images.append(image)
+
+        predecessors = []
+        for image in images:
+            for previous_squares in unmove_squares(layout=layout, squares=image, side=1 - turn):
+                if previous_squares[0] in king_squares:
+                    predecessors.append(position_index(squares=previous_squares, turn=1 - turn, has_pawns=has_pawns))
+        results.append(predecessors)
+
+    return results
+
+def generate(signature: str, directory: str, workers: Optional[int] = None, chunk_size: int = 2048) -> str:
+    """
+    Generates the tablebase of a signature (and the tablebases it depends on, if they don't exist yet)
+    The moves of all positions are counted in a pool of worker processes, then the results are found by
+    working backwards from the checkmates, one ply at a time, taking moves back to find the predecessors
+    of the positions resolved at each ply (also in the pool), so that they are never stored.
+    Arguments:
+    - signature: pieces of each side (e.g. "KQvK")
+    - directory: directory the tablebase files are written to
+    - workers: number of worker processes (defaults to the number of CPUs)
+    - chunk_size: number of positions analysed by a worker at a time
+    Returns: path of the tablebase file
+    """
+    white, black = parse_signature(signature=signature)
+    signature = make_signature(white=white, black=black)
+    os.makedirs(directory, exist_ok=True)
+    tablebases = Tablebases(directory=directory)
+    for dependency in get_dependencies(signature=signature):
+        dependency_white, dependency_black = parse_signature(signature=dependency)
+        if tablebases.get_table(signature=dependency) is None and tablebases.get_table(signature=make_signature(white=dependency_black, black=dependency_white)) is None:
+            generate(signature=dependency, directory=directory, workers=workers, chunk_size=chunk_size)
+
+    size = table_size(signature=signature)
+    values = bytearray(size)
+    resolved = bytearray(size)
+    # Number of successors which aren't known to be wins for the opponent, and the longest of those wins
+    remaining = array("i", bytes(4 * size))
+    longest_win = array("i", bytes(4 * size))
+    # Positions to resolve after each number of plies, as 2 * index + 1 for wins and 2 * index for losses
+    levels = [array("I") for _ in range(MAX_PLIES + 2)]
+    max_pending = 2 * (workers or os.cpu_count() or 1)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        tasks = (
+            (analyse_positions, {"signature": signature, "start": start, "end": min(start + chunk_size, size), "directory": directory})
+            for start in range(0, size, chunk_size)
+        )
+        index = 0
+        for chunk in parallel.map_ordered(executor=executor, tasks=tasks, max_pending=max_pending):
+            for result in chunk:
+                if len(result) == 1:
+                    values[index] = result[0]
+                    if result[0] == 1:
+                        levels[0].append(2 * index)
+                    else:
+                        resolved[index] = 1
+                else:
+                    count, external_values = result
+                    for value in external_values:
+                        if value == DRAW:
+                            # Can't be a loss, so never reaches 0
+                            count += 1
+                        elif is_win(value=value):
+                            longest_win[index] = max(longest_win[index], value_to_plies(value=value))
+                        elif value_to_plies(value=value) < MAX_PLIES:
+                            levels[value_to_plies(value=value) + 1].append(2 * index + 1)
+                    remaining[index] = count
+                    if count == 0:
+                        levels[longest_win[index] + 1].append(2 * index)
+                index += 1
+
+        # Work backwards from the checkmates
+        for plies, level in enumerate(levels):
+            if plies > MAX_PLIES:
+                break
+            # Positions are resolved by their first entry, and the predecessors are only needed for those
+            entries = array("I")
+            for entry in level:
+                index = entry // 2
+                if resolved[index]:
+                    continue
+                resolved[index] = 1
+                values[index] = plies + 1
+                entries.append(entry)
+            del level[:]
+
+            tasks = (
+                (find_predecessors, {"signature": signature, "indexes": [entry // 2 for entry in chunk]})
+                for chunk in parallel.chunks(entries, chunk_size)
+            )
+            results = chain.from_iterable(parallel.map_ordered(executor=executor, tasks=tasks, max_pending=max_pending))
+            for entry, predecessors in zip(entries, results):
+                win = entry % 2 == 1
+                for predecessor in predecessors:
+                    if resolved[predecessor]:
+                        continue
+                    if not win:
+                        # The predecessor can move to a lost position, so it is won
+                        levels[plies + 1].append(2 * predecessor + 1)
+                    else:
+                        remaining[predecessor] -= 1
+                        longest_win[predecessor] = max(longest_win[predecessor], plies)
+                        if remaining[predecessor] == 0:
+                            # All moves lead to positions won by the opponent
+                            levels[longest_win[predecessor] + 1].append(2 * predecessor)
+
+    path = os.path.join(directory, signature + ".tb")
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, signature.encode()))
+        file.write(values)
+    os.replace(temp_path, path)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate endgame tablebases")
+    parser.add_argument("signatures", nargs="+", help="pieces of each side, e.g. KQvK KRvK KPvK")
+    parser.add_argument("--directory", default="tablebases")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    for signature in args.signatures:
+        print(f"Generated {generate(signature=signature, directory=args.directory, workers=args.workers)}")
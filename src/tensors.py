@@ -0,0 +1,253 @@
+"""
+Export of positions as NumPy arrays for training models. Each position is encoded as:
+- planes: 12 x 8 x 8 uint8 (white pawn, knight, bishop, rook, queen, king, then black, rows from rank 8 like the board)
+- side: side to move (0 for white, 1 for black)
+- castling: castling rights (white kingside, white queenside, black kingside, black queenside)
+- en_passant: file of the en passant square (-1 if there is none)
+- halfmove, fullmove: clocks (the halfmove clock counts plies since the last capture or pawn move)
+
+Positions come from FEN files or from replaying PGN games. They are encoded into preallocated arrays in chunks
+by a pool of worker processes and the chunks are appended in order to one .npy file per array, so memory use
+doesn't depend on the number of positions and the files can be memory-mapped with numpy.load(path, mmap_mode="r").
+"""
+import pgn, pieces, zobrist, parallel
+from typing import Dict, Iterator, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+import struct
+import time
+import numpy as np
+
+PIECE_TYPES = [pieces.PAWN, pieces.KNIGHT, pieces.BISHOP, pieces.ROOK, pieces.QUEEN, pieces.KING]
+# Arrays written for each position: name, type and shape (after the position axis)
+ARRAYS = [
+    ("planes", np.uint8, (12, 8, 8)),
+    ("side", np.uint8, ()),
+    ("castling", np.uint8, (4,)),
+    ("en_passant", np.int8, ()),
+    ("halfmove", np.uint16, ()),
+    ("fullmove", np.uint16, ()),
+]
+DEFAULT_CHUNK_SIZE = 4096
+# Size of the .npy headers, fixed so that the header can be rewritten with the final number of positions
+NPY_HEADER_SIZE = 128
+
+
+def allocate(size: int) -> Dict[str, np.ndarray]:
+    """
+    Allocates the arrays for a chunk of positions
+    """
+    return {name: np.zeros((size,) + shape, dtype=dtype) for name, dtype, shape in ARRAYS}
+
+def trim(arrays: Dict[str, np.ndarray], size: int) -> Dict[str, np.ndarray]:
+    return {name: array[:size] for name, array in arrays.items()}
+
+def encode_fen(arrays: Dict[str, np.ndarray], index: int, fen: str):
+    """
+    Encodes a position in FEN (read directly, without a game state) into the arrays at the given index
+    """
+    fields = fen.split()
+    ranks = fields[0].split("/")
+    if len(ranks) != 8:
+        raise Exception(f"Invalid FEN: {fen}")
+    for row, rank in enumerate(ranks):
+        col = 0
+        for char in rank:
+            if char.isdigit():
+                col += int(char)
+            else:
+                arrays["planes"][index, (0 if char.isupper() else 6) + PIECE_TYPES.index(char.upper()), row, col] = 1
+                col += 1
+
+    arrays["side"][index] = 1 if len(fields) > 1 and fields[1] == "b" else 0
+    castling = fields[2] if len(fields) > 2 else "-"
+    for bit, right in enumerate("KQkq"):
+        arrays["castling"][index, bit] = right in castling
+    en_passant = fields[3] if len(fields) > 3 else "-"
+    arrays["en_passant"][index] = "abcdefgh".index(en_passant[0]) if en_passant != "-" else -1
+    arrays["halfmove"][index] = int(fields[4]) if len(fields) > 4 else 0
+    arrays["fullmove"][index] = int(fields[5]) if len(fields) > 5 else 1
+
+def encode_state(arrays: Dict[str, np.ndarray], index: int, state: Dict, halfmove: int, fullmove: int):
+    """
+    Encodes a game state into the arrays at the given index
+    """
+    for piece in state["pieces_params"].values():
+        arrays["planes"][index, piece.side * 6 + PIECE_TYPES.index(str(piece).upper()), piece.row, piece.col] = 1
+    arrays["side"][index] = state["turn"]
+    rights = zobrist.castling_rights(state=state)
+    for bit in range(4):
+        arrays["castling"][index, bit] = rights >> bit & 1
+    arrays["en_passant"][index] = zobrist.en_passant_file(state=state)
+    arrays["halfmove"][index] = halfmove
+    arrays["fullmove"][index] = fullmove
+
+
+def convert_fens(lines: List[str]) -> Tuple[Dict[str, np.ndarray], int]:
+    """
+    Encodes a chunk of FEN lines (in a worker process)
+    Returns the arrays and the number of invalid lines skipped
+    """
+    arrays = allocate(size=len(lines))
+    size = 0
+    skipped = 0
+    for line in lines:
+        try:
+            encode_fen(arrays=arrays, index=size, fen=line)
+            size += 1
+        except Exception:
+            # Clear the partly encoded position
+            for name in arrays:
+                arrays[name][size] = 0
+            skipped += 1
+    return trim(arrays=arrays, size=size), skipped
+
+def convert_games(pgn_games: List[Dict], skip_plies: int = 0) -> Tuple[Dict[str, np.ndarray], int]:
+    """
+    Encodes the positions of a chunk of games (in a worker process), leaving out the first skip_plies of each game
+    Returns the arrays and the number of games skipped because of invalid moves
+    """
+    arrays = allocate(size=sum(max(len(pgn_game["moves"]) - skip_plies, 0) for pgn_game in pgn_games))
+    size = 0
+    skipped = 0
+    for pgn_game in pgn_games:
+        game_start = size
+        halfmove = 0
+        try:
+            for ply, (state, move) in enumerate(pgn.replay_game(san_moves=pgn_game["moves"])):
+                if ply >= skip_plies:
+                    encode_state(arrays=arrays, index=size, state=state, halfmove=halfmove, fullmove=ply // 2 + 1)
+                    size += 1
+                if move.piece_taken is not None or str(state["pieces_params"][move.piece_id]).upper() == pieces.PAWN:
+                    halfmove = 0
+                else:
+                    halfmove += 1
+        except Exception:
+            # Leave out the whole game
+            for name in arrays:
+                arrays[name][game_start:size] = 0
+            size = game_start
+            skipped += 1
+    return trim(arrays=arrays, size=size), skipped
+
+
+class ArrayWriter:
+    def __init__(self, path: str, dtype: type, shape: Tuple[int, ...]) -> None:
+        """
+        Writes an array to a .npy file in chunks along its first axis
+        The header is written again with the final number of rows when the writer is closed
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.shape = shape
+        self.rows = 0
+        self.file = open(path, "wb")
+        self.write_header()
+
+    def write_header(self):
+        header = str({"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False, "shape": (self.rows,) + self.shape})
+        prefix = np.lib.format.magic(1, 0) + struct.pack("<H", NPY_HEADER_SIZE - 10)
+        # The header is padded with spaces and ends with a newline
+        header = header.ljust(NPY_HEADER_SIZE - len(prefix) - 1) + "\n"
+        self.file.seek(0)
+        self.file.write(prefix + header.encode("latin1"))
+
+    def append(self, array: np.ndarray):
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(np.ascontiguousarray(array, dtype=self.dtype).tobytes())
+        self.rows += len(array)
+
+    def close(self):
+        self.write_header()
+        self.file.close()
+
+
+def export_positions(
+    output_directory: str,
+    fen_paths: Optional[List[str]] = None,
+    pgn_paths: Optional[List[str]] = None,
+    workers: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    skip_plies: int = 0,
+    report=None,
+) -> Dict:
+    """
+    Exports positions from FEN and PGN files to .npy files (one per array, see ARRAYS) in the output directory
+    Arguments:
+    - output_directory: directory of the .npy files (created if needed)
+    - fen_paths: files of positions in FEN, one per line
+    - pgn_paths: PGN files, whose games are replayed
+    - workers: number of worker processes (defaults to the number of CPUs)
+    - chunk_size: number of positions (or games divided by 64) encoded by a worker at once
+    - skip_plies: number of plies left out at the start of each game
+    - report: function called with the statistics after each chunk
+    Returns: statistics of the export
+    """
+    if fen_paths is None:
+        fen_paths = []
+    if pgn_paths is None:
+        pgn_paths = []
+    if workers is None:
+        workers = os.cpu_count() or 1
+    os.makedirs(output_directory, exist_ok=True)
+    writers = {name: ArrayWriter(path=os.path.join(output_directory, name + ".npy"), dtype=dtype, shape=shape) for name, dtype, shape in ARRAYS}
+    stats = {"positions": 0, "skipped": 0, "seconds": 0.0}
+    start_time = time.perf_counter()
+
+    def tasks() -> Iterator[Tuple]:
+        for path in fen_paths:
+            with open(path) as file:
+                lines = (line.strip() for line in file if line.strip() != "")
+                for chunk in parallel.chunks(items=lines, chunk_size=chunk_size):
+                    yield convert_fens, {"lines": chunk}
+        for path in pgn_paths:
+            with open(path) as file:
+                # A game has many positions, so fewer games are sent at once
+                for chunk in parallel.chunks(items=pgn.read_games(lines=file), chunk_size=max(1, chunk_size // 64)):
+                    yield convert_games, {"pgn_games": chunk, "skip_plies": skip_plies}
+
+    def write(result: Tuple[Dict[str, np.ndarray], int]):
+        arrays, skipped = result
+        for name, writer in writers.items():
+            writer.append(array=arrays[name])
+        stats["positions"] += len(arrays["side"])
+        stats["skipped"] += skipped
+        stats["seconds"] = time.perf_counter() - start_time
+        if report is not None:
+            report(stats)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Chunks are written in input order, with a bounded number in flight
+            for result in parallel.map_ordered(executor=executor, tasks=tasks(), max_pending=2 * workers):
+                write(result=result)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    stats["seconds"] = time.perf_counter() - start_time
+    stats["positions_per_second"] = stats["positions"] / stats["seconds"] if stats["seconds"] > 0 else 0
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export positions from FEN or PGN files as NumPy arrays")
+    parser.add_argument("output", help="directory the .npy files are written to")
+    parser.add_argument("--fen", nargs="*", default=[], help="files of positions in FEN, one per line")
+    parser.add_argument("--pgn", nargs="*", default=[], help="PGN files")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--skip-plies", type=int, default=0, help="number of plies left out at the start of each game")
+    args = parser.parse_args()
+
+    stats = export_positions(
+        output_directory=args.output,
+        fen_paths=args.fen,
+        pgn_paths=args.pgn,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        skip_plies=args.skip_plies,
+    )
+    print(f"Exported {stats['positions']} positions ({stats['skipped']} skipped) in {stats['seconds']:.1f}s")
+    print(f"{stats['positions_per_second']:.0f} positions/s")
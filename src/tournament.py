@@ -0,0 +1,357 @@
+"""
+Tournament runner for testing engine changes: two engine configurations play each other in a pool of worker processes,
+each opening of a balanced suite being played twice with colours swapped.
+A Sequential Probability Ratio Test (SPRT) stops the match as soon as one configuration is shown to be stronger
+(by elo1 or more) or not stronger (by elo0 or less), and the Elo difference, the nodes per second of each side and
+the number of games lost on time are reported.
+"""
+import game, engine, parallel
+from typing import Dict, Iterator, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import math
+import os
+import time
+
+DEFAULT_MAX_PLIES = 300
+# Short names of engine.Searcher options in engine configurations
+OPTION_NAMES = {"nodes": "max_nodes", "movetime": "max_time"}
+# Keyword arguments of engine.Searcher which can be set in engine configurations
+SEARCHER_OPTIONS = [
+    "depth",
+    "max_nodes",
+    "max_time",
+    "null_move",
+    "late_move_reductions",
+    "futility_pruning",
+    "aspiration_windows",
+    "history_heuristic",
+    "multi_pv",
+]
+# Options which must be positive integers
+COUNT_OPTIONS = ["depth", "max_nodes", "multi_pv"]
+
+# Balanced openings (in coordinate notation) used when no opening suite is given
+DEFAULT_OPENINGS = [
+    "e2e4 e7e5 g1f3 b8c6",
+    "d2d4 d7d5 c2c4 e7e6",
+    "e2e4 c7c5 g1f3 d7d6",
+    "d2d4 g8f6 c2c4 e7e6",
+    "c2c4 e7e5 b1c3 g8f6",
+    "e2e4 e7e6 d2d4 d7d5",
+    "e2e4 c7c6 d2d4 d7d5",
+    "g1f3 d7d5 g2g3 g8f6",
+]
+
+
+def parse_config(spec: str) -> Dict:
+    """
+    Parses an engine configuration such as "depth=3", "nodes=2000", "movetime=0.5" or "depth=4,null_move=0" (keyword arguments of engine.Searcher)
+    Unknown options and invalid values (e.g. a depth which isn't a positive integer) raise an Exception, rather than
+    failing later in the worker processes
+    Returns a Dict with the specification and the options
+    """
+    options = {}
+    for option in spec.split(","):
+        if option != "":
+            key, _, value = option.partition("=")
+            name = OPTION_NAMES.get(key, key)
+            if name not in SEARCHER_OPTIONS:
+                raise Exception(f"Unknown option in engine configuration {spec}: {key}")
+            try:
+                options[name] = float(value) if "." in value else int(value)
+            except ValueError:
+                raise Exception(f"Invalid value in engine configuration {spec}: {option}")
+            if name in COUNT_OPTIONS and (not isinstance(options[name], int) or options[name] < 1):
+                raise Exception(f"{key} must be a positive integer in engine configuration {spec}: {option}")
+    if "depth" not in options and ("max_nodes" in options or "max_time" in options):
+        # Only the nodes or time limit stops the search
+        options["depth"] = engine.MAX_DEPTH
+    return {"spec": spec, "options": options}
+
+def read_openings(path: str) -> List[str]:
+    """
+    Reads an opening suite: one opening per line, either moves in coordinate notation or a position in FEN
+    """
+    with open(path) as file:
+        return [line.strip() for line in file if line.strip() != "" and not line.startswith("#")]
+
+def opening_state(opening: str) -> Dict:
+    """
+    Gets the game state after an opening (moves in coordinate notation or a position in FEN)
+    """
+    if "/" in opening:
+        return game.fen_to_state(fen=opening)
+    state = game.setup_board(state=game.create_game_state())
+    for move_input in opening.split():
+        move = game.choose_move_from_coordinates(state=state, move_input=move_input)
+        if move is None:
+            raise Exception(f"Invalid move in opening: {move_input}")
+        state = game.make_turn(state=state, move=move, log=False)
+    return state
+
+
+def elo_to_score(elo: float) -> float:
+    """
+    Gets the expected score of a player rated elo points higher than its opponent
+    """
+    return 1 / (1 + 10 ** (-elo / 400))
+
+def score_to_elo(score: float) -> float:
+    """
+    Gets the Elo difference corresponding to an expected score
+    """
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * math.log10(1 / score - 1)
+
+def score_stats(wins: int, draws: int, losses: int) -> Tuple[float, float]:
+    """
+    Gets the mean score and its variance per game
+    """
+    games = wins + draws + losses
+    score = (wins + 0.5 * draws) / games
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / games
+    return score, variance
+
+def elo_estimate(wins: int, draws: int, losses: int) -> Tuple[float, float]:
+    """
+    Estimates the Elo difference from the results and the margin of its 95% confidence interval
+    """
+    games = wins + draws + losses
+    if games == 0:
+        return 0.0, math.inf
+    score, variance = score_stats(wins=wins, draws=draws, losses=losses)
+    deviation = 1.96 * math.sqrt(variance / games)
+    margin = (score_to_elo(score=score + deviation) - score_to_elo(score=score - deviation)) / 2
+    return score_to_elo(score=score), margin
+
+def sprt_llr(wins: int, draws: int, losses: int, elo0: float, elo1: float) -> float:
+    """
+    Gets the log-likelihood ratio of the hypothesis elo = elo1 against elo = elo0
+    (normal approximation of the score distribution, see https://www.chessprogramming.org/Sequential_Probability_Ratio_Test)
+    """
+    games = wins + draws + losses
+    if games == 0:
+        return 0.0
+    score, variance = score_stats(wins=wins, draws=draws, losses=losses)
+    if variance == 0:
+        # All results are the same, so there isn't enough information yet
+        return 0.0
+    score0 = elo_to_score(elo=elo0)
+    score1 = elo_to_score(elo=elo1)
+    return games * (score1 - score0) * (2 * score - score0 - score1) / (2 * variance)
+
+def sprt_bounds(alpha: float, beta: float) -> Tuple[float, float]:
+    """
+    Gets the lower and upper bounds of the log-likelihood ratio for the error rates alpha and beta
+    """
+    return math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+
+
+def play_game(
+    white: Dict,
+    black: Dict,
+    opening: str,
+    base_time: Optional[float] = None,
+    increment: float = 0,
+    max_plies: int = DEFAULT_MAX_PLIES,
+) -> Dict:
+    """
+    Plays a game between two engine configurations from an opening
+    Arguments:
+    - white, black: engine configurations (see parse_config)
+    - opening: opening (see opening_state)
+    - base_time: time on each clock at the start (in seconds), None to play without clocks
+    - increment: time added to the clock after each move (in seconds)
+    - max_plies: the game is drawn after this many plies
+    Returns: a Dict describing the game, with the nodes searched and the time spent by each side
+    """
+    state = opening_state(opening=opening)
+    configs = [white, black]
+    clocks = [base_time, base_time]
+    tables = [{}, {}]
+    nodes = [0, 0]
+    seconds = [0.0, 0.0]
+    forfeit = None
+    plies = 0
+
+    while state["result"] is None and plies < max_plies:
+        side = state["turn"]
+        options = dict(configs[side]["options"])
+        if clocks[side] is not None:
+            time_limit = engine.allocate_time(time_left=clocks[side], increment=increment)
+            options["max_time"] = min(options.get("max_time", time_limit), time_limit)
+            options.setdefault("depth", engine.MAX_DEPTH)
+        searcher = engine.Searcher(table=tables[side], **options)
+
+        start_time = time.perf_counter()
+        move, _ = searcher.search(state=state)
+        elapsed = time.perf_counter() - start_time
+        nodes[side] += searcher.nodes
+        seconds[side] += elapsed
+
+        if clocks[side] is not None:
+            clocks[side] -= elapsed
+            if clocks[side] < 0:
+                # Lost on time
+                forfeit = side
+                state["result"] = (side + 1) % 2
+                break
+            clocks[side] += increment
+
+        state = game.make_turn(state=state, move=move, log=False)
+        plies += 1
+
+    return {
+        "opening": opening,
+        "white": white["spec"],
+        "black": black["spec"],
+        # Unfinished games are drawn
+        "result": state["result"] if state["result"] is not None else 0.5,
+        "plies": plies,
+        "forfeit": forfeit,
+        "nodes": nodes,
+        "seconds": seconds,
+    }
+
+
+def run_tournament(
+    first: Dict,
+    second: Dict,
+    openings: List[str],
+    max_games: int,
+    workers: Optional[int] = None,
+    base_time: Optional[float] = None,
+    increment: float = 0,
+    max_plies: int = DEFAULT_MAX_PLIES,
+    elo0: float = 0,
+    elo1: float = 10,
+    alpha: float = 0.05,
+    beta: float = 0.05,
+    report=None,
+) -> Dict:
+    """
+    Plays a match between two engine configurations until the SPRT finishes or max_games games have been played
+    Each opening is played twice, once with each configuration as white (the openings are repeated if needed)
+    Results are recorded in the order of the games rather than as they finish (so that short games don't bias the SPRT),
+    and the SPRT is only checked once both games of an opening are recorded
+    Arguments:
+    - first, second: engine configurations (see parse_config); results are given for the first configuration
+    - openings: opening suite (see opening_state)
+    - max_games: maximum number of games
+    - workers: number of worker processes (defaults to the number of CPUs)
+    - base_time, increment, max_plies: see play_game
+    - elo0, elo1: Elo differences of the SPRT hypotheses
+    - alpha, beta: error rates of the SPRT
+    - report: function called with the statistics after each game
+    Returns: statistics of the match
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    lower_bound, upper_bound = sprt_bounds(alpha=alpha, beta=beta)
+    stats = {
+        "games": 0,
+        "wins": 0,
+        "draws": 0,
+        "losses": 0,
+        "forfeits": [0, 0],
+        "nodes": [0, 0],
+        "seconds": [0.0, 0.0],
+        "llr": 0.0,
+        "sprt": None,
+    }
+
+    def schedule() -> Iterator[Tuple[str, bool]]:
+        # Games in order: each opening with the first configuration as white, then as black
+        for index in range(max_games):
+            yield openings[index // 2 % len(openings)], index % 2 == 0
+
+    def tasks() -> Iterator[Tuple]:
+        for opening, first_is_white in schedule():
+            white, black = (first, second) if first_is_white else (second, first)
+            yield play_game, {"white": white, "black": black, "opening": opening, "base_time": base_time, "increment": increment, "max_plies": max_plies}
+
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # A bounded number of games is in flight, and they are recorded in order
+        finished_games = parallel.map_ordered(executor=executor, tasks=tasks(), max_pending=2 * workers)
+        for (_, first_is_white), finished_game in zip(schedule(), finished_games):
+            # Sides of the game in the order (first, second)
+            sides = [0, 1] if first_is_white else [1, 0]
+            first_score = 1 - abs(finished_game["result"] - sides[0])
+            if first_score == 1:
+                stats["wins"] += 1
+            elif first_score == 0:
+                stats["losses"] += 1
+            else:
+                stats["draws"] += 1
+            stats["games"] += 1
+            for index, side in enumerate(sides):
+                stats["nodes"][index] += finished_game["nodes"][side]
+                stats["seconds"][index] += finished_game["seconds"][side]
+                if finished_game["forfeit"] == side:
+                    stats["forfeits"][index] += 1
+
+            if not first_is_white:
+                # The SPRT is checked once the game with colours reversed is in, so the match never stops in the middle of a pair
+                stats["llr"] = sprt_llr(wins=stats["wins"], draws=stats["draws"], losses=stats["losses"], elo0=elo0, elo1=elo1)
+                if stats["llr"] >= upper_bound:
+                    stats["sprt"] = "H1"
+                elif stats["llr"] <= lower_bound:
+                    stats["sprt"] = "H0"
+            if report is not None:
+                report(stats)
+
+            if stats["sprt"] is not None:
+                # Stop early: games that haven't started are cancelled and the others are left to finish unrecorded
+                finished_games.close()
+                break
+
+    stats["elo"], stats["elo_margin"] = elo_estimate(wins=stats["wins"], draws=stats["draws"], losses=stats["losses"])
+    stats["nodes_per_second"] = [
+        nodes / seconds if seconds > 0 else 0 for nodes, seconds in zip(stats["nodes"], stats["seconds"])
+    ]
+    stats["llr_bounds"] = [lower_bound, upper_bound]
+    stats["total_seconds"] = time.perf_counter() - start_time
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play a match between two engine configurations with an SPRT")
+    parser.add_argument("first", help='engine configuration, e.g. "depth=3" or "nodes=2000"')
+    parser.add_argument("second", help="engine configuration it is tested against")
+    parser.add_argument("--openings", default=None, help="file of openings (coordinate moves or FEN, one per line)")
+    parser.add_argument("--games", type=int, default=1000, help="maximum number of games")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--time", type=float, default=None, help="time on each clock at the start (in seconds)")
+    parser.add_argument("--increment", type=float, default=0, help="time added after each move (in seconds)")
+    parser.add_argument("--max-plies", type=int, default=DEFAULT_MAX_PLIES)
+    parser.add_argument("--elo0", type=float, default=0)
+    parser.add_argument("--elo1", type=float, default=10)
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--beta", type=float, default=0.05)
+    args = parser.parse_args()
+
+    def report(stats: Dict):
+        print(f"Games: {stats['games']}, +{stats['wins']} ={stats['draws']} -{stats['losses']}, LLR {stats['llr']:.2f}", flush=True)
+
+    stats = run_tournament(
+        first=parse_config(spec=args.first),
+        second=parse_config(spec=args.second),
+        openings=read_openings(path=args.openings) if args.openings is not None else DEFAULT_OPENINGS,
+        max_games=args.games,
+        workers=args.workers,
+        base_time=args.time,
+        increment=args.increment,
+        max_plies=args.max_plies,
+        elo0=args.elo0,
+        elo1=args.elo1,
+        alpha=args.alpha,
+        beta=args.beta,
+        report=report,
+    )
+    print(f"Elo difference: {stats['elo']:.1f} +/- {stats['elo_margin']:.1f}")
+    print(f"SPRT ({args.elo0}, {args.elo1}): LLR {stats['llr']:.2f} in [{stats['llr_bounds'][0]:.2f}, {stats['llr_bounds'][1]:.2f}], {stats['sprt'] or 'inconclusive'}")
+    print(f"Nodes/s: {stats['nodes_per_second'][0]:.0f} ({args.first}), {stats['nodes_per_second'][1]:.0f} ({args.second})")
+    print(f"Time forfeits: {stats['forfeits'][0]} ({args.first}), {stats['forfeits'][1]} ({args.second})")
+    print(f"Finished in {stats['total_seconds']:.1f}s")
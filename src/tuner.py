@@ -0,0 +1,358 @@
+"""
+Texel tuning of the evaluation (see https://www.chessprogramming.org/Texel%27s_Tuning_Method): the piece values and
+piece-square tables of engine.evaluate are fitted to game results, by minimising the squared error between the results
+and the win probabilities predicted from the evaluation, sigmoid(K * evaluation).
+
+Labelled positions are converted once into a sparse feature matrix (stored as NumPy arrays of the row, column and
+value of each non-zero entry) in a pool of worker processes: a white piece adds 1 to its material feature and to the
+feature of its square, a black piece subtracts 1 (squares are seen from the piece's side, see engine.relative_square).
+The evaluation of all the positions and the gradient are then computed with vectorised sums over the entries.
+The material feature of a piece type is the sum of its square features, so the piece-square table of each type is kept
+at a mean of zero (see center_tables): its mean is moved into the piece value, which doesn't change the evaluation,
+and the tuned piece values carry the average worth of the pieces. Lines and games which can't be read are skipped.
+The tuned tables are written as JSON, which engine.load_evaluation loads.
+"""
+import engine, game, pgn, pieces, parallel
+from typing import Dict, Iterator, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import math
+import os
+import time
+import numpy as np
+
+PIECE_TYPES = [pieces.PAWN, pieces.KNIGHT, pieces.BISHOP, pieces.ROOK, pieces.QUEEN, pieces.KING]
+# Features: material of each piece type, then the 64 squares of each piece type
+MATERIAL_FEATURES = len(PIECE_TYPES)
+FEATURES = MATERIAL_FEATURES + 64 * len(PIECE_TYPES)
+# Labels of the results, for white
+RESULT_LABELS = {"1-0": 1.0, "0-1": 0.0, "1/2-1/2": 0.5, "1.0": 1.0, "0.0": 0.0, "0.5": 0.5}
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def piece_features(piece_str: str, row: int, col: int) -> Tuple[int, int, int]:
+    """
+    Gets the material feature, square feature and sign (1 for white, -1 for black) of a piece
+    """
+    side = 0 if piece_str.isupper() else 1
+    piece_index = PIECE_TYPES.index(piece_str.upper())
+    square = engine.relative_square(side=side, row=row, col=col)
+    return piece_index, MATERIAL_FEATURES + 64 * piece_index + square, 1 - 2 * side
+
+def fen_features(fen: str) -> Dict[int, int]:
+    """
+    Gets the non-zero features of a position in FEN (read directly from the piece placement, without a game state)
+    Raises ValueError if the piece placement is invalid
+    """
+    ranks = fen.split()[0].split("/") if fen.strip() != "" else []
+    if len(ranks) != 8:
+        raise ValueError(f"Invalid FEN: {fen}")
+    features = {}
+    for row, rank in enumerate(ranks):
+        col = 0
+        for char in rank:
+            if char.isdigit():
+                col += int(char)
+                continue
+            if col >= 8:
+                raise ValueError(f"Invalid FEN: {fen}")
+            material, square, sign = piece_features(piece_str=char, row=row, col=col)
+            features[material] = features.get(material, 0) + sign
+            features[square] = features.get(square, 0) + sign
+            col += 1
+        if col != 8:
+            raise ValueError(f"Invalid FEN: {fen}")
+    return features
+
+def state_features(state: Dict) -> Dict[int, int]:
+    """
+    Gets the non-zero features of a game state
+    """
+    features = {}
+    for piece in state["pieces_params"].values():
+        material, square, sign = piece_features(piece_str=str(piece), row=piece.row, col=piece.col)
+        features[material] = features.get(material, 0) + sign
+        features[square] = features.get(square, 0) + sign
+    return features
+
+def parse_labelled_line(line: str) -> Optional[Tuple[str, float]]:
+    """
+    Parses a labelled position: a FEN followed by the result for white, either as an EPD operation (c9 "1-0";)
+    or in brackets ([1.0], [0.5], [0.0] or [1-0], ...)
+    Returns the FEN and the label (None if the line has no result)
+    """
+    if "[" in line:
+        fen, _, label = line.partition("[")
+        label = label.strip().rstrip("]").strip()
+    elif "c9" in line:
+        fen, _, label = line.partition("c9")
+        label = label.strip().split(";")[0].strip().strip('"')
+    else:
+        return None
+    if label not in RESULT_LABELS:
+        return None
+    return fen.strip(), RESULT_LABELS[label]
+
+
+def convert_lines(lines: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, int]:
+    """
+    Converts labelled positions to sparse features (in a worker process)
+    Returns the rows (within the chunk), columns and values of the non-zero features, the labels,
+    and the number of lines skipped because their FEN is invalid
+    """
+    rows, columns, values, labels = [], [], [], []
+    skipped = 0
+    for line in lines:
+        parsed = parse_labelled_line(line=line)
+        if parsed is None:
+            continue
+        fen, label = parsed
+        try:
+            features = fen_features(fen=fen)
+        except ValueError:
+            skipped += 1
+            continue
+        for feature, value in features.items():
+            if value != 0:
+                rows.append(len(labels))
+                columns.append(feature)
+                values.append(value)
+        labels.append(label)
+    return np.array(rows, dtype=np.int32), np.array(columns, dtype=np.int16), np.array(values, dtype=np.int8), np.array(labels, dtype=np.float32), skipped
+
+def convert_games(pgn_games: List[Dict], skip_plies: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, int]:
+    """
+    Converts the positions of games (labelled with their results) to sparse features (in a worker process)
+    The first skip_plies positions of each game are left out, as are games without a result or with invalid moves
+    Returns the arrays as convert_lines does, with the number of games skipped because of invalid moves
+    """
+    rows, columns, values, labels = [], [], [], []
+    skipped = 0
+    for pgn_game in pgn_games:
+        if pgn_game["result"] is None:
+            continue
+        # Results are 0 if white wins and 1 if black wins
+        label = 1 - pgn_game["result"]
+        game_rows, game_columns, game_values = [], [], []
+        game_labels = 0
+        try:
+            for ply, (state, _) in enumerate(pgn.replay_game(san_moves=pgn_game["moves"])):
+                if ply < skip_plies:
+                    continue
+                for feature, value in state_features(state=state).items():
+                    if value != 0:
+                        game_rows.append(len(labels) + game_labels)
+                        game_columns.append(feature)
+                        game_values.append(value)
+                game_labels += 1
+        except Exception:
+            skipped += 1
+            continue
+        rows.extend(game_rows)
+        columns.extend(game_columns)
+        values.extend(game_values)
+        labels.extend([label] * game_labels)
+    return np.array(rows, dtype=np.int32), np.array(columns, dtype=np.int16), np.array(values, dtype=np.int8), np.array(labels, dtype=np.float32), skipped
+
+def build_features(
+    position_paths: List[str],
+    pgn_paths: List[str],
+    workers: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    skip_plies: int = 8,
+) -> Tuple[Dict[str, np.ndarray], int]:
+    """
+    Converts labelled positions (see parse_labelled_line) and the positions of PGN games to a sparse feature matrix
+    Returns a Dict of arrays (rows, columns and values of the non-zero features, and labels: results for white)
+    and the number of lines and games skipped because they are invalid
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    def tasks() -> Iterator[Tuple]:
+        for path in position_paths:
+            with open(path) as file:
+                for chunk in parallel.chunks(items=file, chunk_size=chunk_size):
+                    yield convert_lines, {"lines": chunk}
+        for path in pgn_paths:
+            with open(path) as file:
+                # Games are much slower to convert than positions, so they are sent in smaller chunks
+                for chunk in parallel.chunks(items=pgn.read_games(lines=file), chunk_size=max(1, chunk_size // 100)):
+                    yield convert_games, {"pgn_games": chunk, "skip_plies": skip_plies}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # The files are read as the chunks are converted, rather than all at once
+        parts = list(parallel.map_ordered(executor=executor, tasks=tasks(), max_pending=2 * workers))
+
+    # Offset the rows of each chunk
+    offset = 0
+    rows = []
+    for part_rows, _, _, part_labels, _ in parts:
+        rows.append(part_rows.astype(np.int64) + offset)
+        offset += len(part_labels)
+    features = {
+        "rows": np.concatenate(rows) if len(rows) > 0 else np.zeros(0, dtype=np.int64),
+        "columns": np.concatenate([part[1] for part in parts]).astype(np.int64) if len(parts) > 0 else np.zeros(0, dtype=np.int64),
+        "values": np.concatenate([part[2] for part in parts]).astype(np.float64) if len(parts) > 0 else np.zeros(0),
+        "labels": np.concatenate([part[3] for part in parts]).astype(np.float64) if len(parts) > 0 else np.zeros(0),
+    }
+    return features, sum(part[4] for part in parts)
+
+
+def center_tables(weights: np.ndarray) -> np.ndarray:
+    """
+    Moves the mean of each piece-square table into the piece value, so that the tables have a mean of zero
+    The evaluation doesn't change, as each piece counts for its piece value and the weight of its square
+    """
+    weights = weights.copy()
+    for index in range(len(PIECE_TYPES)):
+        table = weights[MATERIAL_FEATURES + 64 * index:MATERIAL_FEATURES + 64 * (index + 1)]
+        mean = table.mean()
+        table -= mean
+        # Each side has one king, so shifting the king's table doesn't change the evaluation and its value is left alone
+        if PIECE_TYPES[index] != pieces.KING:
+            weights[index] += mean
+    return weights
+
+def initial_weights() -> np.ndarray:
+    """
+    Gets the weights of the features from the current evaluation tables (with centred piece-square tables)
+    """
+    weights = np.zeros(FEATURES)
+    for index, piece_type in enumerate(PIECE_TYPES):
+        weights[index] = engine.PIECE_VALUES[piece_type]
+        weights[MATERIAL_FEATURES + 64 * index:MATERIAL_FEATURES + 64 * (index + 1)] = engine.PIECE_SQUARE_TABLES[piece_type]
+    return center_tables(weights=weights)
+
+def evaluate_all(features: Dict[str, np.ndarray], weights: np.ndarray) -> np.ndarray:
+    """
+    Evaluates all the positions (in centipawns, for white)
+    """
+    return np.bincount(features["rows"], weights=features["values"] * weights[features["columns"]], minlength=len(features["labels"]))
+
+def win_probability(evaluations: np.ndarray, k: float) -> np.ndarray:
+    return 1 / (1 + 10 ** (-k * evaluations / 400))
+
+def loss(features: Dict[str, np.ndarray], weights: np.ndarray, k: float) -> float:
+    """
+    Gets the mean squared error between the results and the predicted win probabilities
+    """
+    return float(np.mean((features["labels"] - win_probability(evaluations=evaluate_all(features=features, weights=weights), k=k)) ** 2))
+
+def fit_k(features: Dict[str, np.ndarray], weights: np.ndarray, low: float = 0.1, high: float = 3.0, steps: int = 30) -> float:
+    """
+    Finds the scaling constant K of the win probability which minimises the error (golden-section search)
+    """
+    ratio = (math.sqrt(5) - 1) / 2
+    for _ in range(steps):
+        first = high - ratio * (high - low)
+        second = low + ratio * (high - low)
+        if loss(features=features, weights=weights, k=first) < loss(features=features, weights=weights, k=second):
+            high = second
+        else:
+            low = first
+    return (low + high) / 2
+
+def tune(
+    features: Dict[str, np.ndarray],
+    weights: np.ndarray,
+    k: float,
+    iterations: int = 200,
+    learning_rate: float = 1.0,
+    report=None,
+) -> np.ndarray:
+    """
+    Optimises the weights with Adam (gradient steps on all the positions at once)
+    The king's material weight isn't tuned (it is the same for both sides), and the piece-square tables are centred
+    after each step (see center_tables), as otherwise Adam spreads each piece's value between its material and square weights
+    Arguments:
+    - features: sparse feature matrix (see build_features)
+    - weights: initial weights
+    - k: scaling constant of the win probability
+    - iterations: number of gradient steps
+    - learning_rate: size of the steps (in centipawns)
+    - report: function called with the iteration and the loss after each step
+    Returns: the tuned weights
+    """
+    weights = weights.astype(np.float64).copy()
+    fixed = np.zeros(FEATURES, dtype=bool)
+    fixed[PIECE_TYPES.index(pieces.KING)] = True
+    first_moment = np.zeros(FEATURES)
+    second_moment = np.zeros(FEATURES)
+    beta1, beta2, epsilon = 0.9, 0.999, 1e-8
+    count = len(features["labels"])
+
+    for iteration in range(1, iterations + 1):
+        probabilities = win_probability(evaluations=evaluate_all(features=features, weights=weights), k=k)
+        errors = probabilities - features["labels"]
+        # Derivative of the squared error with respect to each position's evaluation
+        position_gradients = 2 * errors * probabilities * (1 - probabilities) * math.log(10) * k / 400
+        gradient = np.bincount(features["columns"], weights=features["values"] * position_gradients[features["rows"]], minlength=FEATURES) / count
+        gradient[fixed] = 0
+
+        first_moment = beta1 * first_moment + (1 - beta1) * gradient
+        second_moment = beta2 * second_moment + (1 - beta2) * gradient ** 2
+        step = first_moment / (1 - beta1 ** iteration) / (np.sqrt(second_moment / (1 - beta2 ** iteration)) + epsilon)
+        weights = center_tables(weights=weights - learning_rate * step)
+
+        if report is not None:
+            report(iteration, float(np.mean(errors ** 2)))
+    return weights
+
+def export_tables(weights: np.ndarray, path: str):
+    """
+    Writes the weights as evaluation tables (see engine.load_evaluation)
+    """
+    tables = {"piece_values": {}, "piece_square_tables": {}}
+    for index, piece_type in enumerate(PIECE_TYPES):
+        tables["piece_values"][piece_type] = int(round(weights[index]))
+        tables["piece_square_tables"][piece_type] = [
+            int(round(weight)) for weight in weights[MATERIAL_FEATURES + 64 * index:MATERIAL_FEATURES + 64 * (index + 1)]
+        ]
+    with open(path, "w") as file:
+        json.dump(tables, file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune the evaluation tables on positions labelled with game results")
+    parser.add_argument("output", help="JSON file the tuned tables are written to")
+    parser.add_argument("--positions", nargs="*", default=[], help='files of labelled positions (FEN followed by c9 "1-0"; or [1.0])')
+    parser.add_argument("--pgn", nargs="*", default=[], help="PGN files whose positions are labelled with the game results")
+    parser.add_argument("--cache", default=None, help=".npz file the feature matrix is saved to (or loaded from if it exists)")
+    parser.add_argument("--skip-plies", type=int, default=8, help="number of opening plies of each game left out")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--learning-rate", type=float, default=1.0)
+    parser.add_argument("--tables", default=None, help="evaluation tables to start from (the engine's defaults otherwise)")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    if args.cache is not None and os.path.exists(args.cache):
+        with np.load(args.cache) as cache:
+            features = {name: cache[name] for name in ["rows", "columns", "values", "labels"]}
+    else:
+        features, skipped = build_features(position_paths=args.positions, pgn_paths=args.pgn, workers=args.workers, skip_plies=args.skip_plies)
+        if skipped > 0:
+            print(f"Skipped {skipped} invalid positions or games")
+        if args.cache is not None:
+            np.savez(args.cache, **features)
+    print(f"{len(features['labels'])} positions ({len(features['rows'])} features) in {time.perf_counter() - start_time:.1f}s")
+    if len(features["labels"]) == 0:
+        raise SystemExit("No labelled positions")
+
+    if args.tables is not None:
+        engine.load_evaluation(path=args.tables)
+    weights = initial_weights()
+    k = fit_k(features=features, weights=weights)
+    print(f"K = {k:.3f}, initial loss {loss(features=features, weights=weights, k=k):.6f}")
+
+    start_time = time.perf_counter()
+    def report(iteration: int, mean_error: float):
+        if iteration % 10 == 0 or iteration == args.iterations:
+            elapsed = time.perf_counter() - start_time
+            print(f"Iteration {iteration}: loss {mean_error:.6f} ({elapsed / iteration:.3f}s per iteration)", flush=True)
+
+    weights = tune(features=features, weights=weights, k=k, iterations=args.iterations, learning_rate=args.learning_rate, report=report)
+    export_tables(weights=weights, path=args.output)
+    print(f"Final loss {loss(features=features, weights=weights, k=k):.6f}, tables written to {args.output}")
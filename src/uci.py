@@ -0,0 +1,228 @@
+"""
+UCI (Universal Chess Interface) front end, so that the engine can be used by GUIs and tournament managers
+(see https://www.shredderchess.com/chess-features/uci-universal-chess-interface.html)
+
+Supported commands: uci, isready, ucinewgame, setoption (MultiPV), position (startpos or fen, with moves),
+go (depth, nodes, movetime, wtime/btime/winc/binc/movestogo, infinite), stop and quit. The search runs in a background thread so that stop and
+isready are answered while searching.
+Commands received while searching (other than stop and quit) wait for the search to finish.
+GUIs send the whole game with every position command, so when the moves extend those of the previous position
+only the new moves are made.
+"""
+import game, engine, moves
+from typing import Dict, List, TextIO
+import sys
+import threading
+import time
+
+ENGINE_NAME = "Chess"
+MAX_MULTI_PV = 16
+
+
+class UCIEngine:
+    def __init__(self, output: TextIO = sys.stdout) -> None:
+        """
+        Handles UCI commands, writing the responses to the output
+        """
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.table = {}
+        self.start_fen = None
+        self.state = engine.prepare_search_state(state=game.setup_board(state=game.create_game_state()))
+        self.move_inputs = []
+        self.search_thread = None
+        self.stop_event = threading.Event()
+        self.multi_pv = 1
+
+    def send(self, message: str):
+        with self.output_lock:
+            self.output.write(message + "\n")
+            self.output.flush()
+
+    def handle(self, line: str) -> bool:
+        """
+        Handles a command
+        Returns False once the engine has to quit
+        """
+        tokens = line.split()
+        if len(tokens) == 0:
+            return True
+        command = tokens[0]
+
+        if command == "uci":
+            self.send(f"id name {ENGINE_NAME}")
+            self.send("id author Chess contributors")
+            self.send(f"option name MultiPV type spin default 1 min 1 max {MAX_MULTI_PV}")
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "ucinewgame":
+            self.wait()
+            self.table = {}
+        elif command == "setoption":
+            self.wait()
+            self.set_option(tokens=tokens[1:])
+        elif command == "position":
+            self.wait()
+            self.set_position(tokens=tokens[1:])
+        elif command == "go":
+            self.wait()
+            self.go(tokens=tokens[1:])
+        elif command == "stop":
+            self.stop()
+        elif command == "quit":
+            self.stop()
+            return False
+        # Unknown commands are ignored, as required by the protocol
+        return True
+
+    def set_option(self, tokens: List[str]):
+        """
+        Sets an option from the arguments of a setoption command, e.g. "name MultiPV value 3"
+        """
+        if "name" not in tokens or "value" not in tokens:
+            return
+        name = " ".join(tokens[tokens.index("name") + 1:tokens.index("value")])
+        value = " ".join(tokens[tokens.index("value") + 1:])
+        if name.lower() == "multipv" and value.isdigit():
+            self.multi_pv = min(max(int(value), 1), MAX_MULTI_PV)
+        else:
+            self.send(f"info string unknown option {name}")
+
+    def set_position(self, tokens: List[str]):
+        """
+        Sets the position from the arguments of a position command, e.g. "startpos moves e2e4 e7e5"
+        Only the new moves are made if the position extends the current one, and the current position is kept
+        if the FEN is invalid
+        """
+        if "moves" in tokens:
+            move_inputs = tokens[tokens.index("moves") + 1:]
+            tokens = tokens[:tokens.index("moves")]
+        else:
+            move_inputs = []
+        start_fen = " ".join(tokens[1:]) if len(tokens) > 0 and tokens[0] == "fen" else None
+
+        if start_fen != self.start_fen or move_inputs[:len(self.move_inputs)] != self.move_inputs:
+            # Not a continuation of the current position, so start again
+            if start_fen is None:
+                self.state = engine.prepare_search_state(state=game.setup_board(state=game.create_game_state()))
+            else:
+                try:
+                    state = game.fen_to_state(fen=start_fen)
+                except Exception:
+                    # Keep the previous position rather than stopping the engine
+                    self.send("info string invalid position")
+                    return
+                self.state = engine.prepare_search_state(state=state)
+            self.start_fen = start_fen
+            self.move_inputs = []
+
+        for move_input in move_inputs[len(self.move_inputs):]:
+            move = game.choose_move_from_coordinates(state=self.state, move_input=move_input)
+            if move is None:
+                self.send(f"info string invalid move {move_input}")
+                break
+            # Only the last move is kept (for en passant), so that making a move doesn't copy the whole game
+            self.state = engine.make_search_move(state=self.state, move=move)
+            self.move_inputs.append(move_input)
+
+    def get_limits(self, tokens: List[str]) -> Dict:
+        """
+        Gets the search limits from the arguments of a go command (tokens without a valid value are ignored)
+        Returns a Dict with the depth, the maximum number of nodes and the maximum time (in seconds)
+        """
+        arguments = {}
+        for index, token in enumerate(tokens):
+            if token in ["depth", "nodes", "movetime", "wtime", "btime", "winc", "binc", "movestogo"] and index + 1 < len(tokens):
+                try:
+                    arguments[token] = int(tokens[index + 1])
+                except ValueError:
+                    # Malformed values are ignored, like unknown tokens
+                    pass
+
+        limits = {"depth": arguments.get("depth", engine.MAX_DEPTH), "nodes": arguments.get("nodes"), "time": None}
+        if "movetime" in arguments:
+            limits["time"] = arguments["movetime"] / 1000
+        clock = "wtime" if self.state["turn"] == 0 else "btime"
+        increment = "winc" if self.state["turn"] == 0 else "binc"
+        if clock in arguments and "infinite" not in tokens:
+            time_limit = engine.allocate_time(
+                time_left=arguments[clock] / 1000,
+                increment=arguments.get(increment, 0) / 1000,
+                moves_to_go=arguments.get("movestogo"),
+            )
+            limits["time"] = time_limit if limits["time"] is None else min(limits["time"], time_limit)
+        return limits
+
+    def go(self, tokens: List[str]):
+        """
+        Starts searching the current position in a background thread
+        """
+        limits = self.get_limits(tokens=tokens)
+        self.stop_event = threading.Event()
+        start_time = time.perf_counter()
+
+        def send_info(depth: int, score: int, move: moves.Move, nodes: int):
+            elapsed = time.perf_counter() - start_time
+            # One line per principal variation (a single line without a move if there are no legal moves)
+            lines = searcher.lines if len(searcher.lines) > 0 else [{"move": move, "score": score, "pv": []}]
+            for index, line in enumerate(lines):
+                mate = engine.score_to_mate(score=line["score"])
+                score_str = f"mate {mate}" if mate is not None else f"cp {line['score']}"
+                info = f"info depth {depth}"
+                if self.multi_pv > 1:
+                    info += f" multipv {index + 1}"
+                info += f" score {score_str} nodes {nodes} nps {int(nodes / elapsed) if elapsed > 0 else 0} time {int(elapsed * 1000)}"
+                if len(line["pv"]) > 0:
+                    info += " pv " + " ".join(game.move_to_coordinates(move=pv_move) for pv_move in line["pv"])
+                self.send(info)
+
+        searcher = engine.Searcher(
+            depth=limits["depth"],
+            max_nodes=limits["nodes"],
+            max_time=limits["time"],
+            table=self.table,
+            stop_event=self.stop_event,
+            callback=send_info,
+            multi_pv=self.multi_pv,
+        )
+
+        def search():
+            move, _ = searcher.search(state=self.state)
+            # "0000" is the null move, sent when there are no legal moves
+            self.send(f"bestmove {game.move_to_coordinates(move=move) if move is not None else '0000'}")
+
+        self.search_thread = threading.Thread(target=search, daemon=True)
+        self.search_thread.start()
+
+    def stop(self):
+        """
+        Stops the search (if there is one), which then sends its best move
+        """
+        if self.search_thread is not None:
+            self.stop_event.set()
+        self.wait()
+
+    def wait(self):
+        """
+        Waits until the search (if there is one) has finished
+        """
+        if self.search_thread is not None:
+            self.search_thread.join()
+            self.search_thread = None
+
+
+def run(input: TextIO = sys.stdin, output: TextIO = sys.stdout):
+    """
+    Reads UCI commands until quit (or the end of the input)
+    """
+    uci_engine = UCIEngine(output=output)
+    for line in input:
+        if not uci_engine.handle(line=line):
+            return
+    # Let the last search finish at the end of the input
+    uci_engine.wait()
+
+
+if __name__ == "__main__":
+    run()
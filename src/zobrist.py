@@ -0,0 +1,85 @@
+"""
+Zobrist hashing of positions (see https://www.chessprogramming.org/Zobrist_Hashing)
+Position keys are 64 bit integers built from the pieces on their squares, the castling rights,
+the en passant file and the side to move.
+NOTE: keys are generated from a fixed seed, so they are stable between runs but are not the Polyglot keys
+"""
+import pieces
+from typing import Dict
+import random
+
+SEED = 2023
+PIECE_TYPES = [pieces.PAWN, pieces.KNIGHT, pieces.BISHOP, pieces.ROOK, pieces.QUEEN, pieces.KING]
+
+_random = random.Random(SEED)
+# Keys for each (piece string, square), e.g. PIECE_KEYS["n"][square]
+PIECE_KEYS = {}
+for piece_type in PIECE_TYPES:
+    for piece_str in [piece_type, piece_type.lower()]:
+        PIECE_KEYS[piece_str] = [_random.getrandbits(64) for _ in range(64)]
+# Keys for white kingside, white queenside, black kingside and black queenside castling
+CASTLING_KEYS = [_random.getrandbits(64) for _ in range(4)]
+EN_PASSANT_KEYS = [_random.getrandbits(64) for _ in range(8)]
+# Key used when it is black's turn
+TURN_KEY = _random.getrandbits(64)
+
+
+def castling_rights(state: Dict) -> int:
+    """
+    Gets the castling rights as 4 bits: white kingside, white queenside, black kingside, black queenside
+    A side can castle if its king hasn't moved and its rook is still on the home square
+    """
+    rights = 0
+    for piece in state["pieces_params"].values():
+        if str(piece).upper() == pieces.KING and not piece.has_moved:
+            for bit, rook_col in [(0, len(state["board"][0]) - 1), (1, 0)]:
+                rook_id = state["board"][piece.row][rook_col]
+                if rook_id is not None:
+                    rook = state["pieces_params"][rook_id]
+                    if rook.side == piece.side and str(rook).upper() == pieces.ROOK:
+                        rights |= 1 << (bit + 2 * piece.side)
+    return rights
+
+def en_passant_file(state: Dict) -> int:
+    """
+    Gets the file (column) on which an en passant capture can be made, or -1 if there isn't one
+    """
+    if len(state["moves"]) == 0:
+        return -1
+    last_move = state["moves"][-1]
+    if abs(last_move.start_row - last_move.end_row) != 2 or last_move.piece_id not in state["pieces_params"]:
+        return -1
+    moved_piece = state["pieces_params"][last_move.piece_id]
+    if str(moved_piece).upper() != pieces.PAWN:
+        return -1
+
+    # Only count the en passant square if a pawn can capture there
+    for col in [last_move.end_col - 1, last_move.end_col + 1]:
+        if 0 <= col < len(state["board"][0]):
+            neighbour_id = state["board"][last_move.end_row][col]
+            if neighbour_id is not None:
+                neighbour = state["pieces_params"][neighbour_id]
+                if neighbour.side != moved_piece.side and str(neighbour).upper() == pieces.PAWN:
+                    return last_move.end_col
+    return -1
+
+def position_key(state: Dict) -> int:
+    """
+    Gets the Zobrist key of the position (for an 8x8 board)
+    """
+    key = 0
+    for piece in state["pieces_params"].values():
+        key ^= PIECE_KEYS[str(piece)][piece.row * 8 + piece.col]
+
+    rights = castling_rights(state=state)
+    for bit in range(4):
+        if rights >> bit & 1:
+            key ^= CASTLING_KEYS[bit]
+
+    file = en_passant_file(state=state)
+    if file >= 0:
+        key ^= EN_PASSANT_KEYS[file]
+
+    if state["turn"] == 1:
+        key ^= TURN_KEY
+    return key
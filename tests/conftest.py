@@ -0,0 +1,29 @@
+import os
+import random
+import sys
+
+import pytest
+
+# The modules in src import each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import game, moves
+
+
+@pytest.fixture
+def random_game():
+    """
+    Plays random moves from the starting position, returning the state after every move
+    """
+    def play(seed: int, max_moves: int = 80):
+        rng = random.Random(seed)
+        state = game.setup_board(state=game.create_game_state())
+        states = [state]
+        for _ in range(max_moves):
+            move_list = moves.get_all_possible_moves(state=state, side=state["turn"])
+            if state["result"] is not None or len(move_list) == 0:
+                break
+            state = game.make_turn(state=state, move=rng.choice(move_list), log=False)
+            states.append(state)
+        return states
+    return play
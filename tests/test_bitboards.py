@@ -0,0 +1,36 @@
+import bitboards, game
+
+# Positions with castling, en passant, promotions, pins, checks, checkmate and stalemate
+FENS = [
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+    "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+    "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+    "rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3",
+    "4k3/8/8/8/8/8/8/4K2R w K - 0 1",
+    "7k/5Q2/6K1/8/8/8/8/8 b - - 0 1",
+    "6rk/6pp/8/8/8/8/8/K5R1 b - - 0 1",
+    "k7/8/1K6/8/8/8/8/7Q w - - 0 1",
+]
+
+
+def test_matches_pieces_on_fens():
+    mismatches, _, _ = bitboards.cross_check(states=[game.fen_to_state(fen=fen) for fen in FENS])
+    assert mismatches == []
+
+def test_matches_pieces_on_random_positions(random_game):
+    states = []
+    for seed in range(3):
+        states += random_game(seed=seed, max_moves=60)
+    mismatches, _, _ = bitboards.cross_check(states=states)
+    assert mismatches == []
+
+def test_terminal_positions():
+    analysis = bitboards.analyse(positions=bitboards.from_fens(fens=[
+        "7k/5Q2/6K1/8/8/8/8/8 b - - 0 1",
+        "7k/6Q1/6K1/8/8/8/8/8 b - - 0 1",
+        game.state_to_fen(state=game.setup_board(state=game.create_game_state())),
+    ]))
+    assert analysis["stalemate"].tolist() == [True, False, False]
+    assert analysis["checkmate"].tolist() == [False, True, False]
+    assert analysis["legal_moves"].tolist()[2] == 20
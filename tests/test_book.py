@@ -0,0 +1,87 @@
+import random
+
+import book, game, moves, zobrist
+
+PGN = """[Event "First"]
+[Result "1-0"]
+
+1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 1-0
+
+[Event "Second"]
+[Result "1/2-1/2"]
+
+1. e4 c5 2. Nf3 d6 1/2-1/2
+
+[Event "Third"]
+[Result "0-1"]
+
+1. d4 d5 2. c4 e6 0-1
+"""
+
+
+def play(move_inputs):
+    state = game.setup_board(state=game.create_game_state())
+    for move_input in move_inputs:
+        state = game.make_turn(state=state, move=game.choose_move_from_coordinates(state=state, move_input=move_input), log=False)
+    return state
+
+
+def test_encode_move():
+    # Values from the Polyglot format: to file, to row, from file, from row and promotion piece
+    state = play(move_inputs=[])
+    assert book.encode_move(move=game.choose_move_from_coordinates(state=state, move_input="e2e4")) == 0x031C
+    assert book.encode_move(move=game.choose_move_from_coordinates(state=state, move_input="g1f3")) == 0x0195
+    # Castling is the king taking its own rook
+    state = game.fen_to_state(fen="r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1")
+    assert book.encode_move(move=game.choose_move_from_coordinates(state=state, move_input="e1g1")) == 0x0107
+    assert book.encode_move(move=game.choose_move_from_coordinates(state=state, move_input="e1c1")) == 0x0100
+    state = game.fen_to_state(fen="4k3/P7/8/8/8/8/8/4K3 w - - 0 1")
+    assert book.encode_move(move=game.choose_move_from_coordinates(state=state, move_input="a7a8q")) == 0x4C38
+
+def test_decode_move_round_trip():
+    for fen in [
+        "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+        "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 b kq - 0 1",
+        "rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3",
+    ]:
+        state = game.fen_to_state(fen=fen)
+        for move in moves.get_all_possible_moves(state=state, side=state["turn"]):
+            decoded_move = book.decode_move(state=state, encoded_move=book.encode_move(move=move))
+            assert game.move_to_coordinates(move=decoded_move) == game.move_to_coordinates(move=move)
+    # Moves which aren't valid in the position
+    assert book.decode_move(state=play(move_inputs=[]), encoded_move=0x0324) is None
+
+def test_position_key():
+    # Transpositions have the same key, and the side to move, castling rights and en passant are part of it
+    assert zobrist.position_key(state=play(move_inputs=["g1f3", "g8f6", "f3g1", "f6g8"])) == zobrist.position_key(state=play(move_inputs=[]))
+    assert zobrist.position_key(state=play(move_inputs=["e2e4", "e7e5", "g1f3"])) == zobrist.position_key(state=play(move_inputs=["g1f3", "e7e5", "e2e4"]))
+    assert zobrist.position_key(state=play(move_inputs=["g1f3", "g8f6", "f3g1"])) != zobrist.position_key(state=play(move_inputs=["g1f3"]))
+    assert zobrist.position_key(state=play(move_inputs=["e2e4", "e7e5", "e1e2", "e8e7", "e2e1", "e7e8"])) != zobrist.position_key(state=play(move_inputs=["e2e4", "e7e5"]))
+    assert zobrist.position_key(state=play(move_inputs=["e2e4", "g8f6", "e4e5", "d7d5"])) != zobrist.position_key(state=play(move_inputs=["e2e4", "d7d5", "e4e5", "g8f6"]))
+
+def test_build_and_probe(tmp_path):
+    pgn_path = tmp_path / "games.pgn"
+    pgn_path.write_text(PGN)
+    book_path = str(tmp_path / "games.book")
+    assert book.build_book(pgn_paths=[str(pgn_path)], book_path=book_path, max_ply=4, min_weight=0) == 11
+
+    opening_book = book.OpeningBook(path=book_path)
+    try:
+        # Weighted by the results: 2 for a win, 1 for a draw and 0 for a loss
+        book_moves = {game.move_to_coordinates(move=move): weight for move, weight in opening_book.get_moves(state=play(move_inputs=[]))}
+        assert book_moves == {"e2e4": 3, "d2d4": 0}
+        book_moves = {game.move_to_coordinates(move=move): weight for move, weight in opening_book.get_moves(state=play(move_inputs=["e2e4"]))}
+        assert book_moves == {"e7e5": 0, "c7c5": 1}
+        assert opening_book.get_moves(state=play(move_inputs=["e2e4", "e7e5", "g1f3", "b8c6"])) == []
+
+        # Moves with no weight are never chosen
+        rng = random.Random(0)
+        for _ in range(10):
+            assert game.move_to_coordinates(move=opening_book.choose_move(state=play(move_inputs=[]), rng=rng)) == "e2e4"
+        assert opening_book.choose_move(state=play(move_inputs=["a2a3"])) is None
+    finally:
+        opening_book.close()
+
+    # Moves with a lower total weight are left out
+    assert book.build_book(pgn_paths=[str(pgn_path)], book_path=book_path, max_ply=4) == 7
+    assert book.build_book(pgn_paths=[str(pgn_path)], book_path=book_path, max_ply=4, min_weight=2) == 4
@@ -0,0 +1,64 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import parallel
+
+
+class Tracker:
+    """
+    Counts the tasks read from the task list and running at once
+    """
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.read = 0
+        self.running = 0
+        self.max_running = 0
+        self.started = []
+
+    def run(self, index: int, seconds: float) -> int:
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.started.append(index)
+        time.sleep(seconds)
+        with self.lock:
+            self.running -= 1
+        return index
+
+    def tasks(self, count: int):
+        for index in range(count):
+            self.read += 1
+            # Later tasks finish first
+            yield self.run, {"index": index, "seconds": 0.001 * ((count - index) % 5)}
+
+
+def test_results_in_task_order():
+    tracker = Tracker()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(parallel.map_ordered(executor=executor, tasks=tracker.tasks(count=50), max_pending=8)) == list(range(50))
+
+def test_pending_tasks_are_bounded():
+    tracker = Tracker()
+    max_pending = 3
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for result in parallel.map_ordered(executor=executor, tasks=tracker.tasks(count=40), max_pending=max_pending):
+            # The tasks are read lazily: only the ones yielded or in flight and the next one have been read
+            assert tracker.read <= result + max_pending + 1
+    assert tracker.max_running <= max_pending
+    assert tracker.read == 40
+
+def test_stopping_early_cancels_pending_tasks():
+    tracker = Tracker()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        results = parallel.map_ordered(executor=executor, tasks=tracker.tasks(count=100), max_pending=10)
+        assert next(results) == 0
+        results.close()
+    # The tasks waiting in the executor never start
+    assert len(tracker.started) < 10
+    assert tracker.read <= 11
+
+def test_chunks():
+    assert list(parallel.chunks(items=iter(range(7)), chunk_size=3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(parallel.chunks(items=range(6), chunk_size=3)) == [[0, 1, 2], [3, 4, 5]]
+    assert list(parallel.chunks(items=[], chunk_size=3)) == []
@@ -0,0 +1,53 @@
+import game, snapshot
+
+
+def describe_pieces(pieces_params):
+    return {id: (type(piece).__name__, vars(piece)) for id, piece in pieces_params.items()}
+
+def describe_move(move):
+    description = dict(vars(move))
+    if move.castling_move is not None:
+        description["castling_move"] = describe_move(move=move.castling_move)
+    return description
+
+def assert_same_game(state, other_state):
+    assert game.state_to_fen(state=other_state) == game.state_to_fen(state=state)
+    assert other_state["board"] == state["board"]
+    assert describe_pieces(other_state["pieces_params"]) == describe_pieces(state["pieces_params"])
+    assert describe_pieces(other_state["pieces_taken_params"]) == describe_pieces(state["pieces_taken_params"])
+    assert [describe_move(move=move) for move in other_state["moves"]] == [describe_move(move=move) for move in state["moves"]]
+    assert other_state["positions"] == state["positions"]
+    assert (other_state["turn"], other_state["result"], other_state["next_id"]) == (state["turn"], state["result"], state["next_id"])
+
+
+def test_record_round_trip(random_game):
+    for seed in range(3):
+        for state in random_game(seed=seed)[::10]:
+            metadata = {"seed": seed, "players": ["white", "black"]}
+            other_state, other_metadata = snapshot.unpack_state(record=snapshot.pack_state(state=state, metadata=metadata))
+            assert_same_game(state=state, other_state=other_state)
+            assert other_metadata == metadata
+
+def test_resumed_game_continues(random_game):
+    states = random_game(seed=7, max_moves=40)
+    other_state, _ = snapshot.unpack_state(record=snapshot.pack_state(state=states[20]))
+    for state in states[21:]:
+        move = game.choose_move_from_coordinates(state=other_state, move_input=game.move_to_coordinates(move=state["moves"][-1]))
+        other_state = game.make_turn(state=other_state, move=move, log=False)
+        assert game.state_to_fen(state=other_state) == game.state_to_fen(state=state)
+
+def test_save_and_load_games(tmp_path, random_game):
+    path = str(tmp_path / "games.snapshot")
+    games = [(f"game-{seed}", random_game(seed=seed)[-1], {"seed": seed}) for seed in range(3)]
+    snapshot.save_games(path=path, games=games)
+
+    loaded_games = {key: (state, metadata) for key, state, metadata in snapshot.load_games(path=path)}
+    assert sorted(loaded_games) == sorted(key for key, _, _ in games)
+    for key, state, metadata in games:
+        assert_same_game(state=state, other_state=loaded_games[key][0])
+        assert loaded_games[key][1] == metadata
+
+        other_state, other_metadata = snapshot.load_game(path=path, key=key)
+        assert_same_game(state=state, other_state=other_state)
+        assert other_metadata == metadata
+    assert snapshot.load_game(path=path, key="missing") is None
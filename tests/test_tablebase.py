@@ -0,0 +1,71 @@
+import random
+
+import pytest
+
+import game, moves, pieces, tablebase
+
+
+@pytest.fixture(scope="module")
+def tablebases(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp("tablebases"))
+    tablebase.generate(signature="KQvK", directory=directory, workers=1)
+    return tablebase.Tablebases(directory=directory)
+
+
+@pytest.mark.parametrize("fen, value", [
+    # Mate in one (Qh8#) and the mate itself
+    ("k7/8/1K6/8/8/8/7Q/8 w - - 0 1", 2),
+    ("k6Q/8/1K6/8/8/8/8/8 b - - 0 1", 1),
+    # Stalemate, and the queen can be taken
+    ("k7/2Q5/1K6/8/8/8/8/8 b - - 0 1", tablebase.DRAW),
+    ("k7/1Q6/8/8/8/8/8/7K b - - 0 1", tablebase.DRAW),
+    # The same mate in one with the colours swapped is probed through the KQvK table
+    ("8/7q/8/8/8/1k6/8/K7 b - - 0 1", 2),
+])
+def test_probe_values(tablebases, fen, value):
+    assert tablebases.probe(state=game.fen_to_state(fen=fen)) == value
+
+def test_value_counts(tablebases):
+    table = tablebases.get_table(signature="KQvK")
+    values = [value for value in table[tablebase.FILE_HEADER.size:] if value != tablebase.INVALID]
+    # Every valid position with white to move is won, in at most 10 moves
+    white_values = [table[tablebase.FILE_HEADER.size + index] for index in range(tablebase.table_size(signature="KQvK") // 2)]
+    assert all(tablebase.is_win(value=value) for value in white_values if value != tablebase.INVALID)
+    assert max(tablebase.value_to_plies(value=value) for value in values) == 20
+
+def test_values_agree_with_moves(tablebases):
+    # Each value follows from the values after every move: the best move for a win and the longest defence for a loss
+    layout = tablebase.get_layout(signature="KQvK")
+    rng = random.Random(0)
+    checked = 0
+    while checked < 300:
+        squares, turn = tablebase.index_to_position(index=rng.randrange(tablebase.table_size(signature="KQvK")), length=len(layout), has_pawns=False)
+        if len(set(squares)) < len(squares):
+            continue
+        state = tablebase.make_state(layout=layout, squares=squares, turn=turn)
+        value = tablebases.probe(state=state)
+        if value is None:
+            continue
+        checked += 1
+
+        child_plies = []
+        for move in moves.get_all_possible_moves(state=state, side=turn):
+            child = pieces.make_move(state=state, move=move)
+            child["turn"] = 1 - turn
+            child_value = tablebases.probe(state=child)
+            child_plies.append(None if child_value == tablebase.DRAW else tablebase.value_to_plies(value=child_value))
+        if len(child_plies) == 0:
+            assert value == (1 if pieces.in_check(state=state, side=turn) else tablebase.DRAW)
+        elif any(plies is not None and plies % 2 == 0 for plies in child_plies):
+            assert value - 1 == 1 + min(plies for plies in child_plies if plies is not None and plies % 2 == 0)
+        elif any(plies is None for plies in child_plies):
+            assert value == tablebase.DRAW
+        else:
+            assert value - 1 == 1 + max(child_plies)
+
+def test_positions_outside_the_tables(tablebases):
+    # Castling rights, a table that hasn't been generated and too many pieces
+    assert tablebases.probe(state=game.fen_to_state(fen="4k3/8/8/8/8/8/8/4K2Q w - - 0 1")) is not None
+    assert tablebases.probe(state=game.fen_to_state(fen="4k3/8/8/8/8/8/8/R3K3 w Q - 0 1")) is None
+    assert tablebases.probe(state=game.fen_to_state(fen="4k3/8/8/8/8/8/8/R3K3 w - - 0 1")) is None
+    assert tablebases.probe(state=game.setup_board(state=game.create_game_state())) is None
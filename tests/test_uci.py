@@ -0,0 +1,80 @@
+import io
+
+import engine, game, uci
+
+
+def position_fen(state):
+    # The search states only keep the last move, so the move counters aren't compared
+    return " ".join(game.state_to_fen(state=state).split()[:4])
+
+def played_fen(move_inputs, fen=None):
+    state = game.setup_board(state=game.create_game_state()) if fen is None else game.fen_to_state(fen=fen)
+    for move_input in move_inputs:
+        state = game.make_turn(state=state, move=game.choose_move_from_coordinates(state=state, move_input=move_input), log=False)
+    return position_fen(state=state)
+
+
+def test_position_moves_are_made_incrementally(monkeypatch):
+    made_moves = []
+    make_search_move = engine.make_search_move
+    def counting_make_search_move(state, move):
+        made_moves.append(game.move_to_coordinates(move=move))
+        return make_search_move(state=state, move=move)
+    monkeypatch.setattr(engine, "make_search_move", counting_make_search_move)
+
+    uci_engine = uci.UCIEngine(output=io.StringIO())
+    uci_engine.handle(line="position startpos moves e2e4 e7e5")
+    uci_engine.handle(line="position startpos moves e2e4 e7e5 g1f3 b8c6")
+    assert made_moves == ["e2e4", "e7e5", "g1f3", "b8c6"]
+    assert position_fen(state=uci_engine.state) == played_fen(move_inputs=["e2e4", "e7e5", "g1f3", "b8c6"])
+
+    # A different line starts again from the starting position
+    uci_engine.handle(line="position startpos moves d2d4")
+    assert made_moves[4:] == ["d2d4"]
+    assert position_fen(state=uci_engine.state) == played_fen(move_inputs=["d2d4"])
+
+def test_special_moves():
+    uci_engine = uci.UCIEngine(output=io.StringIO())
+    move_inputs = ["e2e4", "g8f6", "e4e5", "d7d5", "e5d6", "e7d6", "g1f3", "f8e7", "f1c4", "e8g8", "e1g1"]
+    uci_engine.handle(line="position startpos moves " + " ".join(move_inputs))
+    assert uci_engine.move_inputs == move_inputs
+    assert position_fen(state=uci_engine.state) == played_fen(move_inputs=move_inputs)
+
+    fen = "8/P6k/8/8/8/8/8/K7 w - - 0 1"
+    uci_engine.handle(line=f"position fen {fen} moves a7a8n")
+    assert position_fen(state=uci_engine.state) == played_fen(move_inputs=["a7a8n"], fen=fen)
+
+def test_invalid_move_stops_the_moves():
+    output = io.StringIO()
+    uci_engine = uci.UCIEngine(output=output)
+    uci_engine.handle(line="position startpos moves e2e4 e2e5 d7d5")
+    assert "info string invalid move e2e5" in output.getvalue().splitlines()
+    assert uci_engine.move_inputs == ["e2e4"]
+    assert position_fen(state=uci_engine.state) == played_fen(move_inputs=["e2e4"])
+
+def test_invalid_fen_keeps_the_position():
+    output = io.StringIO()
+    uci_engine = uci.UCIEngine(output=output)
+    uci_engine.handle(line="position startpos moves e2e4")
+    for fen in [
+        "8/8/8/8/8/8/8/8 w - - 0 1",
+        "4k3/8/8/8/8/8/8/3KK3 w - - 0 1",
+        "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e6 0 1",
+        "not a fen",
+    ]:
+        uci_engine.handle(line=f"position fen {fen}")
+        assert output.getvalue().splitlines()[-1] == "info string invalid position"
+        assert uci_engine.move_inputs == ["e2e4"]
+        assert position_fen(state=uci_engine.state) == played_fen(move_inputs=["e2e4"])
+
+    # The engine still follows the game afterwards
+    uci_engine.handle(line="position startpos moves e2e4 c7c5")
+    assert position_fen(state=uci_engine.state) == played_fen(move_inputs=["e2e4", "c7c5"])
+
+def test_unknown_commands_are_ignored():
+    output = io.StringIO()
+    uci_engine = uci.UCIEngine(output=output)
+    assert uci_engine.handle(line="xyzzy") is True
+    assert uci_engine.handle(line="isready") is True
+    assert output.getvalue() == "readyok\n"
+    assert uci_engine.handle(line="quit") is False